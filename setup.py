@@ -11,6 +11,7 @@ setup(
     packages = find_packages(),
     install_requires = [
         "matplotlib",
+        "contourpy",
         "numpy",
         "scipy",
         "netCDF4",
@@ -0,0 +1,282 @@
+import json, os
+import numpy as np
+from snowline.analysis.snowmap import PIXEL_SNOW, PIXEL_NOSNOW
+
+
+class SnowCube(object):
+    """
+    On-disk time series (time x y x x) of state maps on the internal grid.
+    The grid is split into spatial chunks, every chunk is stored in its own
+    raw int8 file of shape (time, chunk_y, chunk_x). Appending a map appends
+    one frame to every chunk file, and a query for a pixel or a small region
+    only has to memory-map the chunks it touches.
+    """
+    _METADATA_FILENAME = 'cube.json'
+    _CHUNK_FILENAME = 'chunk_{}_{}.bin'
+    _DTYPE = np.int8
+
+    def __init__(self, directory):
+        """
+        Opens an existing cube, use SnowCube.create for a new one.
+        :param str directory: The directory of the cube
+        """
+        self._directory = directory
+        metadata_filename = os.path.join(directory, self._METADATA_FILENAME)
+        if not os.path.isfile(metadata_filename):
+            raise OSError("{} is not a valid cube".format(directory))
+        with open(metadata_filename) as f:
+            metadata = json.load(f)
+        self._shape = tuple(metadata['shape'])
+        self._chunks = tuple(metadata['chunks'])
+        self._timestamps = list(metadata['timestamps'])
+
+    @classmethod
+    def create(cls, directory, shape, chunks=(128, 128)):
+        """
+        Creates a new, empty cube.
+        :param str directory: The directory to create the cube in
+        :param tuple shape: The shape (y, x) of the maps, e.g. Grid().zeros().shape
+        :param tuple chunks: The spatial chunk size (y, x)
+        """
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, cls._METADATA_FILENAME)):
+            raise OSError("There is already a cube in {}".format(directory))
+        shape = tuple(int(n) for n in shape)
+        chunks = tuple(int(n) for n in chunks)
+        if len(shape) != 2 or len(chunks) != 2 or min(chunks) < 1:
+            raise ValueError("Invalid shape {} or chunks {}".format(
+                    shape, chunks))
+        cls._write_metadata(directory, shape, chunks, [])
+        return cls(directory)
+
+    @classmethod
+    def _write_metadata(cls, directory, shape, chunks, timestamps):
+        # Metadata is written last and atomically, frames beyond the number
+        # of timestamps in a chunk file are leftovers of an interrupted
+        # append and are overwritten by the next append.
+        filename = os.path.join(directory, cls._METADATA_FILENAME)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump({'shape': shape, 'chunks': chunks,
+                    'timestamps': timestamps}, f)
+        os.replace(filename + '.tmp', filename)
+
+    def get_timestamps(self):
+        return np.array(self._timestamps, dtype=float)
+
+    def get_shape(self):
+        """
+        Returns the shape (time, y, x) of the cube
+        """
+        return (len(self._timestamps),) + self._shape
+
+    def _iter_chunks(self, ys=None, xs=None):
+        """
+        Yields (iy, ix, slice_y, slice_x) for all chunks overlapping
+        the region ys, xs (slices, default all)
+        """
+        y0, y1 = (ys or slice(None)).indices(self._shape[0])[:2]
+        x0, x1 = (xs or slice(None)).indices(self._shape[1])[:2]
+        if y0 >= y1 or x0 >= x1:
+            return
+        cy, cx = self._chunks
+        for iy in range(y0 // cy, (y1-1) // cy + 1):
+            for ix in range(x0 // cx, (x1-1) // cx + 1):
+                yield (iy, ix, slice(iy*cy, min((iy+1)*cy, self._shape[0])),
+                        slice(ix*cx, min((ix+1)*cx, self._shape[1])))
+
+    def _get_chunk(self, iy, ix, slice_y, slice_x, time_slice=slice(None)):
+        """
+        Returns a read-only memory map of shape (time, y, x) of one chunk
+        """
+        ntimes = len(self._timestamps)
+        shape = (ntimes, slice_y.stop-slice_y.start, slice_x.stop-slice_x.start)
+        if ntimes == 0:
+            return np.zeros(shape, dtype=self._DTYPE)[time_slice]
+        filename = os.path.join(self._directory,
+                self._CHUNK_FILENAME.format(iy, ix))
+        return np.memmap(filename, dtype=self._DTYPE, mode='r',
+                shape=shape)[time_slice]
+
+    def append(self, snowmap, timestamp):
+        """
+        Appends a state map to the cube.
+        :param snowmap: An instance of SnowMap on the internal grid
+        :param timestamp: The timestamp of the map, has to be newer than
+            the last timestamp in the cube
+        """
+        if not snowmap._is_internal:
+            raise ValueError("Only maps on the internal grid can be appended")
+        array = snowmap.get_array()
+        if array.shape != self._shape:
+            raise ValueError("Map of shape {} does not fit in cube of "
+                "shape {}".format(array.shape, self._shape))
+        if self._timestamps and timestamp <= self._timestamps[-1]:
+            raise ValueError("Timestamp {} is not newer than last timestamp "
+                "{} in cube".format(timestamp, self._timestamps[-1]))
+        array = array.astype(self._DTYPE)
+        ntimes = len(self._timestamps)
+        for iy, ix, slice_y, slice_x in self._iter_chunks():
+            frame = np.ascontiguousarray(array[slice_y, slice_x])
+            filename = os.path.join(self._directory,
+                    self._CHUNK_FILENAME.format(iy, ix))
+            with open(filename, 'ab') as f:
+                # Truncating leftovers of a previously interrupted append
+                f.truncate(ntimes * frame.nbytes)
+            with open(filename, 'r+b') as f:
+                f.seek(ntimes * frame.nbytes)
+                f.write(frame.tobytes())
+        self._timestamps.append(timestamp)
+        self._write_metadata(self._directory, self._shape, self._chunks,
+                self._timestamps)
+
+    def _get_time_slice(self, start=None, stop=None):
+        """
+        Returns the slice of time indices with start <= timestamp <= stop
+        """
+        timestamps = self.get_timestamps()
+        istart = 0 if start is None else np.searchsorted(timestamps, start,
+                side='left')
+        istop = len(timestamps) if stop is None else np.searchsorted(
+                timestamps, stop, side='right')
+        return slice(int(istart), int(istop))
+
+    def get_time_index(self, timestamp):
+        """
+        Returns the index of the last map at or before timestamp,
+        -1 if there is none
+        """
+        return int(np.searchsorted(self.get_timestamps(), timestamp,
+                side='right')) - 1
+
+    def get_values(self, iy, ix, time_index):
+        """
+        Returns the values of many pixels in a single map, reading only
+        the chunks that contain pixels.
+        :param iy: Array with the indices in y
+        :param ix: Array with the indices in x
+        :param int time_index: The index of the map, see get_time_index
+        """
+        iy = np.asarray(iy, dtype=np.int64)
+        ix = np.asarray(ix, dtype=np.int64)
+        if not 0 <= time_index < len(self._timestamps):
+            raise IndexError("No map with index {}".format(time_index))
+        if np.any((iy < 0) | (iy >= self._shape[0]) | (ix < 0) |
+                (ix >= self._shape[1])):
+            raise IndexError("Pixels out of bounds")
+        cy, cx = self._chunks
+        values = np.zeros(iy.shape, dtype=self._DTYPE)
+        chunk_ids = (iy // cy) * (self._shape[1] // cx + 1) + ix // cx
+        for chunk_id in np.unique(chunk_ids):
+            msk = chunk_ids == chunk_id
+            chunk_iy, chunk_ix = iy[msk][0] // cy, ix[msk][0] // cx
+            slice_y = slice(chunk_iy*cy, min((chunk_iy+1)*cy, self._shape[0]))
+            slice_x = slice(chunk_ix*cx, min((chunk_ix+1)*cx, self._shape[1]))
+            chunk = self._get_chunk(chunk_iy, chunk_ix, slice_y, slice_x)
+            values[msk] = chunk[time_index, iy[msk] - slice_y.start,
+                    ix[msk] - slice_x.start]
+        return values
+
+    def get_pixel_series(self, iy, ix, start=None, stop=None):
+        """
+        Returns the values of a single pixel over time, only reading the
+        chunk the pixel is in.
+        :param int iy: The index in y
+        :param int ix: The index in x
+        :param start: Optional, the first timestamp to include
+        :param stop: Optional, the last timestamp to include
+        """
+        if not (0 <= iy < self._shape[0] and 0 <= ix < self._shape[1]):
+            raise IndexError("Pixel {}, {} out of bounds".format(iy, ix))
+        (chunk_iy, chunk_ix, slice_y, slice_x), = self._iter_chunks(
+                slice(iy, iy+1), slice(ix, ix+1))
+        chunk = self._get_chunk(chunk_iy, chunk_ix, slice_y, slice_x,
+                self._get_time_slice(start, stop))
+        return np.array(chunk[:, iy-slice_y.start, ix-slice_x.start])
+
+    def get_region_series(self, ys, xs, start=None, stop=None):
+        """
+        Returns the values of a rectangular region over time as an array
+        of shape (time, y, x).
+        :param slice ys: The region in y
+        :param slice xs: The region in x
+        :param start: Optional, the first timestamp to include
+        :param stop: Optional, the last timestamp to include
+        """
+        time_slice = self._get_time_slice(start, stop)
+        ys = slice(*ys.indices(self._shape[0])[:2])
+        xs = slice(*xs.indices(self._shape[1])[:2])
+        ntimes = len(range(*time_slice.indices(len(self._timestamps))))
+        result = np.zeros((ntimes, max(ys.stop-ys.start, 0),
+                max(xs.stop-xs.start, 0)), dtype=self._DTYPE)
+        if result.size == 0:
+            return result
+        for iy, ix, slice_y, slice_x in self._iter_chunks(ys, xs):
+            chunk = self._get_chunk(iy, ix, slice_y, slice_x, time_slice)
+            y0, y1 = max(ys.start, slice_y.start), min(ys.stop, slice_y.stop)
+            x0, x1 = max(xs.start, slice_x.start), min(xs.stop, slice_x.stop)
+            result[:, y0-ys.start:y1-ys.start, x0-xs.start:x1-xs.start] = \
+                    chunk[:, y0-slice_y.start:y1-slice_y.start,
+                        x0-slice_x.start:x1-slice_x.start]
+        return result
+
+    def _reduce(self, function, dtype, start=None, stop=None):
+        """
+        Applies function chunk by chunk to arrays of shape (time, y, x),
+        function has to return an array of shape (y, x).
+        Only one chunk is in memory at any time.
+        """
+        time_slice = self._get_time_slice(start, stop)
+        result = np.zeros(self._shape, dtype=dtype)
+        for iy, ix, slice_y, slice_x in self._iter_chunks():
+            chunk = np.asarray(self._get_chunk(iy, ix, slice_y, slice_x,
+                    time_slice))
+            result[slice_y, slice_x] = function(chunk)
+        return result
+
+    def get_snow_duration(self, start=None, stop=None):
+        """
+        Returns the number of time steps with snow for every pixel.
+        With daily maps, this is the number of days with snow.
+        :param start: Optional, the first timestamp to include
+        :param stop: Optional, the last timestamp to include
+        """
+        return self._reduce(lambda chunk: (chunk == PIXEL_SNOW).sum(axis=0),
+                np.int32, start=start, stop=stop)
+
+    def get_onset(self, start=None, stop=None):
+        """
+        Returns the timestamp of the first snow for every pixel,
+        NaN for pixels without snow.
+        :param start: Optional, the first timestamp to include
+        :param stop: Optional, the last timestamp to include
+        """
+        timestamps = self.get_timestamps()[self._get_time_slice(start, stop)]
+        def onset(chunk):
+            is_snow = chunk == PIXEL_SNOW
+            result = timestamps[is_snow.argmax(axis=0)] if len(timestamps) \
+                    else np.zeros(chunk.shape[1:])
+            return np.where(is_snow.any(axis=0), result, np.nan)
+        return self._reduce(onset, float, start=start, stop=stop)
+
+    def get_melt(self, start=None, stop=None):
+        """
+        Returns the timestamp of the melt for every pixel, that is the first
+        time no snow is observed after the last observation of snow.
+        NaN for pixels without melt.
+        :param start: Optional, the first timestamp to include
+        :param stop: Optional, the last timestamp to include
+        """
+        timestamps = self.get_timestamps()[self._get_time_slice(start, stop)]
+        def melt(chunk):
+            ntimes = chunk.shape[0]
+            if ntimes == 0:
+                return np.full(chunk.shape[1:], np.nan)
+            is_snow = chunk == PIXEL_SNOW
+            last_snow = ntimes - 1 - is_snow[::-1].argmax(axis=0)
+            # Pixels that never had snow cannot melt
+            last_snow[~is_snow.any(axis=0)] = ntimes
+            after_snow = (chunk == PIXEL_NOSNOW) & (
+                    np.arange(ntimes)[:, None, None] > last_snow)
+            result = timestamps[after_snow.argmax(axis=0)]
+            return np.where(after_snow.any(axis=0), result, np.nan)
+        return self._reduce(melt, float, start=start, stop=stop)
@@ -0,0 +1,189 @@
+import hashlib, json, os
+import numpy as np
+from snowline.analysis.grid import get_grid, WGS_DIST_X, WGS_DIST_Y
+from snowline.analysis.snowmap import PIXEL_SNOW, PIXEL_NOSNOW
+
+NODATA_ELEVATION = -32768
+# Aspect classes, the direction a slope faces. Slopes below
+# FLAT_SLOPE get the class flat.
+ASPECTS = ('N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW', 'flat')
+FLAT_SLOPE = 0.05
+
+
+class ElevationModel(object):
+    """
+    A digital elevation model on the internal grid, stored compactly as
+    int16 elevations (m) and uint8 aspect classes (indices into ASPECTS).
+    """
+    def __init__(self, elevation, aspect=None):
+        """
+        :param elevation: Array of the grid shape with elevations in
+            meters, NODATA_ELEVATION where unknown
+        :param aspect: Optional, array with the aspect classes,
+            calculated from elevation if not given
+        """
+        elevation = np.asarray(elevation)
+        if elevation.shape != get_grid().zeros().shape:
+            raise ValueError("Elevation is not on the internal grid")
+        self._elevation = elevation.astype(np.int16)
+        if aspect is None:
+            aspect = self._calculate_aspect(self._elevation)
+        self._aspect = np.asarray(aspect).astype(np.uint8)
+
+    @staticmethod
+    def _calculate_aspect(elevation):
+        grid = get_grid()
+        # Rows go from south to north, columns from west to east
+        spacing_y = grid._transformation[1] * WGS_DIST_Y
+        spacing_x = grid._transformation[0] * WGS_DIST_X
+        z = np.where(elevation == NODATA_ELEVATION, np.nan,
+                elevation.astype(np.float32))
+        dz_north, dz_east = np.gradient(z, spacing_y, spacing_x)
+        # A slope faces downhill, angle clockwise from north
+        angle = np.degrees(np.arctan2(-dz_east, -dz_north)) % 360
+        aspect = (np.round(angle / 45).astype(np.int64) % 8).astype(np.uint8)
+        flat = ~(np.hypot(dz_north, dz_east) >= FLAT_SLOPE)
+        aspect[flat] = ASPECTS.index('flat')
+        return aspect
+
+    @classmethod
+    def from_array(cls, elevation, lon, lat):
+        """
+        Resamples a DEM in WGS coordinates onto the internal grid.
+        :param elevation: Array of shape (lat, lon) with elevations in
+            meters, NaN where unknown
+        :param lon: The longitudes of the columns, ascending
+        :param lat: The latitudes of the rows, ascending
+        """
+        elevation = np.asarray(elevation, dtype=np.float32)
+        elevation = np.where(np.isnan(elevation), NODATA_ELEVATION, elevation)
+        on_grid = get_grid().transform_map_from_grid(elevation.T,
+                np.asarray(lon), np.asarray(lat),
+                fill_value=NODATA_ELEVATION).T
+        return cls(np.round(on_grid))
+
+    @classmethod
+    def from_file(cls, filename, cache_dir=None):
+        """
+        Loads a DEM from a npz file with arrays elevation (lat x lon), lon
+        and lat, see from_array. The resampled DEM is cached in cache_dir,
+        if given, under a key of file content and grid, so resampling is
+        done only once.
+        :param str filename: The npz file
+        :param str cache_dir: Optional, directory to cache resampled DEMs in
+        """
+        cache_filename = None
+        if cache_dir is not None:
+            key = hashlib.sha256(json.dumps(get_grid().get_spec(),
+                    sort_keys=True).encode())
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    key.update(block)
+            cache_filename = os.path.join(cache_dir,
+                    'dem_{}.npz'.format(key.hexdigest()[:16]))
+            if os.path.isfile(cache_filename):
+                return cls.load(cache_filename)
+        with np.load(filename) as data:
+            new = cls.from_array(data['elevation'], data['lon'], data['lat'])
+        if cache_filename is not None:
+            new.save(cache_filename)
+        return new
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['elevation'], aspect=data['aspect'])
+
+    def save(self, filename):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        tmp_filename = filename + '.tmp.npz'
+        np.savez_compressed(tmp_filename, elevation=self._elevation,
+                aspect=self._aspect)
+        os.replace(tmp_filename, filename)
+
+    def get_elevation(self):
+        return self._elevation
+
+    def get_aspect(self):
+        return self._aspect
+
+    def get_histograms(self, snowmap, regions=None, band_width=100):
+        """
+        Returns the histograms of snow and no-snow pixels over region,
+        aspect and elevation band.
+        :param snowmap: An instance of SnowMap on the internal grid
+        :param regions: Optional, a RegionRaster. If None, the whole grid
+            is treated as a single region.
+        :param int band_width: Width of the elevation bands in meters
+        :returns: snow, nosnow, min_elevation. snow and nosnow are arrays of
+            shape (regions, aspects, bands), band i starts at
+            min_elevation + i*band_width
+        """
+        if not snowmap._is_internal:
+            raise ValueError("Histograms need a map on the internal grid")
+        valid = self._elevation != NODATA_ELEVATION
+        if regions is None:
+            labels = valid.astype(np.int32)
+            nregions = 1
+        else:
+            labels = regions.get_labels()
+            nregions = len(regions.get_names())
+            valid &= labels > 0
+        if not valid.any():
+            raise ValueError("No valid elevation in any region")
+        min_elevation = int(self._elevation[valid].min() //
+                band_width * band_width)
+        bands = (self._elevation.astype(np.int32) - min_elevation) // band_width
+        nbands = int(bands[valid].max()) + 1
+        naspects = len(ASPECTS)
+        # A single flat index, such that every histogram is one bincount
+        index = ((labels - 1) * naspects + self._aspect) * nbands + bands
+        shape = (nregions, naspects, nbands)
+        array = snowmap._array
+        snow, nosnow = [np.bincount(index[valid & (array == value)],
+                minlength=nregions*naspects*nbands).reshape(shape)
+                for value in (PIXEL_SNOW, PIXEL_NOSNOW)]
+        return snow, nosnow, min_elevation
+
+    def get_snowline_altitudes(self, snowmap, regions=None, band_width=100,
+            min_pixels=100):
+        """
+        Estimates the snowline altitude per region and aspect. The altitude
+        is the band edge that minimizes the number of misclassified pixels,
+        i.e. snow below plus no snow above the snowline.
+        :param snowmap: An instance of SnowMap on the internal grid
+        :param regions: Optional, a RegionRaster
+        :param int band_width: Width of the elevation bands in meters
+        :param int min_pixels: Minimum number of pixels with snow or no snow
+            needed for an estimate
+        :returns: A list of dictionaries with region, aspect (one of ASPECTS
+            or 'all'), snowline_altitude (None if no estimate) and the
+            pixel counts used.
+        """
+        snow, nosnow, min_elevation = self.get_histograms(snowmap,
+                regions=regions, band_width=band_width)
+        # Adding the sum over all aspects
+        snow = np.concatenate([snow, snow.sum(axis=1, keepdims=True)], axis=1)
+        nosnow = np.concatenate([nosnow, nosnow.sum(axis=1, keepdims=True)],
+                axis=1)
+        zeros = np.zeros(snow.shape[:2] + (1,), dtype=snow.dtype)
+        # errors[..., i] is the number of misclassified pixels for a
+        # snowline at the lower edge of band i (i == nbands is above all)
+        snow_below = np.concatenate([zeros, snow.cumsum(axis=2)], axis=2)
+        nosnow_above = np.concatenate([nosnow[..., ::-1].cumsum(axis=2)[
+                ..., ::-1], zeros], axis=2)
+        errors = snow_below + nosnow_above
+        altitudes = min_elevation + errors.argmin(axis=2) * band_width
+        nsnow, nnosnow = snow.sum(axis=2), nosnow.sum(axis=2)
+        names = ['all'] if regions is None else regions.get_names()
+        result = []
+        for iregion, name in enumerate(names):
+            for iaspect, aspect in enumerate(ASPECTS + ('all',)):
+                enough = nsnow[iregion, iaspect] + nnosnow[iregion, iaspect] \
+                        >= min_pixels
+                result.append({'region': name, 'aspect': aspect,
+                        'snowline_altitude': int(altitudes[iregion, iaspect])
+                            if enough else None,
+                        'snow_pixels': int(nsnow[iregion, iaspect]),
+                        'nosnow_pixels': int(nnosnow[iregion, iaspect])})
+        return result
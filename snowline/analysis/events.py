@@ -0,0 +1,160 @@
+import json, os
+import numpy as np
+from snowline.analysis.grid import get_grid
+from snowline.analysis.labelling import label_tiled, NEUMANN_STRUCTURE
+
+# Directions of a change, no snow to snow and snow to no snow
+ONSET = 1
+MELT = -1
+_EVENT_TYPES = {ONSET: 'onset', MELT: 'melt'}
+
+
+class ChangeSet(object):
+    """
+    The pixels that flipped between snow and no snow in an update, as flat
+    indices into the map and directions (ONSET or MELT)
+    """
+    def __init__(self, indices, directions, shape, timestamp=None):
+        self._indices = np.asarray(indices, dtype=np.int64)
+        self._directions = np.asarray(directions, dtype=np.int8)
+        self._shape = tuple(shape)
+        self._timestamp = timestamp
+
+    def __len__(self):
+        return len(self._indices)
+
+    def get_indices(self):
+        return self._indices
+
+    def get_directions(self):
+        return self._directions
+
+    def get_timestamp(self):
+        return self._timestamp
+
+    def get_events(self, min_pixels=1):
+        """
+        Clusters the changed pixels into events, connected pixels with the
+        same direction forming one event.
+        :param int min_pixels: Events with fewer pixels are dropped
+        :returns: A list of dictionaries with timestamp, type (onset or
+            melt), pixels, area (km^2), bbox (minlon, minlat, maxlon,
+            maxlat) and centroid (lon, lat)
+        """
+        from scipy.ndimage import find_objects
+        grid = get_grid()
+        lon, lat = grid.get_coordinates()
+        pixel_area = (grid.GRID_PREC * 1e-3)**2
+        events = []
+        for direction, event_type in _EVENT_TYPES.items():
+            indices = self._indices[self._directions == direction]
+            if not len(indices):
+                continue
+            iy, ix = np.unravel_index(indices, self._shape)
+            # Labelling only the window around the changed pixels
+            y0, x0 = iy.min(), ix.min()
+            mask = np.zeros((iy.max()-y0+1, ix.max()-x0+1), dtype=bool)
+            mask[iy-y0, ix-x0] = True
+            labels, _, sizes = label_tiled(mask, structure=NEUMANN_STRUCTURE)
+            label_of_pixel = labels[iy-y0, ix-x0]
+            sum_lon = np.bincount(label_of_pixel, weights=lon[iy, ix])
+            sum_lat = np.bincount(label_of_pixel, weights=lat[iy, ix])
+            for label, (slice_y, slice_x) in enumerate(find_objects(labels),
+                    start=1):
+                if sizes[label] < min_pixels:
+                    continue
+                ys = slice(slice_y.start+y0, slice_y.stop+y0-1)
+                xs = slice(slice_x.start+x0, slice_x.stop+x0-1)
+                events.append({'timestamp': self._timestamp,
+                        'type': event_type,
+                        'pixels': int(sizes[label]),
+                        'area': round(float(sizes[label] * pixel_area), 3),
+                        'bbox': [float(lon[ys.start, xs.start]),
+                            float(lat[ys.start, xs.start]),
+                            float(lon[ys.stop, xs.stop]),
+                            float(lat[ys.stop, xs.stop])],
+                        'centroid': [float(sum_lon[label] / sizes[label]),
+                            float(sum_lat[label] / sizes[label])]})
+        return events
+
+
+class EventLog(object):
+    """
+    A rolling log of change events, one JSON object per line. Events are
+    appended, events older than the retention are dropped when the log
+    is appended to.
+    """
+    def __init__(self, filename, retention=30*86400):
+        """
+        :param str filename: The log file, created if needed
+        :param float retention: Seconds to keep events, relative to the
+            newest event. None keeps all events.
+        """
+        self._filename = filename
+        self._retention = retention
+
+    def get_events(self, since=None, bbox=None):
+        """
+        Returns the events in the log
+        :param since: Optional, only events with a later timestamp
+        :param bbox: Optional, (minlon, minlat, maxlon, maxlat), only
+            events with an intersecting bounding box
+        """
+        try:
+            with open(self._filename) as f:
+                events = [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+        if since is not None:
+            events = [event for event in events if event['timestamp'] is not
+                    None and event['timestamp'] > since]
+        if bbox is not None:
+            events = [event for event in events if
+                    event['bbox'][0] <= bbox[2] and event['bbox'][2] >= bbox[0]
+                    and event['bbox'][1] <= bbox[3] and
+                    event['bbox'][3] >= bbox[1]]
+        return events
+
+    def _get_first_event(self):
+        """
+        Returns the first event of the log, None if there is none
+        """
+        try:
+            with open(self._filename) as f:
+                for line in f:
+                    if line.strip():
+                        return json.loads(line)
+        except FileNotFoundError:
+            pass
+        return None
+
+    def append(self, events):
+        """
+        Appends events and drops the events older than the retention.
+        The log is in time order, only its first event is read to decide
+        whether there are events to drop, and the log is only rewritten
+        then.
+        """
+        if not events:
+            return
+        directory = os.path.dirname(os.path.abspath(self._filename))
+        os.makedirs(directory, exist_ok=True)
+        timestamps = [event['timestamp'] for event in events
+                if event['timestamp'] is not None]
+        oldest = None
+        if self._retention is not None and timestamps:
+            oldest = max(timestamps) - self._retention
+        first = self._get_first_event() if oldest is not None else None
+        if first is not None and (first['timestamp'] is None or
+                first['timestamp'] < oldest):
+            # Rewriting the log without the old events, atomically
+            kept = [event for event in self.get_events()
+                    if event['timestamp'] is not None
+                    and event['timestamp'] >= oldest]
+            with open(self._filename + '.tmp', 'w') as f:
+                for event in kept + list(events):
+                    f.write(json.dumps(event) + '\n')
+            os.replace(self._filename + '.tmp', self._filename)
+        else:
+            with open(self._filename, 'a') as f:
+                f.write(''.join(json.dumps(event) + '\n' for event in events))
@@ -1,5 +1,6 @@
+import functools
 import numpy as np
-from scipy.interpolate import RegularGridInterpolator
+from snowline.utils.boundaries import Boundaries
 
 
 
@@ -8,6 +9,41 @@ from scipy.interpolate import RegularGridInterpolator
 WGS_DIST_X = 76e3
 WGS_DIST_Y = 111e3
 
+
+def _get_cell_edges(centers):
+    """
+    Returns the edges of the cells around ascending cell centers, halfway
+    between neighboring centers and half a spacing beyond the outer ones
+    """
+    centers = np.asarray(centers, dtype=float)
+    if len(centers) < 2:
+        raise ValueError("Need at least two cell centers")
+    middle = 0.5 * (centers[1:] + centers[:-1])
+    return np.concatenate([[1.5*centers[0] - 0.5*centers[1]], middle,
+            [1.5*centers[-1] - 0.5*centers[-2]]])
+
+
+def _get_overlap_matrix(source_centers, target_centers):
+    """
+    Returns a sparse matrix W of shape (target, source) along one axis,
+    W[i, j] being the fraction of target cell i covered by source cell j.
+    """
+    from scipy.sparse import coo_matrix
+    source_edges = _get_cell_edges(source_centers)
+    target_edges = _get_cell_edges(target_centers)
+    # Every interval between two consecutive edges (of either grid) lies
+    # within a single source and a single target cell
+    breaks = np.union1d(source_edges, target_edges)
+    middle = 0.5 * (breaks[1:] + breaks[:-1])
+    isource = np.searchsorted(source_edges, middle, side='right') - 1
+    itarget = np.searchsorted(target_edges, middle, side='right') - 1
+    valid = ((isource >= 0) & (isource < len(source_centers)) &
+            (itarget >= 0) & (itarget < len(target_centers)))
+    itarget, isource = itarget[valid], isource[valid]
+    weights = np.diff(breaks)[valid] / np.diff(target_edges)[itarget]
+    return coo_matrix((weights, (itarget, isource)),
+            shape=(len(target_centers), len(source_centers))).tocsr()
+
 class Grid(object):
     # Using international WGS 84 coordinates. CH lies between 45.8 and 47.8N and between 5.9 and 10.5E 
     # Defining our grid here, hardcoded:
@@ -17,6 +53,8 @@ class Grid(object):
     # The distance between neighboring gridpoint in meters
     # This could be changed by users in the future, for now I hard code here #TODO
     GRID_PREC = 300
+    # Number of source geometries for which resampling operators are kept
+    _MAX_RESAMPLING_OPERATORS = 8
     def __init__(self):
         self._origin = np.array(self.LOWER_LEFT)
 
@@ -30,6 +68,45 @@ class Grid(object):
         grid_y = np.linspace(self.LOWER_LEFT[1], self.UPPER_RIGHT[1], self._gridsize_y)
 
         self._coords_mesh = np.array(np.meshgrid(grid_x, grid_y))
+        self._resampling_operators = {}
+
+    def get_spec(self):
+        """
+        Returns a JSON-compatible description of the grid, two grids with
+        the same spec are identical. Useful as key for cached data.
+        """
+        return {'lower_left': list(self.LOWER_LEFT),
+                'upper_right': list(self.UPPER_RIGHT),
+                'grid_prec': self.GRID_PREC,
+                'shape': [self._gridsize_y, self._gridsize_x]}
+
+    def get_coordinates(self):
+        """
+        Returns the WGS coordinates (longitude, latitude) of every grid
+        point as an array of shape (2, y, x)
+        """
+        return self._coords_mesh
+
+    def get_indices(self, lon, lat):
+        """
+        Returns the indices (iy, ix) of the grid points nearest to the
+        given WGS coordinates, the inverse of the sampling done in
+        transform_map_from_grid. Vectorized, lon and lat can be arrays.
+        Points outside of the grid get the index -1.
+        """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        ix = np.asarray(np.round((lon - self.LOWER_LEFT[0]) / (
+                self.UPPER_RIGHT[0] - self.LOWER_LEFT[0]) *
+                (self._gridsize_x - 1)))
+        iy = np.asarray(np.round((lat - self.LOWER_LEFT[1]) / (
+                self.UPPER_RIGHT[1] - self.LOWER_LEFT[1]) *
+                (self._gridsize_y - 1)))
+        outside = ~((ix >= 0) & (ix < self._gridsize_x) &
+                (iy >= 0) & (iy < self._gridsize_y))
+        ix[outside] = -1
+        iy[outside] = -1
+        return iy.astype(np.int64), ix.astype(np.int64)
 
     def transform_map(self, map_, coords, fill_value):
         """
@@ -51,18 +128,71 @@ class Grid(object):
         return self.transform_map_from_grid(map_, grid_x_given, grid_y_given, fill_value)
 
     def transform_map_from_grid(self, map_, grid_x, grid_y, fill_value):
+        from scipy.interpolate import RegularGridInterpolator
         rgi = RegularGridInterpolator((grid_x, grid_y), map_,
                         bounds_error=False, fill_value=fill_value)
         return rgi(self._coords_mesh.T, method='nearest').astype(map_.dtype)
 
+    def get_resampling_operator(self, grid_x, grid_y):
+        """
+        Returns the sparse matrices (w_x, w_y) of the area-weighted
+        resampling from a source grid (rectilinear, ascending coordinates)
+        to the internal grid. The resampling operator on the flattened maps
+        is the Kronecker product of both, w_x[i, j] is the fraction of
+        target column i covered by source column j, likewise for rows.
+        Operators are cached per source geometry, scenes on the same
+        source grid reuse them.
+        :param grid_x: The longitudes of the source columns
+        :param grid_y: The latitudes of the source rows
+        """
+        grid_x = np.asarray(grid_x, dtype=float)
+        grid_y = np.asarray(grid_y, dtype=float)
+        key = (grid_x.tobytes(), grid_y.tobytes())
+        operator = self._resampling_operators.pop(key, None)
+        if operator is None:
+            operator = (_get_overlap_matrix(grid_x, self._coords_mesh[0, 0]),
+                    _get_overlap_matrix(grid_y, self._coords_mesh[1, :, 0]))
+            while len(self._resampling_operators) >= \
+                    self._MAX_RESAMPLING_OPERATORS:
+                self._resampling_operators.pop(next(iter(
+                        self._resampling_operators)))
+        # Most recently used last
+        self._resampling_operators[key] = operator
+        return operator
+
+    def transform_fractions_from_grid(self, maps, grid_x, grid_y):
+        """
+        Conservative, area-weighted resampling of maps on a source grid to
+        the internal grid, see get_resampling_operator. Like
+        transform_map_from_grid, maps are indexed (x, y).
+        :param maps: A list of 2-D maps, e.g. boolean masks of a class
+        :param grid_x: The longitudes of the source columns
+        :param grid_y: The latitudes of the source rows
+        :returns: An array of shape (len(maps), x, y) with the area-weighted
+            mean of every map over each cell of the internal grid. Parts of
+            a cell not covered by the source grid count as 0, so the
+            fractions of all classes of a map add up to the covered fraction.
+        """
+        w_x, w_y = self.get_resampling_operator(grid_x, grid_y)
+        fractions = np.empty((len(maps), w_x.shape[0], w_y.shape[0]),
+                dtype=np.float32)
+        for imap, map_ in enumerate(maps):
+            # Separable form of kron(w_x, w_y) @ map_.ravel(), two sparse
+            # products instead of one much larger matrix
+            resampled_x = w_x @ np.asarray(map_, dtype=np.float32)
+            fractions[imap] = (w_y @ resampled_x.T).T
+        return fractions
 
     def transform_boundaries(self, boundaries):
         """
         Transform boundaries in internal grid, as returned by SnowMap.get_boundaries,
-        to WGS coordinates.
+        to WGS coordinates. An instance of Boundaries is transformed at once,
+        other iterables of boundaries lazily, cluster by cluster.
         """
-        for boundaries_this_cluster in boundaries:
-            yield transform_boundary(boundaries_this_cluster)
+        if isinstance(boundaries, Boundaries):
+            return boundaries.transform(self._transformation, self._origin)
+        return (self.transform_boundary(boundaries_this_cluster)
+                for boundaries_this_cluster in boundaries)
 
     def transform_boundary(self, boundaries_cluster):
         """
@@ -79,3 +209,13 @@ class Grid(object):
         Convenience function, returns a grid of the right shape filled with zeros
         """
         return np.zeros((self._gridsize_y, self._gridsize_x), dtype=dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def get_grid():
+    """
+    Returns a shared instance of Grid. Building the grid (and its coordinate
+    mesh) is not free, long-running processes should reuse this instance
+    instead of creating a new Grid for every map.
+    """
+    return Grid()
@@ -0,0 +1,150 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Von Neumann neighborhood, as used by SnowMap
+NEUMANN_STRUCTURE = [[0,1,0], [1,1,1], [0,1,0]]
+
+
+class UnionFind(object):
+    """
+    Union-find over the integers 0..size-1, 0 is never merged with
+    other elements (it is the background label).
+    """
+    def __init__(self, size):
+        self._parent = np.arange(size, dtype=np.int64)
+
+    def find(self, element):
+        parent = self._parent
+        root = element
+        while parent[root] != root:
+            root = parent[root]
+        # Path compression
+        while parent[element] != root:
+            parent[element], element = root, parent[element]
+        return root
+
+    def union(self, first, second):
+        first, second = self.find(first), self.find(second)
+        # The smaller label becomes the root, such that the resulting
+        # labels are in order of first appearance, like scipy's
+        if first < second:
+            self._parent[second] = first
+        elif second < first:
+            self._parent[first] = second
+
+    def get_roots(self):
+        """
+        Returns an array with the root of every element, vectorized by
+        pointer jumping instead of calling find for every element.
+        """
+        parent = self._parent
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                return parent.copy()
+            parent = grandparent
+
+
+def _get_tiles(shape, tile_size):
+    for y0 in range(0, shape[0], tile_size):
+        for x0 in range(0, shape[1], tile_size):
+            yield (slice(y0, min(y0+tile_size, shape[0])),
+                    slice(x0, min(x0+tile_size, shape[1])))
+
+
+def _get_seam_pairs(labels, structure, tile_size):
+    """
+    Returns the pairs of labels of neighboring pixels on different sides
+    of a tile seam, according to the (3x3) structure
+    """
+    structure = np.asarray(structure, dtype=bool)
+    pairs = []
+    # Horizontal seams, between rows y-1 and y
+    for y in range(tile_size, labels.shape[0], tile_size):
+        upper = np.asarray(labels[y-1])
+        lower = np.asarray(labels[y])
+        for dx in (-1, 0, 1):
+            if not structure[2, 1+dx]:
+                continue
+            first = upper[max(0, -dx):len(upper)-max(0, dx)]
+            second = lower[max(0, dx):len(lower)-max(0, -dx)]
+            pairs.append(np.stack([first, second], axis=1))
+    # Vertical seams, between columns x-1 and x
+    for x in range(tile_size, labels.shape[1], tile_size):
+        left = np.asarray(labels[:, x-1])
+        right = np.asarray(labels[:, x])
+        for dy in (-1, 0, 1):
+            if not structure[1+dy, 2]:
+                continue
+            first = left[max(0, -dy):len(left)-max(0, dy)]
+            second = right[max(0, dy):len(right)-max(0, -dy)]
+            pairs.append(np.stack([first, second], axis=1))
+    if not pairs:
+        return np.zeros((0, 2), dtype=labels.dtype)
+    pairs = np.concatenate(pairs)
+    pairs = pairs[(pairs[:, 0] != 0) & (pairs[:, 1] != 0) &
+            (pairs[:, 0] != pairs[:, 1])]
+    return np.unique(pairs, axis=0)
+
+
+def label_tiled(mask, structure=NEUMANN_STRUCTURE, tile_size=1024,
+        out=None, n_jobs=1):
+    """
+    Labels the clusters of True pixels in mask, like
+    scipy.ndimage.label, but tile by tile. Tiles are labelled
+    independently (in parallel if n_jobs > 1) and the labels are merged
+    across tile seams with a union-find. Only one tile (per job) is
+    processed at a time, so with memory-mapped arrays as mask and out,
+    maps larger than RAM can be labelled. Without out, the labels are
+    an in-memory array of the size of mask.
+    :param mask: A 2-D boolean array
+    :param structure: The 3x3 structure defining the neighborhood
+    :param int tile_size: The size of the (square) tiles
+    :param out: Optional, an integer array of the shape of mask to write
+        the labels to, e.g. a numpy.memmap
+    :param int n_jobs: The number of tiles labelled in parallel
+    :returns: labels, num_clusters, sizes. Labels are consecutive from 1 to
+        num_clusters, sizes[i] is the number of pixels with label i.
+    """
+    from scipy.ndimage import label
+    if out is None:
+        out = np.zeros(mask.shape, dtype=np.int32)
+    elif out.shape != mask.shape:
+        raise ValueError("out has the wrong shape")
+
+    def label_tile(tile):
+        return label(np.asarray(mask[tile], dtype=bool), structure=structure)
+
+    tiles = list(_get_tiles(mask.shape, tile_size))
+    num_labels = 0
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as executor:
+        # Submitting a batch at a time keeps the memory bounded
+        for start in range(0, len(tiles), max(1, n_jobs)):
+            batch = tiles[start:start+max(1, n_jobs)]
+            for tile, (labels, num) in zip(batch,
+                    executor.map(label_tile, batch)):
+                # Checking before offsetting, the labels would wrap around
+                if num_labels + num > np.iinfo(out.dtype).max:
+                    raise OverflowError("Too many clusters for dtype {}".format(
+                            out.dtype))
+                labels = labels.astype(out.dtype, copy=False)
+                labels[labels != 0] += num_labels
+                out[tile] = labels
+                num_labels += num
+
+    union_find = UnionFind(num_labels + 1)
+    for first, second in _get_seam_pairs(out, structure, tile_size):
+        union_find.union(first, second)
+    roots = union_find.get_roots()
+    # Consecutive labels for the roots, in order
+    is_root = roots == np.arange(num_labels + 1)
+    new_labels = np.cumsum(is_root) - 1
+    mapping = new_labels[roots].astype(out.dtype)
+    num_clusters = int(new_labels[-1]) if num_labels else 0
+
+    sizes = np.zeros(num_clusters + 1, dtype=np.int64)
+    for tile in tiles:
+        labels = mapping[out[tile]]
+        out[tile] = labels
+        sizes += np.bincount(labels.ravel(), minlength=num_clusters + 1)
+    return out, num_clusters, sizes
@@ -1,9 +1,14 @@
-import netCDF4
 import numpy as np
 from snowline.analysis.snowmap import PIXEL_NOSNOW, PIXEL_SNOW, PIXEL_UNKNOWN
-from snowline.analysis.grid import Grid
+from snowline.analysis.grid import get_grid
 
 class NetCDF4SnowMap(object):
+    # Increase whenever a change in reading or thresholding changes the
+    # resulting maps, invalidates the decoded maps in SceneCache
+    READER_VERSION = 1
+    # nearest: value of the nearest source pixel, area: class with the
+    # largest area fraction, see get_fractions
+    RESAMPLING_METHODS = ('nearest', 'area')
     _REQUIRED_VARS = ('lon', 'lat', 'IDEPIX_CLOUD', 
             'IDEPIX_SNOW_ICE', 'RED')
     _OPTIONAL_VARS = ('IDEPIX_CLOUD_BUFFER', 'IDEPIX_INVALID')
@@ -21,6 +26,7 @@ class NetCDF4SnowMap(object):
         """
         :param filename: A valid netCDF4 filename
         """
+        import netCDF4
         self._ncfile = netCDF4.Dataset(filename, mode='r', format='NETCDF4_CLASSIC')
         for varname in self._REQUIRED_VARS:
             if varname not in self._ncfile.variables.keys():
@@ -29,6 +35,40 @@ class NetCDF4SnowMap(object):
         self._load_data()
 
 
+    @classmethod
+    def get_usable_fraction(cls, filename, stride=4):
+        """
+        Cheap estimate of the fraction of pixels that are neither cloud nor
+        invalid within the internal grid. Only the cloud and invalid flags
+        are read, only inside the grid window and only every stride-th
+        pixel in both directions.
+        :param filename: A valid netCDF4 filename
+        :param int stride: Read every stride-th row and column
+        """
+        import netCDF4
+        grid = get_grid()
+        with netCDF4.Dataset(filename, mode='r') as ncfile:
+            for varname in ('lon', 'lat', 'IDEPIX_CLOUD'):
+                if varname not in ncfile.variables.keys():
+                    raise ValueError("Missing variable {} in netCDF4 {}".format(
+                            varname, filename))
+            lat_data = ncfile.variables['lat'][:].data
+            lon_data = ncfile.variables['lon'][:].data
+            iy = np.where((lat_data >= grid.LOWER_LEFT[1]) &
+                    (lat_data <= grid.UPPER_RIGHT[1]))[0]
+            ix = np.where((lon_data >= grid.LOWER_LEFT[0]) &
+                    (lon_data <= grid.UPPER_RIGHT[0]))[0]
+            if len(iy) == 0 or len(ix) == 0:
+                return 0.0
+            window = (slice(iy.min(), iy.max()+1, stride),
+                    slice(ix.min(), ix.max()+1, stride))
+            # Same thresholds as in _load_data
+            unusable = np.ma.filled(ncfile['IDEPIX_CLOUD'][window] > 1, False)
+            if 'IDEPIX_INVALID' in ncfile.variables.keys():
+                unusable |= np.ma.filled(
+                        ncfile['IDEPIX_INVALID'][window] > 1, False)
+        return 1.0 - float(unusable.mean())
+
     def _load_data(self):
 
         lat_data = self._ncfile.variables['lat'][:].data
@@ -55,7 +95,8 @@ class NetCDF4SnowMap(object):
                 # Loading just the negative mask that is everything we need:
                 # data = ~self._ncfile[key][:,:].mask.T
                 data = self._ncfile[key][:,:] > 1
-            except KeyError:
+            except (KeyError, IndexError):
+                # netCDF4 raises an IndexError for missing variables
                 if key in self._REQUIRED_VARS:
                     raise KeyError("Key {} not in NetCDF".format(key))
                 else:
@@ -65,7 +106,7 @@ class NetCDF4SnowMap(object):
             self._vars[newkey] = data
 
 
-    def get_snowmap(self, transform=True):
+    def get_snowmap(self, transform=True, resampling='nearest'):
         """
         Builds a valid snowmap with the values:
          - {} for a pixel definitively showing snow
@@ -73,7 +114,15 @@ class NetCDF4SnowMap(object):
          - {} for a pixel with uncertainty due to cloud cover or invalid
         
         :param bool transform: Transform the map to internal coordinates
+        :param str resampling: How to transform, one of RESAMPLING_METHODS
         """.format(PIXEL_SNOW, PIXEL_NOSNOW, PIXEL_UNKNOWN)
+        if resampling not in self.RESAMPLING_METHODS:
+            raise ValueError("Unknown resampling method {}".format(resampling))
+        if transform and resampling == 'area':
+            # Every grid cell gets the class covering most of its area
+            classes = np.array([PIXEL_SNOW, PIXEL_NOSNOW, PIXEL_UNKNOWN],
+                    dtype=np.int8)
+            return classes[self.get_fractions().argmax(axis=0)]
 
         # creating a snowmap of right dimensions
         # WATCH OUT: small memory footprint achieved via np.int8 (-128 to 127), since only 3 values need
@@ -99,9 +148,25 @@ class NetCDF4SnowMap(object):
         snowmap[self._vars['snow']] = PIXEL_SNOW
 
         if transform:
-            grid = Grid()
+            grid = get_grid()
             return grid.transform_map_from_grid(snowmap.T,
                     self._vars[self._KEY_LON], self._vars[self._KEY_LAT], fill_value=PIXEL_UNKNOWN).T
         else:
             return snowmap
 
+    def get_fractions(self):
+        """
+        Returns the fractions of snow, no snow and unknown of every cell of
+        the internal grid, as array of shape (3, y, x). Resampling is
+        area-weighted, every source pixel contributes with the area it
+        shares with a cell. Parts of a cell outside of the scene count as
+        unknown, so the fractions add up to 1.
+        """
+        snowmap = self.get_snowmap(transform=False)
+        # One sparse product per class, unknown is the rest
+        snow, nosnow = get_grid().transform_fractions_from_grid(
+                [(snowmap == PIXEL_SNOW).T, (snowmap == PIXEL_NOSNOW).T],
+                self._vars[self._KEY_LON], self._vars[self._KEY_LAT])
+        fractions = np.stack([snow.T, nosnow.T, np.zeros_like(snow.T)])
+        fractions[2] = np.clip(1 - fractions[0] - fractions[1], 0, 1)
+        return fractions
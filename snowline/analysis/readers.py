@@ -0,0 +1,161 @@
+import numpy as np
+from abc import ABCMeta, abstractmethod
+from snowline.analysis.grid import get_grid
+from snowline.analysis.read_NetCDF import NetCDF4SnowMap
+from snowline.analysis.snowmap import PIXEL_SNOW, PIXEL_NOSNOW, PIXEL_UNKNOWN
+
+RESAMPLING_METHODS = NetCDF4SnowMap.RESAMPLING_METHODS
+
+# Registered readers, tried in this order
+_READERS = []
+
+
+def register_reader(reader):
+    """
+    Registers a subclass of SceneReader, can be used as class decorator
+    """
+    if reader not in _READERS:
+        _READERS.append(reader)
+    return reader
+
+
+def get_reader(filename):
+    """
+    Returns the first registered reader that can read filename, raises
+    a ValueError if there is none
+    """
+    for reader in _READERS:
+        if reader.can_read(filename):
+            return reader
+    raise ValueError("No reader for {}".format(filename))
+
+
+def can_read(filename):
+    """
+    Returns True if a registered reader can read filename
+    """
+    return any(reader.can_read(filename) for reader in _READERS)
+
+
+def resample_to_grid(snowmap, lon, lat, resampling='nearest'):
+    """
+    Resamples a map on a rectilinear source grid to the internal grid,
+    with the cached resampling operators of the grid.
+    :param snowmap: The map with the values PIXEL_*, indexed (lat, lon)
+    :param lon: The ascending longitudes of the source columns
+    :param lat: The ascending latitudes of the source rows
+    :param str resampling: One of RESAMPLING_METHODS
+    :returns: The map on the internal grid (int8), unknown outside of
+        the source grid
+    """
+    grid = get_grid()
+    if resampling == 'nearest':
+        return grid.transform_map_from_grid(snowmap.T, lon, lat,
+                fill_value=PIXEL_UNKNOWN).T
+    elif resampling == 'area':
+        snow, nosnow = grid.transform_fractions_from_grid(
+                [(snowmap == PIXEL_SNOW).T, (snowmap == PIXEL_NOSNOW).T],
+                lon, lat)
+        classes = np.array([PIXEL_SNOW, PIXEL_NOSNOW, PIXEL_UNKNOWN],
+                dtype=np.int8)
+        return classes[np.stack([snow, nosnow, 1 - snow - nosnow]
+                ).argmax(axis=0)].T
+    raise ValueError("Unknown resampling method {}".format(resampling))
+
+
+class SceneReader(object, metaclass=ABCMeta):
+    """
+    Reads the scenes of one sensor or file format directly onto the
+    internal grid. Readers are classes with class methods only, such that
+    they can be passed to other processes.
+    Scenes with the same timestamp are applied in order of increasing
+    PRIORITY, the known pixels of the scene with the highest priority
+    win, the other scenes fill its gaps.
+    """
+    NAME = None
+    # Increase whenever a change in reading changes the resulting maps,
+    # invalidates the decoded maps in SceneCache
+    READER_VERSION = 1
+    PRIORITY = 0
+    EXTENSIONS = ()
+
+    @classmethod
+    def can_read(cls, filename):
+        return filename.lower().endswith(cls.EXTENSIONS)
+
+    @classmethod
+    def get_cache_version(cls, resampling):
+        """
+        Returns the reader version for SceneCache.get_key
+        """
+        return '{}-{}-{}'.format(cls.NAME, cls.READER_VERSION, resampling)
+
+    @classmethod
+    def get_usable_fraction(cls, filename, stride=4):
+        """
+        Returns a cheap estimate of the fraction of usable pixels, None if
+        the reader cannot estimate it (the scene is never skipped)
+        """
+        return None
+
+    @classmethod
+    @abstractmethod
+    def read(cls, filename, resampling='nearest'):
+        """
+        Returns the map of a scene on the internal grid, int8 with the
+        values PIXEL_*
+        :param str resampling: One of RESAMPLING_METHODS
+        """
+
+
+@register_reader
+class IdePixReader(SceneReader):
+    """
+    Sentinel-3 OLCI scenes classified with IdePix, as NetCDF
+    """
+    NAME = 'idepix'
+    READER_VERSION = NetCDF4SnowMap.READER_VERSION
+    PRIORITY = 10
+    EXTENSIONS = ('.nc',)
+
+    @classmethod
+    def get_cache_version(cls, resampling):
+        # Nearest keeps the keys of the maps cached before there were
+        # several readers
+        if resampling == 'nearest':
+            return cls.READER_VERSION
+        return '{}-{}'.format(cls.READER_VERSION, resampling)
+
+    @classmethod
+    def get_usable_fraction(cls, filename, stride=4):
+        return NetCDF4SnowMap.get_usable_fraction(filename, stride=stride)
+
+    @classmethod
+    def read(cls, filename, resampling='nearest'):
+        return NetCDF4SnowMap(filename).get_snowmap(transform=True,
+                resampling=resampling)
+
+
+@register_reader
+class GeoTIFFReader(SceneReader):
+    """
+    Classified snow maps as RGBA GeoTIFF (black: no snow, white: snow,
+    transparent: no data), on a regular longitude-latitude raster
+    """
+    NAME = 'geotiff'
+    EXTENSIONS = ('.tif', '.tiff')
+
+    @classmethod
+    def read(cls, filename, resampling='nearest'):
+        from snowline.utils.read_geotiff import load_array, get_coordinates
+        values = load_array(filename)
+        snowmap = np.full(values.shape, PIXEL_UNKNOWN, dtype=np.int8)
+        snowmap[values == 0] = PIXEL_NOSNOW
+        snowmap[values == 1] = PIXEL_SNOW
+        (left, top), _, (right, bottom) = get_coordinates(filename)[[0, 1, 3]]
+        ncols, nrows = snowmap.shape
+        # Centers of the pixels, rows flipped to ascending latitudes
+        lon = left + (np.arange(ncols) + 0.5) * (right - left) / ncols
+        lat = bottom + (np.arange(nrows) + 0.5) * (top - bottom) / nrows
+        return resample_to_grid(snowmap[:, ::-1].T, lon, lat,
+                resampling=resampling)
@@ -0,0 +1,164 @@
+import hashlib, json, os
+import numpy as np
+from snowline.analysis.grid import get_grid
+from snowline.analysis.snowmap import PIXEL_SNOW, PIXEL_NOSNOW, PIXEL_UNKNOWN
+
+# The value classes reported, in this order
+_CLASSES = (('snow', PIXEL_SNOW), ('nosnow', PIXEL_NOSNOW),
+        ('unknown', PIXEL_UNKNOWN))
+
+
+def _get_polygons(geometry):
+    """
+    Returns the list of polygons (each a list of rings) of a GeoJSON
+    Polygon or MultiPolygon geometry
+    """
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    raise ValueError("Geometry {} is not supported".format(geometry['type']))
+
+
+def rasterize_polygons(polygons, grid):
+    """
+    Returns a boolean mask on the grid that is True for grid points
+    inside the polygons. The first ring of every polygon is its outline,
+    further rings are holes.
+    :param polygons: A list of polygons, each a list of rings of (lon, lat)
+    :param grid: An instance of Grid
+    """
+    from matplotlib.path import Path
+    lon, lat = grid.get_coordinates()
+    mask = np.zeros(lon.shape, dtype=bool)
+    for polygon in polygons:
+        for iring, ring in enumerate(polygon):
+            ring = np.asarray(ring, dtype=float)
+            # Only testing points in the bounding box of the ring
+            (xmin, ymin), (xmax, ymax) = ring.min(axis=0), ring.max(axis=0)
+            iy = np.where((lat[:, 0] >= ymin) & (lat[:, 0] <= ymax))[0]
+            ix = np.where((lon[0] >= xmin) & (lon[0] <= xmax))[0]
+            if len(iy) == 0 or len(ix) == 0:
+                continue
+            window = (slice(iy[0], iy[-1]+1), slice(ix[0], ix[-1]+1))
+            points = np.stack([lon[window].ravel(), lat[window].ravel()],
+                    axis=1)
+            inside = Path(ring).contains_points(points).reshape(
+                    lon[window].shape)
+            if iring == 0:
+                mask[window] |= inside
+            else:
+                mask[window] &= ~inside
+    return mask
+
+
+class RegionRaster(object):
+    """
+    Regions (cantons, catchments, elevation bands...) rasterized onto
+    the internal grid as a label raster. Label 0 is outside of all regions,
+    label i is the region names[i-1]. Where regions overlap, the later
+    region wins.
+    """
+    def __init__(self, labels, names):
+        """
+        :param labels: Integer array of the grid shape with the labels
+        :param names: The names of the regions, label i is names[i-1]
+        """
+        labels = np.asarray(labels)
+        if labels.shape != get_grid().zeros().shape:
+            raise ValueError("Labels are not on the internal grid")
+        if labels.min() < 0 or labels.max() > len(names):
+            raise ValueError("Labels do not fit to {} names".format(
+                    len(names)))
+        self._labels = labels.astype(np.int32)
+        self._names = list(names)
+
+    @classmethod
+    def from_geojson(cls, filename, name_property='name', cache_dir=None):
+        """
+        Rasterizes the (Multi)Polygon features of a GeoJSON file in WGS
+        coordinates. Rasterizing is done only once if a cache_dir is given,
+        the label raster is stored there under a key of file content and grid.
+        :param str filename: The GeoJSON file
+        :param str name_property: The feature property used as region name
+        :param str cache_dir: Optional, directory to cache label rasters in
+        """
+        with open(filename, 'rb') as f:
+            content = f.read()
+        grid = get_grid()
+        cache_filename = None
+        if cache_dir is not None:
+            key = hashlib.sha256(content + json.dumps(grid.get_spec(),
+                    sort_keys=True).encode() + name_property.encode())
+            cache_filename = os.path.join(cache_dir,
+                    'regions_{}.npz'.format(key.hexdigest()[:16]))
+            if os.path.isfile(cache_filename):
+                with np.load(cache_filename) as data:
+                    return cls(data['labels'], list(data['names']))
+        geo_dict = json.loads(content.decode())
+        labels = grid.zeros(dtype=np.int32)
+        names = []
+        for feature in geo_dict['features']:
+            names.append(str(feature['properties'][name_property]))
+            mask = rasterize_polygons(_get_polygons(feature['geometry']), grid)
+            labels[mask] = len(names)
+        new = cls(labels, names)
+        if cache_filename is not None:
+            new.save(cache_filename)
+        return new
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['labels'], list(data['names']))
+
+    def save(self, filename):
+        """
+        Saves the label raster to a npz file, written atomically since
+        it is used as a cache shared between processes.
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(directory, exist_ok=True)
+        tmp_filename = filename + '.tmp.npz'
+        np.savez_compressed(tmp_filename, labels=self._labels,
+                names=np.array(self._names))
+        os.replace(tmp_filename, filename)
+
+    def get_labels(self):
+        return self._labels
+
+    def get_names(self):
+        return list(self._names)
+
+    def get_counts(self, snowmap):
+        """
+        Returns an array of shape (3, nregions) with the number of pixels
+        of snow, no snow and unknown per region
+        """
+        if not snowmap._is_internal:
+            raise ValueError("Statistics need a map on the internal grid")
+        array = snowmap._array
+        nlabels = len(self._names) + 1
+        counts = np.array([np.bincount(self._labels[array == value],
+                minlength=nlabels) for _, value in _CLASSES])
+        # Label 0 is outside of all regions
+        return counts[:, 1:]
+
+    def get_statistics(self, snowmap):
+        """
+        Returns a list with a dictionary of pixel counts and areas (km^2)
+        of snow, no snow and unknown for every region.
+        :param snowmap: An instance of SnowMap on the internal grid
+        """
+        counts = self.get_counts(snowmap)
+        pixel_area = (get_grid().GRID_PREC * 1e-3)**2
+        statistics = []
+        for iregion, name in enumerate(self._names):
+            entry = {'region': name}
+            for iclass, (class_name, _) in enumerate(_CLASSES):
+                entry['{}_pixels'.format(class_name)] = int(
+                        counts[iclass, iregion])
+                entry['{}_area'.format(class_name)] = round(
+                        float(counts[iclass, iregion] * pixel_area), 3)
+            statistics.append(entry)
+        return statistics
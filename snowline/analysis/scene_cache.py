@@ -0,0 +1,105 @@
+import hashlib, json, os, tempfile
+import numpy as np
+from snowline.analysis.grid import get_grid
+from snowline.analysis.snowmap import PIXEL_SNOW, PIXEL_NOSNOW
+
+
+class SceneCache(object):
+    """
+    A persistent cache of decoded snowmaps on the internal grid, one file
+    per input file. Entries are keyed by the content hash of the input file,
+    the grid and the version of the reader, so changing any of these never
+    returns a stale map. Maps are stored as two packed bit planes (snow and
+    no snow), 4 times smaller than int8.
+    The least recently used entries are evicted once the cache is larger
+    than max_size bytes.
+    """
+    _SUFFIX = '.scene.npz'
+
+    def __init__(self, directory, max_size=2*1024**3):
+        """
+        :param str directory: The cache directory, created if needed
+        :param int max_size: The maximum size of the cache in bytes
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._max_size = int(max_size)
+
+    @staticmethod
+    def get_key(filename, reader_version):
+        """
+        Returns the key of a decoded map for an input file
+        :param str filename: The input file
+        :param reader_version: The version of the reader decoding filename
+        """
+        key = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                key.update(block)
+        key.update(json.dumps({'grid': get_grid().get_spec(),
+                'reader_version': reader_version}, sort_keys=True).encode())
+        return key.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, key + self._SUFFIX)
+
+    def get(self, key):
+        """
+        Returns the decoded map stored under key as int8 array,
+        None if not in the cache
+        """
+        path = self._get_path(key)
+        try:
+            with np.load(path) as data:
+                shape = tuple(data['shape'])
+                snow = np.unpackbits(data['snow'], count=int(np.prod(shape)))
+                nosnow = np.unpackbits(data['nosnow'],
+                        count=int(np.prod(shape)))
+        except (OSError, KeyError, ValueError):
+            # Missing, or broken by an interrupted write of another process
+            return None
+        # Marking as recently used
+        os.utime(path)
+        array = snow.astype(np.int8) * PIXEL_SNOW + \
+                nosnow.astype(np.int8) * PIXEL_NOSNOW
+        return array.reshape(shape)
+
+    def put(self, key, array):
+        """
+        Stores a decoded map under key and evicts old entries if the cache
+        is too large
+        :param array: An array with values PIXEL_SNOW, PIXEL_NOSNOW,
+            PIXEL_UNKNOWN
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, shape=np.array(array.shape),
+                    snow=np.packbits(array.ravel() == PIXEL_SNOW),
+                    nosnow=np.packbits(array.ravel() == PIXEL_NOSNOW))
+        os.replace(tmp_path, self._get_path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is
+        not larger than max_size
+        """
+        entries = []
+        for filename in os.listdir(self._directory):
+            if not filename.endswith(self._SUFFIX):
+                continue
+            path = os.path.join(self._directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
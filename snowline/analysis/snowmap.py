@@ -1,11 +1,12 @@
 import datetime
-from matplotlib import pyplot as plt
 import numpy as np
 import tarfile, tempfile, json, os
 
-from scipy.ndimage import measurements
-from snowline.analysis.grid import Grid
-from snowline.utils.geo_utils import clean_up_line
+from snowline.analysis.grid import get_grid
+from snowline.analysis.labelling import label_tiled
+from snowline.analysis.events import ChangeSet, ONSET, MELT
+from snowline.utils.boundaries import Boundaries
+from snowline.utils.rle import encode_rle, decode_rle
 
 PIXEL_SNOW = 1
 PIXEL_UNKNOWN = 0
@@ -15,6 +16,9 @@ PIXEL_NOSNOW = -1
 class SnowMap(object):
     _ARRAY_FILENAME = 'array.npy'
     _ATTRIBUTE_FILENAME = 'attributes.json'
+    # Tile size and number of parallel jobs for labelling clusters
+    _LABEL_TILE_SIZE = 1024
+    _LABEL_JOBS = 1
     def __init__(self, array, is_internal=False):
         """
         :param array: the original array, containing values of -1 for no snow, 1 for snow,
@@ -34,14 +38,15 @@ class SnowMap(object):
         self._structure = [[0,1,0], [1,1,1], [0,1,0]]
 
     @classmethod
-    def from_netcdf(cls, filename, transform=True):
+    def from_netcdf(cls, filename, transform=True, resampling='nearest'):
         """
         :param filename: a valid path to a netcdf file
         :param transform: whether to transform to internal coordinates.
+        :param str resampling: nearest or area, see NetCDF4SnowMap.get_snowmap
         """
         from snowline.analysis.read_NetCDF import NetCDF4SnowMap
         netcdf = NetCDF4SnowMap(filename)
-        array = netcdf.get_snowmap(transform=transform)
+        array = netcdf.get_snowmap(transform=transform, resampling=resampling)
         return cls(array=array, is_internal=transform)
     @classmethod
     def load(cls, filename):
@@ -78,16 +83,54 @@ class SnowMap(object):
     def save(self, filename):
         """
         Saves the trajectory instance to tarfile.
+        The file is replaced atomically, an interrupted save leaves the
+        previous file intact.
         :param str filename: The filename. Won't be checked or modified with extension!
         """
+        tmp_filename = filename + '.tmp'
         with tempfile.TemporaryDirectory() as temp_folder:
             np.save(os.path.join(temp_folder, self._ARRAY_FILENAME), self._array)
             with open(os.path.join(temp_folder, self._ATTRIBUTE_FILENAME), 'w') as f:
                 json.dump(self._get_attributes(), f)            
-            with tarfile.open(filename, "w:gz", format=tarfile.PAX_FORMAT) as tar:
+            with tarfile.open(tmp_filename, "w:gz", format=tarfile.PAX_FORMAT) as tar:
                 tar.add(temp_folder, arcname="")
+        os.replace(tmp_filename, filename)
 
     
+    def publish(self, directory):
+        """
+        Writes the array as plain .npy file, next to the attributes, into
+        directory, such that readers (e.g. the query server) can memory-map
+        it. Both files are replaced atomically, the array last.
+        :param str directory: The directory, created if needed
+        """
+        os.makedirs(directory, exist_ok=True)
+        for filename, write in ((self._ATTRIBUTE_FILENAME,
+                    lambda f: f.write(json.dumps(self._get_attributes()).encode())),
+                (self._ARRAY_FILENAME, lambda f: np.save(f, self._array))):
+            path = os.path.join(directory, filename)
+            with open(path + '.tmp', 'wb') as f:
+                write(f)
+            os.replace(path + '.tmp', path)
+
+    def to_rle(self):
+        """
+        Returns the map run-length encoded (see utils.rle), with the
+        attributes in the header. Much smaller than the array for maps
+        with large homogeneous areas.
+        """
+        return encode_rle(self._array, **self._get_attributes())
+
+    @classmethod
+    def from_rle(cls, data):
+        """
+        Creates an instance from bytes written by to_rle
+        """
+        array, header = decode_rle(data)
+        for key in ('version', 'shape', 'runs'):
+            header.pop(key)
+        return cls(array, **header)
+
     def copy(self):
         return self.__class__(array=self._array, **self._get_attributes())
 
@@ -113,18 +156,17 @@ class SnowMap(object):
             msk = (self._array==PIXEL_NOSNOW) | (self._array==PIXEL_UNKNOWN)
         else:
             msk = (self._array==PIXEL_NOSNOW)
-        # Use scipy measurements.label to find clusters.
-        nonsnow_clusters, num_clusters = measurements.label(msk,
-                structure=self._structure)
-        cluster_indices, counts = np.unique(nonsnow_clusters, return_counts=True)
-        msk_nonzero = cluster_indices != 0 # cluster 0 contains no snow, no need to include in count
+        # Label clusters tile by tile, see _label.
+        nonsnow_clusters, num_clusters, counts = self._label(msk)
 
         # remove all cluster that are smaller than limit
-        small_cluster_indices = cluster_indices[counts < limit_nonsnow_patch_size]
+        # cluster 0 contains snow, it is never removed
+        is_small = counts < limit_nonsnow_patch_size
+        is_small[0] = False
         if verbose:
             print('   Reduced nonsnow clusters from {} to {}'.format(
-                    num_clusters, num_clusters - len(small_cluster_indices)))
-        msk = np.isin(nonsnow_clusters, small_cluster_indices)
+                    num_clusters, num_clusters - is_small.sum()))
+        msk = is_small[nonsnow_clusters]
         # msk is now set to True for all clusters that are smmaller limit_snow
         self._array[msk] = PIXEL_SNOW
 
@@ -144,54 +186,86 @@ class SnowMap(object):
             msk = (self._array==PIXEL_SNOW) | (self._array==PIXEL_UNKNOWN)
         else:
             msk = (self._array==PIXEL_SNOW)
-        # Use scipy measurements.label to find clusters.
+        # Label clusters tile by tile, see _label.
         # structure tells it which neighborhood kind to apply.
         # For now Neumann, but maybe this can be an input
-        snow_clusters, num_clusters = measurements.label(msk,
-                        structure=self._structure)
-        cluster_indices, counts = np.unique(snow_clusters, return_counts=True)
-        msk_nonzero = cluster_indices != 0 # cluster 0 contains no snow, no need to include in count
-        small_cluster_indices = cluster_indices[counts < limit_snow_patch_size]
+        snow_clusters, num_clusters, counts = self._label(msk)
+        # cluster 0 contains no snow, it is never removed
+        is_small = counts < limit_snow_patch_size
+        is_small[0] = False
         if verbose:
             print('   Reduced snow clusters from {} to {}'.format(
-                    num_clusters, num_clusters - len(small_cluster_indices)))
-        msk = np.isin(snow_clusters, small_cluster_indices)
+                    num_clusters, num_clusters - is_small.sum()))
+        msk = is_small[snow_clusters]
         self._array[msk] = PIXEL_NOSNOW
 
+    def _label(self, msk):
+        """
+        Finds the clusters of True pixels in msk. Labelling is done tile by
+        tile with the tiles merged by union-find, in parallel, see
+        label_tiled. The labels are kept in memory like the map itself.
+        :returns: labels, num_clusters, and the size of every cluster
+            (index 0 being the pixels outside of clusters)
+        """
+        return label_tiled(msk, structure=self._structure,
+                tile_size=self._LABEL_TILE_SIZE, n_jobs=self._LABEL_JOBS)
+
     def get_num_clusters(self):
-        return measurements.label(self._array==PIXEL_SNOW,
-                structure=self.  _structure)[1]
+        return self._label(self._array==PIXEL_SNOW)[1]
 
-    def get_boundaries(self, transform=False, clean=True):
+    def get_boundaries(self, transform=False, clean=True, smooth=0):
         """
         Get the points around the snow patches
         :param bool transform: transform to WGS coordinates based on internal grid
         :param bool clean: Clean points, which removes all points that
             lie on a straight line between two other points
+        :param int smooth: Smooth the staircase outlines with this many
+            passes of corner cutting on the traced rings, see
+            Boundaries.smooth
+        :returns: An instance of Boundaries with one polygon per snow
+            patch. Iterating over it yields the rings of every patch.
         """
+        # contourpy (used by matplotlib) traces the contours without
+        # drawing them into a global pyplot figure, which would keep every
+        # contour of a long-running process alive
+        from contourpy import contour_generator
+        from scipy.ndimage import find_objects
         # pad 0 around
         array = np.concatenate([np.zeros((1, self._array.shape[1])), self._array, 
                 np.zeros((1, self._array.shape[1]))], axis=0)
         array = np.concatenate([np.zeros((array.shape[0], 1)), array, np.zeros((array.shape[0], 1))], axis=1)
         # TODO option to treat unknown as having snow?
-        snow_clusters, num_clusters = measurements.label(array==PIXEL_SNOW,
-                            structure=self._structure)
-        cluster_indices, counts = np.unique(snow_clusters, return_counts=True)
-        msk_nonzero = cluster_indices != 0 # cluster 0 contains no snow, no need to include in count
-        # TODO use np.kron to augment data and scipy.convolve to smoothen it,
-        # such that the line become much nicer. Is this an issue?
+        snow_clusters, num_clusters, _ = self._label(array==PIXEL_SNOW)
+        # The rings of all clusters are collected in a single buffer, see
+        # Boundaries.
+        rings = []
+        polygon_offsets = [0]
+        # Contours are calculated on the bounding box of every cluster
+        # (+1 pixel, the padding makes sure this is within the array),
+        # not on the full map.
+        for cluster_index, (slice_y, slice_x) in enumerate(
+                find_objects(snow_clusters), start=1):
+            y0, x0 = slice_y.start - 1, slice_x.start - 1
+            window = snow_clusters[y0:slice_y.stop+1, x0:slice_x.stop+1]
+            # Same algorithm as the default of matplotlib's contour
+            contours, _ = contour_generator(z=(window==cluster_index
+                    ).astype(float), name='mpl2014', corner_mask=True,
+                    line_type='SeparateCode').lines(0.5)
+            rings.extend(seg + [x0-1, y0-1] for seg in contours)
+            polygon_offsets.append(len(rings))
+        boundaries = Boundaries(
+                np.concatenate(rings) if rings else np.zeros((0, 2)),
+                np.cumsum([0] + [len(ring) for ring in rings]),
+                polygon_offsets)
+        if clean:
+            boundaries = boundaries.clean()
+        # Smoothing the rings rather than an upsampled map, the cost is
+        # bound by the number of vertices and not by the grid
+        if smooth:
+            boundaries = boundaries.smooth(iterations=smooth)
         if transform:
-            grid = Grid()
-        for cluster_index in cluster_indices[msk_nonzero]:
-            cs  = plt.contour(snow_clusters==cluster_index, levels=(0.5,))
-            boundaries_this_cluster = [(seg-1) for seg in cs.allsegs[0]]
-            if clean:
-                boundaries_this_cluster = [clean_up_line(line)
-                    for line in boundaries_this_cluster]
-            if transform:
-                yield grid.transform_boundary(boundaries_this_cluster)
-            else:
-                yield boundaries_this_cluster
+            boundaries = get_grid().transform_boundaries(boundaries)
+        return boundaries
 
 
 
@@ -205,7 +279,7 @@ class UpdatedSnowMap(SnowMap):
         self._timestamp = kwargs.pop('timestamp', None)
         super().__init__(*args, **kwargs)
 
-    def update(self, other, timestamp=None):
+    def update(self, other, timestamp=None, return_changes=False):
         """
         Will update the internal snowmap given the data in the input snowmap.
         Rules are (pixelwise):
@@ -214,6 +288,8 @@ class UpdatedSnowMap(SnowMap):
           * if new map indicates unknown, do not change
         :param other: a valid snowmap
         :param timestamp: A timestamp of other
+        :param bool return_changes: Return the pixels that flipped between
+            snow and no snow as events.ChangeSet
         """
         # first some checks on the snowmap:
         if not isinstance(other, SnowMap):
@@ -223,13 +299,32 @@ class UpdatedSnowMap(SnowMap):
         if not(other._is_internal) and not(self._is_internal):
             print("WARNING: updating grids that might not be compatible")
         array = other.get_array()
-        self._array[array==PIXEL_SNOW] = PIXEL_SNOW
-        self._array[array == PIXEL_NOSNOW] = PIXEL_NOSNOW
+        is_snow = array == PIXEL_SNOW
+        is_nosnow = array == PIXEL_NOSNOW
+        if return_changes:
+            # Only the flips between snow and no snow, from the masks
+            # used for the update anyway
+            onset = np.flatnonzero(is_snow & (self._array == PIXEL_NOSNOW))
+            melt = np.flatnonzero(is_nosnow & (self._array == PIXEL_SNOW))
+        self._array[is_snow] = PIXEL_SNOW
+        self._array[is_nosnow] = PIXEL_NOSNOW
         self._timestamp = timestamp
+        if return_changes:
+            return ChangeSet(np.concatenate([onset, melt]),
+                    np.repeat(np.array([ONSET, MELT], dtype=np.int8),
+                        [len(onset), len(melt)]),
+                    self._array.shape, timestamp=timestamp)
 
     def get_timestamp(self):
         return self._timestamp
 
+    def set_timestamp(self, timestamp):
+        """
+        Sets the timestamp without changing the map, e.g. for a file that
+        was looked at but not used for an update
+        """
+        self._timestamp = timestamp
+
     def is_newer(self, timestamp):
         """
         Given a timestamp, return True if this timestamp is newer (or if
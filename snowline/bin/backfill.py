@@ -0,0 +1,262 @@
+import os, json, datetime, re
+from snowline.analysis.cube import SnowCube
+from snowline.analysis.scene_cache import SceneCache
+from snowline.analysis.readers import can_read
+from snowline.bin.update_snowmap import SnowMapUpdater
+from snowline.utils.s3_io import SatelliteDB
+from snowline.utils.time_utils import (get_datetime_from_filename,
+        get_timestamp_from_date_string)
+
+CHECKPOINT_FILENAME = 'backfill_checkpoint.json'
+STATE_MAP_FORMAT = 'statemap_{}.tar.gz'
+SNOWLINE_FORMAT = 'snowline_{}.json'
+
+_CADENCES = {'hourly': 3600, 'daily': 86400, 'weekly': 7*86400}
+_CADENCE_UNITS = {'h': 3600, 'd': 86400}
+
+
+def parse_cadence(cadence):
+    """
+    Returns the cadence in seconds.
+    :param str cadence: Either one of 'hourly', 'daily', 'weekly' or
+        a number followed by a unit h (hours) or d (days), e.g. 6h or 2d
+    """
+    if cadence in _CADENCES:
+        return _CADENCES[cadence]
+    match = re.match(r'^(?P<number>\d+)(?P<unit>[hd])$', cadence)
+    if match is None or int(match.group('number')) == 0:
+        raise ValueError("Invalid cadence {}".format(cadence))
+    return int(match.group('number')) * _CADENCE_UNITS[match.group('unit')]
+
+
+def get_local_scenes(directory):
+    """
+    Returns a list of (timestamp, path) for all scenes in directory that
+    can be read, see readers.get_reader
+    """
+    scenes = []
+    for filename in os.listdir(directory):
+        if can_read(filename):
+            timestamp = get_datetime_from_filename(filename).timestamp()
+            scenes.append((timestamp, os.path.join(directory, filename)))
+    return scenes
+
+
+def _format_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y%m%d_%H%M')
+
+
+def _write_checkpoint(filename, checkpoint):
+    # Writing to a temporary file and renaming, a crash while writing
+    # can never leave a broken checkpoint behind
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_filename, filename)
+
+
+def backfill(start_date, end_date, output_dir, cadence='daily',
+        state_map=None, netcdf_dir=None, cache=None,
+        aws_access_key_id=None, aws_secret_access_key=None,
+        size_filter_snow=0, size_filter_nonsnow=0, no_boundaries=False,
+        cube=None, scene_cache=None, scene_cache_size=2048,
+        min_usable_fraction=0, resampling='nearest', restart=False,
+        quiet=False, decode_workers=1, smooth=0):
+    """
+    Rebuilds the state maps and snowlines for a date range in a single
+    ordered pass over the scenes. The range is split into periods of the
+    cadence. At the end of every period (the cadence point), a state map
+    and a snowline file with all scenes before the cadence point are written
+    to output_dir, labelled with the cadence point: for a daily cadence,
+    statemap_20191202_0000 holds the scenes up to the end of Dec 1. A
+    checkpoint is written such that an interrupted backfill resumes at the
+    last cadence point.
+    :param str start_date: First date, format %Y%m%d(T%H%M)
+    :param str end_date: Last date, format %Y%m%d(T%H%M), the range
+        includes the whole day (or minute). The last cadence point is at the
+        end of the range, also if it does not complete a period.
+    :param str output_dir: Directory to write state maps, snowlines and
+        the checkpoint to
+    :param str cadence: The output cadence, see parse_cadence
+    :param str state_map: The state map to start from, if None starts
+        from a blank map
+    :param str netcdf_dir: Local directory containing the netcdf files.
+        If None, files are listed in the satellite bucket and downloaded
+        to cache.
+    :param str cache: Directory to download files to
+    :param bool no_boundaries: Only write state maps, no snowlines
+    :param str cube: Optional, directory of a SnowCube the state map is
+        appended to at every cadence point. Created if it does not exist.
+    :param str scene_cache: Optional, a directory to cache decoded scenes
+        in, such that rerunning a backfill skips decoding
+    :param int scene_cache_size: Maximum size of the scene cache in MB
+    :param float min_usable_fraction: Skip files with a smaller fraction of
+        pixels that are neither cloud nor invalid
+    :param str resampling: How scenes are resampled to the internal grid,
+        nearest or area
+    :param bool restart: Ignore an existing checkpoint and start over
+    :param bool quiet: Quiet run, disable verbosity
+    :param int decode_workers: The number of files decoded in parallel
+    :param int smooth: Passes of corner cutting to smooth the snowlines
+    """
+    verbose = not(quiet)
+    if netcdf_dir is None and cache is None:
+        raise ValueError("You need to provide either a directory with "
+            "netcdf files or a cache for files from the bucket")
+    start_timestamp = get_timestamp_from_date_string(start_date)
+    # The end of the last minute of the range, exclusive
+    end_timestamp = get_timestamp_from_date_string(end_date,
+            completion='T2359') + 60
+    if end_timestamp <= start_timestamp:
+        raise ValueError("end_date is before start_date")
+    step = parse_cadence(cadence)
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint_filename = os.path.join(output_dir, CHECKPOINT_FILENAME)
+
+    last_done = None
+    if os.path.isfile(checkpoint_filename) and not restart:
+        with open(checkpoint_filename) as f:
+            checkpoint = json.load(f)
+        if (checkpoint['start'] != start_timestamp or
+                checkpoint['step'] != step):
+            raise ValueError("Checkpoint in {} belongs to a different "
+                "backfill, use restart to start over".format(output_dir))
+        last_done = checkpoint['last_done']
+        state_map = os.path.join(output_dir, checkpoint['state_map'])
+        if verbose:
+            print("Resuming backfill after {}".format(
+                    _format_timestamp(last_done)))
+
+    # Scenes before start_date that are newer than the initial state map
+    # are applied before the first output.
+    if scene_cache is not None:
+        scene_cache = SceneCache(scene_cache,
+                max_size=scene_cache_size*1024**2)
+    smu = SnowMapUpdater(update_map_path=state_map,
+            allow_blank=last_done is None, verbose=verbose,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            scene_cache=scene_cache,
+            min_usable_fraction=min_usable_fraction, resampling=resampling,
+            decode_workers=decode_workers)
+
+    # Listing the scenes only once for the whole backfill
+    if netcdf_dir is not None:
+        scenes = get_local_scenes(netcdf_dir)
+        satellite = None
+    else:
+        satellite = SatelliteDB(aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key)
+        scenes = [(get_datetime_from_filename(filename).timestamp(),
+                filename) for filename in satellite.get_files()
+                if can_read(filename)]
+    if last_done is not None:
+        # Scenes at the last cadence point belong to the following period
+        scenes = [(timestamp, path) for timestamp, path in scenes
+                if timestamp >= last_done]
+    elif smu.get_timestamp() is not None:
+        scenes = [(timestamp, path) for timestamp, path in scenes
+                if timestamp > smu.get_timestamp()]
+    scenes = sorted((timestamp, path) for timestamp, path in scenes
+            if timestamp < end_timestamp)
+    if verbose:
+        print("{} scenes to process".format(len(scenes)))
+
+    if cube is not None:
+        try:
+            snowcube = SnowCube(cube)
+        except OSError:
+            snowcube = SnowCube.create(cube, smu.get_state_map().get_array().shape)
+        cube_timestamps = snowcube.get_timestamps()
+
+    # Cadence points are at the end of the periods, the last one is cut
+    # at the end of the range
+    iperiod = 1
+    if last_done is not None:
+        iperiod = int((last_done - start_timestamp) // step) + 1
+    iscene = 0
+    while last_done is None or last_done < end_timestamp:
+        cadence_point = min(start_timestamp + iperiod*step, end_timestamp)
+        paths = []
+        while iscene < len(scenes) and scenes[iscene][0] < cadence_point:
+            paths.append(scenes[iscene][1])
+            iscene += 1
+        if satellite is not None and paths:
+            satellite.download_files(paths, cache, overwrite=False)
+            paths = [os.path.join(cache, path) for path in paths]
+        if paths:
+            smu.set_netcdf_files(*paths)
+            smu.update()
+        label = _format_timestamp(cadence_point)
+        state_map_filename = STATE_MAP_FORMAT.format(label)
+        smu.save(os.path.join(output_dir, state_map_filename))
+        if cube is not None and not (len(cube_timestamps) and
+                cube_timestamps[-1] >= cadence_point):
+            # The cube can be ahead of the checkpoint if the backfill was
+            # interrupted right after appending
+            snowcube.append(smu.get_state_map(), cadence_point)
+        if not no_boundaries:
+            smu.calculate_boundaries(size_filter_snow=size_filter_snow,
+                    size_filter_nonsnow=size_filter_nonsnow,
+                    allow_upload_without_update=True, smooth=smooth)
+            smu.write_boundaries(os.path.join(output_dir,
+                    SNOWLINE_FORMAT.format(label)))
+        _write_checkpoint(checkpoint_filename, {'start': start_timestamp,
+                'step': step, 'last_done': cadence_point,
+                'state_map': state_map_filename})
+        last_done = cadence_point
+        iperiod += 1
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Rebuilds state maps and snowlines'
+            ' for a range of dates')
+    parser.add_argument('start_date', help='First date, format '
+            'YYYYmmdd(THHMM)')
+    parser.add_argument('end_date', help='Last date, format '
+            'YYYYmmdd(THHMM)')
+    parser.add_argument('-o', '--output-dir', required=True,
+            help='Directory for state maps, snowlines and the checkpoint')
+    parser.add_argument('--cadence', default='daily', help='Output cadence'
+            ', hourly, daily, weekly or e.g. 6h, 2d')
+    parser.add_argument('-s', '--state-map', help=('The path to the'
+            ' state map to start from, otherwise starts from a blank map'))
+    parser.add_argument('--netcdf-dir', help='A local directory with the '
+            'NetCDF files. If not given, will query on AWS and download')
+    parser.add_argument('-c', '--cache', help='A valid path to an existing '
+            'directory that will be used as cache for netcdf files. '
+            'Only needed if the option --netcdf-dir is not provided')
+    parser.add_argument('--size-filter-snow', type=int, default=0,
+            help='Remove clusters of snow below this pixel size')
+    parser.add_argument('--size-filter-nonsnow', type=int, default=0,
+            help='Remove clusters of no snow with snow fields '
+                    'below this pixel size')
+    parser.add_argument('--smooth', type=int, default=0,
+            help='Smooth the snowlines with this many passes of corner '
+                'cutting')
+    parser.add_argument('--no-boundaries', action='store_true',
+            help='Only write state maps')
+    parser.add_argument('--cube', help='Directory of a time series cube '
+            'the state maps are appended to')
+    parser.add_argument('--scene-cache', help='A directory to cache '
+            'decoded scenes in, reprocessing cached scenes skips decoding')
+    parser.add_argument('--scene-cache-size', type=int, default=2048,
+            help='Maximum size of the scene cache in MB')
+    parser.add_argument('--min-usable-fraction', type=float, default=0,
+            help='Skip NetCDF files with a smaller fraction of pixels that '
+                'are neither cloud nor invalid, e.g. 0.05')
+    parser.add_argument('--resampling', choices=('nearest', 'area'),
+            default='nearest', help='How scenes are resampled to the grid')
+    parser.add_argument('--decode-workers', type=int, default=1,
+            help='The number of files decoded in parallel')
+    parser.add_argument('--restart', action='store_true',
+            help='Ignore an existing checkpoint and start over')
+    parser.add_argument('-q', '--quiet', action='store_true',
+            help='Perform a quiet run (no verbose output)')
+    parser.add_argument('--aws-access-key-id', help="Access key id for"
+            "download, othewise will be read in ~/.aws by boto3")
+    parser.add_argument('--aws-secret-access-key', help="Access key for"
+            "download, othewise will be read in ~/.aws by boto3")
+    parsed = parser.parse_args()
+    backfill(**vars(parsed))
@@ -0,0 +1,84 @@
+import subprocess, sys
+
+# Budgets in seconds for importing a module in a fresh interpreter.
+# Short invocations (inspecting a state map, local updates) should
+# start well under a second, so keep these tight.
+IMPORT_BUDGETS = {
+    'snowline.analysis.snowmap': 0.3,
+    'snowline.utils.s3_io': 0.3,
+    'snowline.bin.update_snowmap': 0.4,
+}
+# Heavy dependencies that must only be loaded on the code paths using them
+LAZY_MODULES = ('matplotlib', 'scipy', 'netCDF4', 'boto3', 'PIL')
+
+
+def get_import_time(module, repeat=3):
+    """
+    Imports module in a fresh interpreter with python -X importtime and
+    returns the cumulative import time in seconds (best of repeat runs).
+    """
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-X', 'importtime',
+                '-c', 'import {}'.format(module)],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True, check=True)
+        for line in proc.stderr.splitlines():
+            # Format is: import time: self [us] | cumulative | imported package
+            fields = line.split('|')
+            if len(fields) != 3 or fields[2].strip() != module:
+                continue
+            cumulative = int(fields[1]) * 1e-6
+            if best is None or cumulative < best:
+                best = cumulative
+    if best is None:
+        raise RuntimeError("Could not find import time of {}".format(module))
+    return best
+
+
+def get_loaded_lazy_modules(module):
+    """
+    Imports module in a fresh interpreter and returns the heavy
+    dependencies (LAZY_MODULES) that were loaded as a side effect.
+    """
+    code = ('import sys, {module}; print(" ".join(m for m in {lazy} '
+            'if m in sys.modules))').format(module=module, lazy=LAZY_MODULES)
+    proc = subprocess.run([sys.executable, '-c', code],
+            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return proc.stdout.split()
+
+
+def check_import_time(budgets=IMPORT_BUDGETS, verbose=True):
+    """
+    Checks all modules in budgets against their import time budget and
+    against loading heavy dependencies eagerly.
+    :returns: A list of strings describing the regressions, empty if none
+    """
+    regressions = []
+    for module, budget in sorted(budgets.items()):
+        import_time = get_import_time(module)
+        loaded = get_loaded_lazy_modules(module)
+        if verbose:
+            print("{:<30} {:.3f}s (budget {:.3f}s)".format(
+                    module, import_time, budget))
+        if import_time > budget:
+            regressions.append("{} takes {:.3f}s to import, budget is "
+                    "{:.3f}s".format(module, import_time, budget))
+        if loaded:
+            regressions.append("{} loads {} at import".format(
+                    module, ', '.join(loaded)))
+    return regressions
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Checks the import time of the '
+            'snowline modules against a budget')
+    parser.add_argument('-s', '--scale', type=float, default=1.0,
+            help='Scale all budgets by this factor, e.g. for slow machines')
+    parsed = parser.parse_args()
+    regressions = check_import_time({module: budget*parsed.scale
+            for module, budget in IMPORT_BUDGETS.items()})
+    for regression in regressions:
+        print("REGRESSION: {}".format(regression))
+    sys.exit(1 if regressions else 0)
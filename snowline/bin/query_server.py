@@ -0,0 +1,313 @@
+import asyncio, json, os, traceback
+import numpy as np
+from urllib.parse import urlsplit, parse_qs
+from snowline.analysis.cube import SnowCube
+from snowline.analysis.events import EventLog
+from snowline.analysis.grid import get_grid
+from snowline.analysis.snowmap import (SnowMap, PIXEL_SNOW, PIXEL_NOSNOW,
+        PIXEL_UNKNOWN)
+from snowline.utils.time_utils import get_timestamp_from_date_string
+
+
+class QueryError(Exception):
+    pass
+
+
+class SnowQueryService(object):
+    """
+    Answers point and bounding box queries on the current state map
+    (published with SnowMap.publish) and on historical maps (a SnowCube).
+    Maps are memory-mapped, and reloaded when the files change.
+    """
+    def __init__(self, state_dir=None, cube_dir=None, event_log=None):
+        """
+        :param str state_dir: Directory the updater publishes the current
+            state map to
+        :param str cube_dir: Optional, directory of a SnowCube with
+            historical maps
+        :param str event_log: Optional, the event log the updater appends
+            snow onset and melt events to
+        """
+        if state_dir is None and cube_dir is None and event_log is None:
+            raise ValueError("Need at least a state map, a cube or "
+                "an event log")
+        self._event_log = None if event_log is None else EventLog(event_log,
+                retention=None)
+        self._state_dir = state_dir
+        self._cube_dir = cube_dir
+        self._grid = get_grid()
+        self._array = None
+        self._timestamp = None
+        self._cube = None
+        self._mtimes = {}
+        self.reload()
+
+    def _has_changed(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return False
+        if self._mtimes.get(path) == mtime:
+            return False
+        self._mtimes[path] = mtime
+        return True
+
+    def reload(self):
+        """
+        Reloads the state map and the cube if their files have changed
+        :returns: True if anything was reloaded
+        """
+        reloaded = False
+        if self._state_dir is not None:
+            array_path = os.path.join(self._state_dir, SnowMap._ARRAY_FILENAME)
+            if self._has_changed(array_path):
+                with open(os.path.join(self._state_dir,
+                        SnowMap._ATTRIBUTE_FILENAME)) as f:
+                    attributes = json.load(f)
+                # The file is replaced atomically on publish, the mapping
+                # keeps the old file alive as long as it is used.
+                self._array = np.load(array_path, mmap_mode='r')
+                self._timestamp = attributes.get('timestamp')
+                reloaded = True
+        if self._cube_dir is not None:
+            if self._has_changed(os.path.join(self._cube_dir,
+                    SnowCube._METADATA_FILENAME)):
+                self._cube = SnowCube(self._cube_dir)
+                reloaded = True
+        return reloaded
+
+    def _use_current(self, timestamp):
+        """
+        Whether a query for timestamp is answered by the current state map
+        """
+        if self._array is None:
+            return False
+        return (timestamp is None or self._timestamp is None or
+                timestamp >= self._timestamp)
+
+    def _get_time_index(self, timestamp):
+        if self._cube is None:
+            raise QueryError("No historical maps available")
+        time_index = self._cube.get_time_index(timestamp)
+        if time_index < 0:
+            raise QueryError("No map available at this date")
+        return time_index
+
+    def query_points(self, lon, lat, timestamp=None):
+        """
+        Returns the values of the maps at the WGS coordinates, None
+        outside of the grid.
+        :param lon: Array of longitudes
+        :param lat: Array of latitudes
+        :param timestamp: Optional, query the last map at or before this
+            timestamp instead of the current one
+        """
+        iy, ix = self._grid.get_indices(lon, lat)
+        inside = iy >= 0
+        values = np.zeros(iy.shape, dtype=np.int8)
+        if self._use_current(timestamp):
+            values[inside] = self._array[iy[inside], ix[inside]]
+            map_timestamp = self._timestamp
+        else:
+            time_index = self._get_time_index(timestamp)
+            values[inside] = self._cube.get_values(iy[inside], ix[inside],
+                    time_index)
+            map_timestamp = float(self._cube.get_timestamps()[time_index])
+        return {'values': [int(value) if is_inside else None
+                    for value, is_inside in zip(values, inside)],
+                'timestamp': map_timestamp}
+
+    def query_bbox(self, bbox, timestamp=None):
+        """
+        Returns the number of pixels with snow, no snow and unknown in a
+        bounding box.
+        :param bbox: (minlon, minlat, maxlon, maxlat)
+        :param timestamp: Optional, query the last map at or before this
+            timestamp instead of the current one
+        """
+        shape = self._grid.zeros().shape
+        lower_left = np.array(self._grid.LOWER_LEFT)
+        span = np.array(self._grid.UPPER_RIGHT) - lower_left
+        # Indices of the grid points inside bbox, clipped to the grid
+        ix0, iy0 = np.ceil((np.array(bbox[:2]) - lower_left) / span *
+                (np.array(shape[::-1]) - 1)).astype(int)
+        ix1, iy1 = np.floor((np.array(bbox[2:]) - lower_left) / span *
+                (np.array(shape[::-1]) - 1)).astype(int)
+        ys = slice(max(iy0, 0), max(min(iy1 + 1, shape[0]), 0))
+        xs = slice(max(ix0, 0), max(min(ix1 + 1, shape[1]), 0))
+        if self._use_current(timestamp):
+            region = np.asarray(self._array[ys, xs])
+            map_timestamp = self._timestamp
+        else:
+            time_index = self._get_time_index(timestamp)
+            map_timestamp = float(self._cube.get_timestamps()[time_index])
+            region = self._cube.get_region_series(ys, xs,
+                    start=map_timestamp, stop=map_timestamp)[0]
+        return {'snow': int((region == PIXEL_SNOW).sum()),
+                'nosnow': int((region == PIXEL_NOSNOW).sum()),
+                'unknown': int((region == PIXEL_UNKNOWN).sum()),
+                'timestamp': map_timestamp}
+
+    def get_status(self):
+        """
+        Returns the timestamp of the current map and the timestamps of
+        the first and last historical map
+        """
+        history = []
+        if self._cube is not None and self._cube.get_shape()[0]:
+            timestamps = self._cube.get_timestamps()
+            history = [float(timestamps[0]), float(timestamps[-1])]
+        return {'timestamp': self._timestamp, 'history': history}
+
+    def handle(self, method, target, body=b''):
+        """
+        Handles a request, returns (status code, JSON-serializable dict).
+          GET /point?lon=&lat=[&date=]
+          POST /points, body {"points": [[lon, lat], ...], "date": ...}
+          GET /bbox?minlon=&minlat=&maxlon=&maxlat=[&date=]
+          GET /events[?since=][&bbox=minlon,minlat,maxlon,maxlat]
+          GET /status
+        Dates have the format %Y%m%d(T%H%M), a date without time refers
+        to the end of the day.
+        """
+        url = urlsplit(target)
+        params = {key: values[-1] for key, values in
+                parse_qs(url.query).items()}
+        try:
+            if method == 'POST' and url.path == '/points':
+                params = json.loads(body.decode() or '{}')
+                if not isinstance(params, dict):
+                    raise ValueError("The body has to be a JSON object")
+            timestamp = None
+            if params.get('date'):
+                timestamp = get_timestamp_from_date_string(
+                        str(params['date']), completion='T2359')
+            if method == 'GET' and url.path == '/point':
+                result = self.query_points([float(params['lon'])],
+                        [float(params['lat'])], timestamp=timestamp)
+                return 200, {'value': result['values'][0],
+                        'timestamp': result['timestamp']}
+            elif method == 'POST' and url.path == '/points':
+                points = np.array(params['points'], dtype=float).reshape(-1, 2)
+                return 200, self.query_points(points[:, 0], points[:, 1],
+                        timestamp=timestamp)
+            elif method == 'GET' and url.path == '/bbox':
+                return 200, self.query_bbox([float(params[key]) for key in
+                        ('minlon', 'minlat', 'maxlon', 'maxlat')],
+                        timestamp=timestamp)
+            elif (method == 'GET' and url.path == '/events' and
+                    self._event_log is not None):
+                since = None
+                if params.get('since'):
+                    since = get_timestamp_from_date_string(params['since'])
+                bbox = None
+                if params.get('bbox'):
+                    bbox = [float(value) for value in params['bbox'].split(',')]
+                    if len(bbox) != 4:
+                        raise ValueError("bbox needs 4 values")
+                return 200, {'events': self._event_log.get_events(
+                        since=since, bbox=bbox)}
+            elif method == 'GET' and url.path == '/status':
+                return 200, self.get_status()
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            return 400, {'error': 'Invalid request: {}'.format(e)}
+        except QueryError as e:
+            return 404, {'error': str(e)}
+        return 404, {'error': 'Unknown endpoint {} {}'.format(
+                method, url.path)}
+
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found'}
+
+
+async def _handle_connection(service, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, version = request_line.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(
+                    int(headers.get('content-length', 0)))
+            status, result = service.handle(method, target, body)
+            payload = json.dumps(result).encode()
+            keep_alive = (version == 'HTTP/1.1' and
+                    headers.get('connection', '').lower() != 'close')
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                    'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                        status, _REASONS[status], len(payload),
+                        'keep-alive' if keep_alive else 'close').encode() +
+                    payload)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _reload_periodically(service, reload_interval):
+    while True:
+        await asyncio.sleep(reload_interval)
+        # E.g. a map being published right now, tried again next time
+        try:
+            service.reload()
+        except Exception:
+            print("Reloading failed, retrying:")
+            traceback.print_exc()
+
+
+async def serve(service, host='127.0.0.1', port=8080, reload_interval=1.0,
+        ready=None):
+    """
+    Serves queries over HTTP until cancelled
+    :param service: An instance of SnowQueryService
+    :param int port: The port to listen on, 0 lets the OS choose one
+    :param float reload_interval: Seconds between checks for new maps
+    :param ready: Optional, an asyncio.Future that is set to the port
+        once the server listens
+    """
+    server = await asyncio.start_server(
+            lambda reader, writer: _handle_connection(service, reader, writer),
+            host, port)
+    if ready is not None:
+        ready.set_result(server.sockets[0].getsockname()[1])
+    reload_task = asyncio.ensure_future(
+            _reload_periodically(service, reload_interval))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        reload_task.cancel()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Serves point and bounding box '
+            'queries on the current and historical state maps')
+    parser.add_argument('--state-dir', help='The directory the updater '
+            'publishes the current state map to (--publish-dir)')
+    parser.add_argument('--cube', help='Directory of a time series cube '
+            'with historical maps')
+    parser.add_argument('--event-log', help='The event log of the updater '
+            '(--event-log), served at /events')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('--reload-interval', type=float, default=1.0,
+            help='Seconds between checks for new maps')
+    parsed = parser.parse_args()
+    service = SnowQueryService(state_dir=parsed.state_dir,
+            cube_dir=parsed.cube, event_log=parsed.event_log)
+    try:
+        asyncio.run(serve(service, host=parsed.host, port=parsed.port,
+                reload_interval=parsed.reload_interval))
+    except KeyboardInterrupt:
+        pass
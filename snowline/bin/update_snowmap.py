@@ -1,20 +1,78 @@
 
 
-import numpy as np, os
-import datetime
+import numpy as np, os, json
+import time, queue, threading, collections, traceback
+from concurrent.futures import ThreadPoolExecutor
 from snowline.analysis.snowmap import SnowMap, UpdatedSnowMap
-from snowline.analysis.grid import Grid
-from snowline.utils.time_utils import get_datetime_from_filename
+from snowline.analysis.grid import get_grid
+from snowline.analysis.regions import RegionRaster
+from snowline.analysis.dem import ElevationModel
+from snowline.analysis.readers import (get_reader, can_read,
+        RESAMPLING_METHODS)
+from snowline.analysis.scene_cache import SceneCache
+from snowline.analysis.events import EventLog
+from snowline.utils.time_utils import (get_datetime_from_filename,
+        get_timestamp_from_date_string)
 from snowline.utils.s3_io import SnowlineDB, SatelliteDB, boundaries_to_geo
+from snowline.utils.storage import LocalStorage
 
 
 class UploadWithoutUpdateError(Exception):
     pass
 
+class _DecodeFailure(object):
+    """
+    Passed on in the pipeline instead of the snowmap of a file that could
+    not be decoded
+    """
+    def __init__(self, error):
+        self.error = error
+
+class _SkippedFile(object):
+    """
+    Passed on in the pipeline instead of the snowmap of a file skipped for
+    too few usable pixels
+    """
+    def __init__(self, fraction):
+        self.fraction = fraction
+
 class SnowMapUpdater(object):
     def __init__(self, update_map_path=None, allow_blank=True,
             aws_access_key_id=None, aws_secret_access_key=None,
-            verbose=True):
+            verbose=True, scene_cache=None, min_usable_fraction=0,
+            triage_stride=4, resampling='nearest', satellite_dir=None,
+            database_dir=None, event_log=None, min_event_pixels=1,
+            decode_workers=1, max_decode_attempts=3):
+        """
+        :param str update_map_path: The path to the state map to update
+        :param bool allow_blank: Start from a blank map if the state map
+            cannot be read
+        :param scene_cache: Optional, an instance of SceneCache. Files
+            found in the cache are not decoded again.
+        :param float min_usable_fraction: Files with a smaller fraction of
+            pixels free of cloud and invalid flags are skipped without
+            being decoded, see SceneReader.get_usable_fraction
+        :param int triage_stride: The stride for estimating the usable
+            fraction
+        :param str resampling: How scenes are resampled to the internal
+            grid, nearest or area, see readers.resample_to_grid
+        :param str satellite_dir: Optional, a local directory used instead
+            of the satellite bucket
+        :param str database_dir: Optional, a local directory used instead
+            of the database and snowline buckets
+        :param event_log: Optional, an instance of EventLog. The pixels
+            flipping between snow and no snow in every file are clustered
+            into events and appended to it.
+        :param int min_event_pixels: Smaller events are not logged
+        :param int decode_workers: The number of files decoded at once.
+            With more than one, files are read in as many worker
+            processes. Files are applied in the same order regardless.
+        :param int max_decode_attempts: A file that fails to decode in
+            this many updates is dropped, such that it does not block
+            the files after it, and recorded in the metrics
+        """
+        if resampling not in RESAMPLING_METHODS:
+            raise ValueError("Unknown resampling method {}".format(resampling))
         self._aws_dict = dict(aws_access_key_id=aws_access_key_id,
                 aws_secret_access_key=aws_secret_access_key)
 
@@ -32,15 +90,45 @@ class SnowMapUpdater(object):
             if allow_blank:
                 if self._verbose:
                     print("Failed, initializing with zeros")
-                grid = Grid()
-                self._usm = UpdatedSnowMap(array=Grid().zeros(), is_internal=True)
+                self._usm = UpdatedSnowMap(array=get_grid().zeros(),
+                        is_internal=True)
             else:
                 if self._verbose:
                     print("Received exception: {}".format(e))
                 raise e
         self._netcdf_file_list = []
+        # Size and modification time of files seen in a watched directory
+        self._file_signatures = {}
         self._updated = False
         self._boundaries = None
+        self._statistics = None
+        # Kept between calls, such that a long-running updater reuses
+        # the S3 connections instead of building new ones every poll.
+        self._satellite = None
+        self._snowlinedb = None
+        # Files selected by get_netcdf_files, downloaded during update
+        self._remote_files = {}
+        # Files of the local satellite directory used in place, these are
+        # the source data and never deleted
+        self._in_place_files = set()
+        self._metrics = {}
+        self._scene_cache = scene_cache
+        self._min_usable_fraction = min_usable_fraction
+        self._triage_stride = triage_stride
+        self._resampling = resampling
+        # Local directories replacing the buckets, to run offline
+        self._satellite_dir = satellite_dir
+        self._database_dir = database_dir
+        self._event_log = event_log
+        self._min_event_pixels = min_event_pixels
+        self._decode_workers = max(int(decode_workers), 1)
+        self._max_decode_attempts = max_decode_attempts
+        # Failed decodes per file, over all updates
+        self._decode_failures = collections.Counter()
+        # Created on first use and kept, like the S3 connections
+        self._decode_pool = None
+        # Decoding threads share the metrics and the decode pool
+        self._lock = threading.Lock()
 
     def set_netcdf_files(self, *args):
         """
@@ -48,47 +136,111 @@ class SnowMapUpdater(object):
         those, regardless of timestamp etc.
         """
         for netcdf_file_path in args:
-            if not netcdf_file_path.endswith('.nc'):
+            if not can_read(netcdf_file_path):
                 raise ValueError("{} has wrong ending".format(netcdf_file_path))
             if not os.path.exists(netcdf_file_path):
                 raise OSError("{} does not exist".format(netcdf_file_path))
             dt = get_datetime_from_filename(netcdf_file_path) # get_datetime_from_filename returns datetime
             self._netcdf_file_list.append((dt.timestamp(), netcdf_file_path))
 
+    def find_local_netcdf_files(self, directory, stable_only=False):
+        """
+        Searches a local directory for files that can be read (see
+        readers.get_reader) and that are newer than
+        the state map and that are not yet queued for the next update.
+        :param str directory: The directory to search (not recursive)
+        :param bool stable_only: Only queue files with the same size and
+            modification time as in the previous call, such that files that
+            are still being written are only queued once they are complete
+        :returns: The number of files that were added
+        """
+        if not os.path.isdir(directory):
+            raise OSError("{} is not a directory".format(directory))
+        queued = set(path for _, path in self._netcdf_file_list)
+        nfiles_added = 0
+        for filename in sorted(os.listdir(directory)):
+            if not can_read(filename):
+                continue
+            netcdf_file_path = os.path.join(directory, filename)
+            if netcdf_file_path in queued:
+                continue
+            try:
+                timestamp = get_datetime_from_filename(filename).timestamp()
+            except ValueError:
+                if self._verbose:
+                    print("Ignoring {}, no timestamp in name".format(filename))
+                continue
+            if not self._usm.is_newer(timestamp):
+                continue
+            if stable_only:
+                try:
+                    stat = os.stat(netcdf_file_path)
+                except OSError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if self._file_signatures.get(netcdf_file_path) != signature:
+                    self._file_signatures[netcdf_file_path] = signature
+                    continue
+                del self._file_signatures[netcdf_file_path]
+            self._netcdf_file_list.append((timestamp, netcdf_file_path))
+            nfiles_added += 1
+        return nfiles_added
+
+    def has_been_updated(self):
+        """
+        Returns True if the state map has been updated since the last upload
+        """
+        return self._updated
+
+    def has_new_files(self):
+        """
+        Returns True if there are netcdf files waiting for the next update
+        """
+        return bool(self._netcdf_file_list)
+
+    def _get_satellite(self, sattelite_bucketname):
+        if (self._satellite is None or
+                self._satellite._dbbucketname != sattelite_bucketname):
+            storage = None
+            if self._satellite_dir is not None:
+                storage = LocalStorage(self._satellite_dir)
+            self._satellite = SatelliteDB(dbbucketname=sattelite_bucketname,
+                    storage=storage, **self._aws_dict)
+        return self._satellite
+
     def get_netcdf_files(self, cache, max_date_string=None,
                 sattelite_bucketname='snowlines-satellite'):
         """
         Searches the S3 for files and selects the ones that should be used,
-        based on the timestamp. Downloads these to the cache if not
-        already present.
+        based on the timestamp. These are downloaded to the cache during
+        update, if not already present. Files in a local satellite
+        directory are used in place if cache is None.
         :param str max_date_string: The date string (almost same start of format as
                 in netcdf file name %Y%m%dT%H%M) as in 20121217T2158
         """
-        def complete(string, mustlen, completion):
-            """
-            Utility function, completes given string with completion string
-            """
-            return string + completion[len(string)-mustlen:]
-        if not os.path.isdir(cache):
+        in_place = cache is None and self._satellite_dir is not None
+        if not in_place and not os.path.isdir(str(cache)):
             raise OSError("Cache ({}) is not a directory".format(cache))
         if self._verbose:
             print("Seaching in {} for files".format(sattelite_bucketname))
         if max_date_string is not None:
             # Complete with hours and minutes if not given by lazy users
-            max_date_string = complete(max_date_string, 13, 'T2359')
-            max_timestamp = datetime.datetime.strptime(
-                        max_date_string, '%Y%m%dT%H%M').timestamp()
+            max_timestamp = get_timestamp_from_date_string(
+                        max_date_string, completion='T2359')
         else:
             max_timestamp = None
-        satellite = SatelliteDB(dbbucketname=sattelite_bucketname,
-                **self._aws_dict)
+        satellite = self._get_satellite(sattelite_bucketname)
         files_in_bucket = satellite.get_files()
 
         chosen_files = []
         nfiles_too_old = 0
         nfiles_too_new = 0
-        
+        queued = set(os.path.basename(path)
+                for _, path in self._netcdf_file_list)
+
         for netcdf_file in files_in_bucket:
+            if netcdf_file in queued or not can_read(netcdf_file):
+                continue
             timestamp = get_datetime_from_filename(netcdf_file).timestamp()
             use_file = True
             if max_timestamp is not None and timestamp > max_timestamp:
@@ -105,59 +257,398 @@ class SnowMapUpdater(object):
                 " timestamp".format(len(files_in_bucket), len(chosen_files)))
             print("{} files are too old\n{} files are too new".format(
                 nfiles_too_old, nfiles_too_new))
-        if not chosen_files:
-            # No files chosen means no download to be done
+        # Files are not downloaded here but in update, while the previous
+        # files are decoded and applied.
+        for timestamp, filename in chosen_files:
+            if in_place:
+                netcdf_file_path = os.path.join(self._satellite_dir, filename)
+                self._in_place_files.add(netcdf_file_path)
+            else:
+                netcdf_file_path = os.path.join(cache, filename)
+                self._remote_files[netcdf_file_path] = (satellite, filename)
+            self._netcdf_file_list.append((timestamp, netcdf_file_path))
+
+    def _download(self, netcdf_file_path):
+        """
+        Downloads a file selected by get_netcdf_files, if needed
+        """
+        if netcdf_file_path not in self._remote_files:
             return
-        # Satellite instance downloads files here.
+        satellite, filename = self._remote_files[netcdf_file_path]
         # Will raise some boto3 error if htis fails, which should be
         # caught TODO
-        satellite.download_files(list(zip(*chosen_files))[1], cache,
-                overwrite=False)
-        for timestamp, filename in chosen_files:
-            self._netcdf_file_list.append((timestamp,
-                    os.path.join(cache, filename)))
+        satellite.download_files([filename],
+                os.path.dirname(netcdf_file_path), overwrite=False)
+        # Only forgotten once downloaded, a failed download is retried
+        # by the next update
+        del self._remote_files[netcdf_file_path]
+
+    def _call(self, function, *args, **kwargs):
+        """
+        Calls function, in a worker process if files are decoded in parallel
+        """
+        if self._decode_workers == 1:
+            return function(*args, **kwargs)
+        with self._lock:
+            if self._decode_pool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # Not forking the threads of the pipeline
+                self._decode_pool = ProcessPoolExecutor(
+                        max_workers=self._decode_workers,
+                        mp_context=multiprocessing.get_context('spawn'))
+        return self._decode_pool.submit(function, *args, **kwargs).result()
+
+    def _triage(self, netcdf_file_path):
+        """
+        Returns the usable fraction if the file has too few usable pixels
+        to be decoded, None otherwise. Skipped files are recorded in the
+        metrics.
+        """
+        if self._min_usable_fraction <= 0:
+            return None
+        fraction = self._call(get_reader(netcdf_file_path).get_usable_fraction,
+                netcdf_file_path, stride=self._triage_stride)
+        if fraction is None or fraction >= self._min_usable_fraction:
+            return None
+        with self._lock:
+            self._metrics['skipped'].append((netcdf_file_path, fraction))
+        return fraction
 
-    def update(self, store=None):
+    def _decode(self, netcdf_file_path):
         """
-        Update the SnowMap
+        Returns the snowmap of a file, an instance of _SkippedFile if the
+        file is skipped
+        """
+        reader = get_reader(netcdf_file_path)
+        key = None
+        if self._scene_cache is not None:
+            key = SceneCache.get_key(netcdf_file_path,
+                    reader.get_cache_version(self._resampling))
+            array = self._scene_cache.get(key)
+            if array is not None:
+                with self._lock:
+                    self._metrics['cache_hits'] += 1
+                return SnowMap(array, is_internal=True)
+        fraction = self._triage(netcdf_file_path)
+        if fraction is not None:
+            return _SkippedFile(fraction)
+        snowmap = SnowMap(self._call(reader.read, netcdf_file_path,
+                resampling=self._resampling), is_internal=True)
+        if key is not None:
+            self._scene_cache.put(key, snowmap.get_array())
+        return snowmap
+
+    def _run_pipeline(self, netcdf_files, queue_size):
+        """
+        Yields (timestamp, path, snowmap) in the order of netcdf_files.
+        Downloading and decoding run in their own threads, connected with
+        bounded queues, so that file N+1 is downloaded while file N is
+        decoded and file N-1 is applied. Up to decode_workers files are
+        decoded at once, their snowmaps are passed on in order.
+        """
+        decode_queue = queue.Queue(maxsize=queue_size)
+        apply_queue = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(queue_, item):
+            # Checking regularly whether the consumer stopped
+            while not stop.is_set():
+                try:
+                    queue_.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(queue_):
+            while not stop.is_set():
+                try:
+                    return queue_.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return done
+
+        def download():
+            try:
+                for timestamp, netcdf_file_path in netcdf_files:
+                    start = time.time()
+                    self._download(netcdf_file_path)
+                    self._metrics['download_time'] += time.time() - start
+                    if not put(decode_queue, (timestamp, netcdf_file_path)):
+                        return
+                put(decode_queue, done)
+            except BaseException as e:
+                put(decode_queue, e)
+
+        def decode_file(netcdf_file_path):
+            start = time.time()
+            try:
+                snowmap = self._decode(netcdf_file_path)
+            except Exception as e:
+                # Raised when the file is applied, see update
+                snowmap = _DecodeFailure(e)
+            with self._lock:
+                self._metrics['decode_time'] += time.time() - start
+            return snowmap
+
+        def decode():
+            pending = collections.deque()
+            executor = ThreadPoolExecutor(max_workers=self._decode_workers)
+
+            def pass_on(max_pending):
+                # Passing on the oldest files, in order
+                while len(pending) > max_pending:
+                    timestamp, netcdf_file_path, future = pending.popleft()
+                    if not put(apply_queue, (timestamp, netcdf_file_path,
+                            future.result())):
+                        return False
+                return True
+
+            try:
+                while True:
+                    item = get(decode_queue)
+                    if item is done or isinstance(item, BaseException):
+                        if pass_on(0):
+                            put(apply_queue, item)
+                        return
+                    timestamp, netcdf_file_path = item
+                    pending.append((timestamp, netcdf_file_path,
+                            executor.submit(decode_file, netcdf_file_path)))
+                    if not pass_on(self._decode_workers - 1):
+                        return
+            except BaseException as e:
+                put(apply_queue, e)
+            finally:
+                executor.shutdown(wait=True)
+
+        threads = [threading.Thread(target=target, daemon=True)
+                for target in (download, decode)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = apply_queue.get()
+                if item is done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    @staticmethod
+    def _get_journal_path(store):
+        return store + '.journal'
+
+    def _resume(self, store):
+        """
+        Resumes an update that was interrupted after a checkpoint to store.
+        The checkpoint is used if its journal belongs to an update starting
+        from the current state map. Returns the journal to continue with,
+        listing the files applied so far.
+        """
+        journal = {'base': self._usm.get_timestamp(), 'applied': []}
+        try:
+            with open(self._get_journal_path(store)) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            return journal
+        if self._usm.get_timestamp() not in (previous['base'],
+                previous['timestamp']):
+            return journal
+        try:
+            checkpoint = UpdatedSnowMap.load(store)
+        except OSError:
+            return journal
+        # The state map is written before the journal, a crash in between
+        # leaves a state map the journal does not belong to
+        if checkpoint.get_timestamp() != previous['timestamp']:
+            return journal
+        if self._verbose:
+            print("Resuming from checkpoint {}, {} files already "
+                "applied".format(store, len(previous['applied'])))
+        self._usm = checkpoint
+        return previous
+
+    def checkpoint(self, store, journal):
+        """
+        Writes the state map to store and then the journal of applied
+        files next to it, both atomically
+        """
+        self.save(store)
+        journal['timestamp'] = self._usm.get_timestamp()
+        journal_path = self._get_journal_path(store)
+        with open(journal_path + '.tmp', 'w') as f:
+            json.dump(journal, f)
+        os.replace(journal_path + '.tmp', journal_path)
+
+    def update(self, store=None, delete_applied=False, queue_size=2,
+            checkpoint_files=None, checkpoint_interval=None):
+        """
+        Update the SnowMap with all files found, in order of their
+        timestamp. Files with the same timestamp are applied in order of
+        the priority of their readers (see SceneReader), such that the
+        highest priority wins. Downloading, decoding and applying are
+        pipelined.
+        :param str store: Optional, path to write the state map to
+        :param bool delete_applied: Delete every file once it is applied,
+            except for files used in place from the satellite directory
+        :param int queue_size: The maximum number of files waiting
+            between two stages of the pipeline
+        :param int checkpoint_files: Optional, write the state map to store
+            every checkpoint_files files
+        :param float checkpoint_interval: Optional, write the state map to
+            store if the last write is longer ago than this (seconds).
+            With checkpoints, a journal of the applied files is written
+            next to store, and an interrupted update continues from the
+            last checkpoint when run again. The journal is removed once
+            the update is complete.
         """
         if len(self._netcdf_file_list) == 0:
             if self._verbose:
                 print("Nothing to do, no new NetCDF files")
             return
-        for timestamp, netcdf_file_path in sorted(self._netcdf_file_list):
-            if self._verbose:
-                print("Reading NetCDF file {}... ".format(netcdf_file_path),end="")
-            snowmap = SnowMap.from_netcdf(netcdf_file_path, transform=True)
-            array = snowmap.get_array()
-            if self._verbose:
-                print("Done, obtained array of shape {} x {}\n"
-                "Distribution of pixel values is:".format(*array.shape))
-            for unique, count in zip(*np.unique(array, return_counts=True)):
-                if self._verbose:
-                    print("  {:<2}: {}".format(unique, count))
-            # Important, also update the timetamp.
-            # could also be done for final, but leave for now for
-            # reasons of stability
-            self._usm.update(snowmap, timestamp=timestamp)
+        checkpointing = bool(store) and bool(checkpoint_files or
+                checkpoint_interval)
+        if checkpointing:
+            journal = self._resume(store)
+            applied = set(journal['applied'])
+            self._netcdf_file_list = [(timestamp, path) for timestamp, path
+                    in self._netcdf_file_list
+                    if os.path.basename(path) not in applied]
+        start_update = time.time()
+        last_checkpoint = start_update
+        since_checkpoint = 0
+        for key in ('download_time', 'decode_time', 'apply_time'):
+            self._metrics[key] = 0.0
+        self._metrics['cache_hits'] = 0
+        self._metrics['skipped'] = []
+        self._metrics['failed'] = []
+        self._metrics['events'] = 0
+        netcdf_files = sorted(self._netcdf_file_list,
+                key=lambda item: (item[0], get_reader(item[1]).PRIORITY,
+                    item[1]))
+        napplied = 0
+        try:
+            for timestamp, netcdf_file_path, snowmap in self._run_pipeline(
+                    netcdf_files, queue_size):
+                start = time.time()
+                dropped = False
+                if isinstance(snowmap, _DecodeFailure):
+                    self._decode_failures[netcdf_file_path] += 1
+                    if (self._decode_failures[netcdf_file_path] <
+                            self._max_decode_attempts):
+                        raise snowmap.error
+                    print("Dropping NetCDF file {} after {} failed "
+                        "attempts: {}".format(netcdf_file_path,
+                        self._decode_failures.pop(netcdf_file_path),
+                        snowmap.error))
+                    self._metrics['failed'].append((netcdf_file_path,
+                            str(snowmap.error)))
+                    # Like skipped files, it is not picked up again
+                    self._usm.set_timestamp(timestamp)
+                    dropped = True
+                    snowmap = None
+                elif isinstance(snowmap, _SkippedFile):
+                    # Files are decoded ahead and out of order, the
+                    # fraction is passed on with the file
+                    if self._verbose:
+                        print("Skipped NetCDF file {}, usable fraction {:.3f} "
+                            "below {}".format(netcdf_file_path,
+                            snowmap.fraction, self._min_usable_fraction))
+                    # The file is considered, it is not picked up again
+                    self._usm.set_timestamp(timestamp)
+                    snowmap = None
+                elif self._verbose:
+                    array = snowmap.get_array()
+                    print("Read NetCDF file {}, obtained array of shape {} x {}\n"
+                    "Distribution of pixel values is:".format(netcdf_file_path,
+                            *array.shape))
+                    for unique, count in zip(*np.unique(array, return_counts=True)):
+                        print("  {:<2}: {}".format(unique, count))
+                # Important, also update the timetamp.
+                # could also be done for final, but leave for now for
+                # reasons of stability
+                if snowmap is not None:
+                    changes = self._usm.update(snowmap, timestamp=timestamp,
+                            return_changes=self._event_log is not None)
+                    if changes is not None:
+                        events = changes.get_events(
+                                min_pixels=self._min_event_pixels)
+                        self._event_log.append(events)
+                        self._metrics['events'] += len(events)
+                # Dropped files are kept for inspection
+                if netcdf_file_path in self._in_place_files:
+                    self._in_place_files.discard(netcdf_file_path)
+                elif delete_applied and not dropped:
+                    os.remove(netcdf_file_path)
+                self._metrics['apply_time'] += time.time() - start
+                napplied += 1
+                if checkpointing:
+                    journal['applied'].append(os.path.basename(netcdf_file_path))
+                    since_checkpoint += 1
+                    if ((checkpoint_files and since_checkpoint >= checkpoint_files)
+                            or (checkpoint_interval and time.time() -
+                                last_checkpoint >= checkpoint_interval)):
+                        self.checkpoint(store, journal)
+                        last_checkpoint = time.time()
+                        since_checkpoint = 0
+        except BaseException:
+            # The applied files are not applied again when the update is
+            # retried, e.g. on the next poll in watch mode
+            self._netcdf_file_list = netcdf_files[napplied:]
+            self._updated = self._updated or napplied > 0
+            raise
+        self._metrics['nfiles'] = len(netcdf_files)
+        self._metrics['wall_time'] = time.time() - start_update
+        # All files have been applied, a following call to update
+        # (e.g. in watch mode) only processes files found afterwards.
+        self._netcdf_file_list = []
         self._updated = True # Flag to allow for calculation and upload
         # Problem might be if update doesnt run because no new files
         if self._verbose:
-            print("Update complete, final distribution of values is:")
+            print("Update of {nfiles} files complete in {wall_time:.1f}s "
+                "(download {download_time:.1f}s, decode {decode_time:.1f}s, "
+                "apply {apply_time:.1f}s)".format(**self._metrics))
+            print("{} files skipped, {} files read from the scene cache".format(
+                    len(self._metrics['skipped']), self._metrics['cache_hits']))
+            print("Final distribution of values is:")
             for unique, count in zip(*np.unique(self._usm.get_array(),
                         return_counts=True)):
                 print("  {:<2}: {}".format(unique, count))
         if store:
-            # TODO checks for valid file paht and existing files!
-            if self._verbose:
-                print("Writing state map to {}".format(store))
-            self._usm.save(store)
+            self.save(store)
+        if checkpointing and os.path.exists(self._get_journal_path(store)):
+            os.remove(self._get_journal_path(store))
+
+    def publish(self, directory):
+        """
+        Publishes the current state map for readers such as the query server
+        """
+        if self._verbose:
+            print("Publishing state map to {}".format(directory))
+        self._usm.publish(directory)
+
+    def save(self, store):
+        """
+        Writes the current state map to store
+        """
+        # TODO checks for valid file paht and existing files!
+        if self._verbose:
+            print("Writing state map to {}".format(store))
+        self._usm.save(store)
 
     def calculate_boundaries(self, size_filter_snow=0,
-            size_filter_nonsnow=0, allow_upload_without_update=False):
+            size_filter_nonsnow=0, allow_upload_without_update=False,
+            smooth=0):
 
         if not (self._updated):
-            print("There is nothing new to upload")
+            if self._verbose:
+                print("There is nothing new to upload")
             if allow_upload_without_update:
                 if self._verbose:
                     print("Continuing with calculation, upload without update")
@@ -166,22 +657,80 @@ class SnowMapUpdater(object):
                 raise UploadWithoutUpdateError(
                         "Upload called without updates, stopping")
 
+        # Filtering works on a copy, the state map itself has to stay
+        # untouched for further updates
+        usm = self._usm.copy()
         if size_filter_snow and self._verbose:
             print("Reducing snow fields with parameter "
                 "size_filter_snow={}".format(size_filter_snow))
-        self._usm.filter_size_snow(size_filter_snow, verbose=self._verbose)
+        usm.filter_size_snow(size_filter_snow, verbose=self._verbose)
         if size_filter_nonsnow and self._verbose:
             print("Reducing non-snow fields with parameter "
                 "size_filter_nonsnow={}".format(size_filter_nonsnow))
-        self._usm.filter_size_nonsnow(size_filter_nonsnow,
+        usm.filter_size_nonsnow(size_filter_nonsnow,
                 verbose=self._verbose)
         if self._verbose:
             print("Calculating state map boundaries")
-        self._boundaries = list(self._usm.get_boundaries(transform=True))
+        self._boundaries = usm.get_boundaries(transform=True, smooth=smooth)
         if self._verbose:
             print("Done")
 
-    def upload(self, dry_run=False, wipe_previous=False):
+    def calculate_statistics(self, regions=None, dem=None):
+        """
+        Calculates statistics of the (unfiltered) state map, uploaded
+        together with the boundaries.
+        :param regions: Optional, an instance of RegionRaster, to get the
+            snow cover per region
+        :param dem: Optional, an instance of ElevationModel, to get the
+            snowline altitude per region (if given) and aspect
+        """
+        statistics = {}
+        if regions is not None:
+            if self._verbose:
+                print("Calculating statistics for {} regions".format(
+                        len(regions.get_names())))
+            statistics['regions'] = regions.get_statistics(self._usm)
+        if dem is not None:
+            if self._verbose:
+                print("Calculating snowline altitudes")
+            statistics['snowline_altitudes'] = dem.get_snowline_altitudes(
+                    self._usm, regions=regions)
+        self._statistics = statistics or None
+
+    def write_boundaries(self, filename):
+        """
+        Writes the boundaries calculated by calculate_boundaries to a
+        local GeoJSON file, in the same format as uploaded to the DB
+        """
+        if self._boundaries is None:
+            raise RuntimeError("write_boundaries called without "
+                "calculate_boundaries having been called")
+        with open(filename, 'w') as f:
+            json.dump(boundaries_to_geo(self._boundaries), f,
+                    separators=(',', ':'))
+
+    def get_timestamp(self):
+        return self._usm.get_timestamp()
+
+    def get_state_map(self):
+        return self._usm
+
+    def get_metrics(self):
+        """
+        Returns the metrics of the last update: timings (the decode time
+        summed over the decoding workers), number of files, scene cache
+        hits, the skipped files with their usable fraction and the
+        dropped files with their error
+        """
+        return dict(self._metrics)
+
+    def upload(self, dry_run=False, wipe_previous=False, binary=False,
+            keyframe_interval=None, raster=False):
+        """
+        Uploads the boundaries calculated by calculate_boundaries, and the
+        statistics if calculated, see SnowlineDB.upload.
+        :param bool raster: Also upload the state map run-length encoded
+        """
         if self._boundaries is None:
             raise RuntimeError("Upload called without calculate_boundaries"
                 " having been called")
@@ -190,10 +739,18 @@ class SnowMapUpdater(object):
             dbname='snowline.json')
         snowlinedb_kwargs.update(self._aws_dict)
         # TODO: allow for user update of snowlinedb_kwargs
-        sdb = SnowlineDB(**snowlinedb_kwargs)
-        sdb.upload(self._boundaries, dry_run=dry_run,
+        if self._database_dir is not None:
+            storage = LocalStorage(self._database_dir)
+            snowlinedb_kwargs.update(storage=storage, snowline_storage=storage)
+        if self._snowlinedb is None:
+            self._snowlinedb = SnowlineDB(**snowlinedb_kwargs)
+        self._snowlinedb.upload(self._boundaries, dry_run=dry_run,
                 timestamp=self._usm.get_timestamp(), verbose=self._verbose,
-                wipe_previous=wipe_previous)
+                wipe_previous=wipe_previous, statistics=self._statistics,
+                binary=binary, keyframe_interval=keyframe_interval,
+                raster=self._usm.to_rle() if raster else None)
+        # Everything up to now has been published
+        self._updated = False
 
 
 def update_snowmap(state_map=None, new_state_map=None,
@@ -202,7 +759,13 @@ def update_snowmap(state_map=None, new_state_map=None,
         size_filter_snow=0, size_filter_nonsnow=0,
         dry_run=False, no_upload=False, no_boundaries=False,
         quiet=False, wipe_previous=False, max_date=None,
-        allow_upload_without_update=False):
+        allow_upload_without_update=False, regions=None, dem=None,
+        delete_applied=False, scene_cache=None, scene_cache_size=2048,
+        min_usable_fraction=0, binary=False, publish_dir=None,
+        resampling='nearest', keyframe_interval=None, satellite_dir=None,
+        database_dir=None, checkpoint_files=None, checkpoint_interval=None,
+        raster=False, event_log=None, event_retention=30, decode_workers=1,
+        smooth=0):
     """
     Takes as input the path to a instance of UpdateMap (if None creates one)
     and queries the DB for satellite images newer than this UpdateMap.
@@ -227,33 +790,203 @@ def update_snowmap(state_map=None, new_state_map=None,
         format '%Y%m%dT%H%M or '%Y%m%d'
     :param bool allow_upload_without_update: if True code will not raise
         when trying to process a state without having updated it
+    :param str regions: Optional, a GeoJSON file with region polygons.
+        The snow cover per region is uploaded next to the snowline.
+        The rasterized regions are cached in cache, if given.
+    :param str dem: Optional, a DEM file (see ElevationModel.from_file).
+        The snowline altitude per region and aspect is uploaded next to
+        the snowline. The resampled DEM is cached in cache, if given.
+    :param bool delete_applied: Delete every netcdf file once it has been
+        applied to the state map. Files used in place from satellite_dir
+        are kept.
+    :param str scene_cache: Optional, a directory to cache decoded scenes in
+    :param int scene_cache_size: Maximum size of the scene cache in MB
+    :param float min_usable_fraction: Skip files with a smaller fraction of
+        pixels that are neither cloud nor invalid
+    :param bool binary: Also upload the snowline in the binary format with
+        spatial index
+    :param str publish_dir: Optional, directory to publish the updated
+        state map to, e.g. for the query server
+    :param str resampling: How scenes are resampled to the internal grid,
+        nearest or area (class with the largest area fraction)
+    :param int keyframe_interval: Upload a full snowline only every
+        keyframe_interval uploads, deltas in between, see SnowlineDB.upload
+    :param str satellite_dir: Optional, a local directory replacing the
+        satellite bucket. Files are used in place if no cache is given.
+    :param str database_dir: Optional, a local directory replacing the
+        database and snowline buckets
+    :param int checkpoint_files: Write new_state_map every this many files
+    :param float checkpoint_interval: Write new_state_map if the last write
+        is longer ago than this (seconds). With checkpoints, a rerun after
+        a crash resumes from the last checkpoint, see SnowMapUpdater.update.
+    :param bool raster: Also upload the state map run-length encoded, for
+        clients that need the raster but no polygons
+    :param str event_log: Optional, a file to append the snow onset and
+        melt events of every file to, see events.EventLog
+    :param float event_retention: Days to keep events in the event log
+    :param int decode_workers: The number of files decoded in parallel,
+        in as many processes
+    :param int smooth: Passes of corner cutting to smooth the snowline,
+        see Boundaries.smooth
     """
+    if scene_cache is not None:
+        scene_cache = SceneCache(scene_cache,
+                max_size=scene_cache_size*1024**2)
     smu = SnowMapUpdater(update_map_path=state_map,
             allow_blank=allow_blank, verbose=not(quiet),
             aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key)
+            aws_secret_access_key=aws_secret_access_key,
+            scene_cache=scene_cache,
+            min_usable_fraction=min_usable_fraction, resampling=resampling,
+            satellite_dir=satellite_dir, database_dir=database_dir,
+            event_log=None if event_log is None else EventLog(event_log,
+                retention=event_retention*86400),
+            decode_workers=decode_workers)
     if netcdf_files:
         smu.set_netcdf_files(*netcdf_files) #TODO allow for multiples?
     else:
-        if cache is None:
+        if cache is None and satellite_dir is None:
             raise ValueError("You need to provide a valid cache if "
                 "you don't manually set netcdf_file_path")
         smu.get_netcdf_files(cache, max_date_string=max_date)
-    smu.update(store=new_state_map)
+    smu.update(store=new_state_map, delete_applied=delete_applied,
+            checkpoint_files=checkpoint_files,
+            checkpoint_interval=checkpoint_interval)
+    if publish_dir is not None and smu.has_been_updated():
+        smu.publish(publish_dir)
     if no_boundaries:
         return
     try:
         smu.calculate_boundaries(size_filter_snow=size_filter_snow,
             size_filter_nonsnow=size_filter_nonsnow,
-            allow_upload_without_update=allow_upload_without_update)
+            allow_upload_without_update=allow_upload_without_update,
+            smooth=smooth)
     except UploadWithoutUpdateError as e:
         # More graceful exit than allowing the exception to do that.
         print(e)
         return
     if no_upload:
         return
-    smu.upload(dry_run=dry_run, wipe_previous=wipe_previous)
+    if regions is not None or dem is not None:
+        smu.calculate_statistics(
+            regions=None if regions is None else RegionRaster.from_geojson(
+                regions, cache_dir=cache),
+            dem=None if dem is None else ElevationModel.from_file(
+                dem, cache_dir=cache))
+    smu.upload(dry_run=dry_run, wipe_previous=wipe_previous, binary=binary,
+            keyframe_interval=keyframe_interval, raster=raster)
+
 
+def watch_snowmap(state_map=None, new_state_map=None, watch_dir=None,
+        cache=None, allow_blank=True,
+        aws_access_key_id=None, aws_secret_access_key=None,
+        size_filter_snow=0, size_filter_nonsnow=0,
+        dry_run=False, no_upload=False, no_boundaries=False,
+        quiet=False, poll_interval=60, checkpoint_interval=3600,
+        max_polls=None, regions=None, dem=None, delete_applied=False,
+        scene_cache=None, scene_cache_size=2048, min_usable_fraction=0,
+        binary=False, publish_dir=None, resampling='nearest',
+        keyframe_interval=None, satellite_dir=None, database_dir=None,
+        raster=False, event_log=None, event_retention=30, decode_workers=1,
+        smooth=0):
+    """
+    Long-running version of update_snowmap. The state map, the grid and the
+    S3 connections are kept in memory, and new scenes are processed as
+    soon as they appear, either in a local directory (watch_dir) or in the
+    satellite bucket (downloaded to cache).
+    :param string state_map: The path to the update map to start from
+    :param string new_state_map: Optional, path where the state map
+        is checkpointed to
+    :param string watch_dir: A local directory to watch for new netcdf
+        files. If None, will poll the satellite bucket instead. Files are
+        only processed once their size and modification time are the
+        same in two consecutive polls.
+    :param string cache: Directory to download files to, only needed if
+        watch_dir is not given
+    :param float poll_interval: Seconds to wait between two polls
+    :param float checkpoint_interval: Minimum seconds between two writes
+        of the state map to new_state_map. The state map is always
+        written when the watch stops.
+    :param int max_polls: Stop after this many polls, None runs forever
+    Errors during a poll are printed and the poll is retried on the next
+    one, only KeyboardInterrupt stops the watch. A file that fails to
+    decode in three polls is dropped, see SnowMapUpdater.
+    See update_snowmap for the remaining parameters.
+    """
+    if watch_dir is None and cache is None and satellite_dir is None:
+        raise ValueError("You need to provide either a directory to "
+            "watch or a cache for files from the bucket")
+    verbose = not(quiet)
+    # Rasterized and resampled once for the lifetime of the watch
+    if regions is not None:
+        regions = RegionRaster.from_geojson(regions, cache_dir=cache)
+    if dem is not None:
+        dem = ElevationModel.from_file(dem, cache_dir=cache)
+    if scene_cache is not None:
+        scene_cache = SceneCache(scene_cache,
+                max_size=scene_cache_size*1024**2)
+    smu = SnowMapUpdater(update_map_path=state_map,
+            allow_blank=allow_blank, verbose=verbose,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            scene_cache=scene_cache,
+            min_usable_fraction=min_usable_fraction, resampling=resampling,
+            satellite_dir=satellite_dir, database_dir=database_dir,
+            event_log=None if event_log is None else EventLog(event_log,
+                retention=event_retention*86400),
+            decode_workers=decode_workers)
+    last_checkpoint = time.time()
+    needs_checkpoint = False
+    npolls = 0
+    try:
+        while max_polls is None or npolls < max_polls:
+            npolls += 1
+            # A failing poll (a broken file, a network error, a
+            # concurrent upload) is retried on the next poll
+            try:
+                if watch_dir is not None:
+                    smu.find_local_netcdf_files(watch_dir,
+                            stable_only=True)
+                else:
+                    smu.get_netcdf_files(cache)
+                if smu.has_new_files():
+                    start = time.time()
+                    smu.update(delete_applied=delete_applied)
+                    needs_checkpoint = True
+                    if publish_dir is not None:
+                        smu.publish(publish_dir)
+                    if not no_boundaries:
+                        smu.calculate_boundaries(
+                                size_filter_snow=size_filter_snow,
+                                size_filter_nonsnow=size_filter_nonsnow,
+                                smooth=smooth)
+                        if not no_upload:
+                            if regions is not None or dem is not None:
+                                smu.calculate_statistics(regions=regions,
+                                        dem=dem)
+                            smu.upload(dry_run=dry_run, binary=binary,
+                                    keyframe_interval=keyframe_interval,
+                                    raster=raster)
+                    if verbose:
+                        print("Processed new files in {:.1f}s".format(
+                                time.time() - start))
+            except Exception:
+                print("Poll failed, retrying on the next poll:")
+                traceback.print_exc()
+                needs_checkpoint = needs_checkpoint or smu.has_been_updated()
+            if (new_state_map and needs_checkpoint and
+                    time.time() - last_checkpoint >= checkpoint_interval):
+                smu.save(new_state_map)
+                last_checkpoint = time.time()
+                needs_checkpoint = False
+            if max_polls is None or npolls < max_polls:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        if verbose:
+            print("Stopping watch")
+    finally:
+        if new_state_map and needs_checkpoint:
+            smu.save(new_state_map)
 
 
 if __name__ == '__main__':
@@ -264,7 +997,7 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--new-state-map', help=('Where to store '
             'the new state map (if not provided will not store'))
     parser.add_argument('--netcdf-files', nargs='+', help=("Path to NetCDF "
-            "files to be used for update. If none is provided will query"
+            "or GeoTIFF files to be used for update. If none is provided will query"
             " on AWS and download"))
     parser.add_argument('-c', '--cache', help='A valid path to an existing '
             'directory that will be used as cache for netcdf files. '
@@ -277,6 +1010,9 @@ if __name__ == '__main__':
     parser.add_argument('--size-filter-nonsnow', type=int, default=0,
             help='Remove clusters of no snow with snow fields '
                     'below this pixel size')
+    parser.add_argument('--smooth', type=int, default=0,
+            help='Smooth the snowline with this many passes of corner '
+                'cutting, e.g. 2')
     parser.add_argument('--no-upload', action='store_true',
             help='Disable the writing of boundary files and upload')
     parser.add_argument('--no-boundaries', action='store_true',
@@ -298,5 +1034,79 @@ if __name__ == '__main__':
     parser.add_argument('--max-date', help="The maximum date when querying "
         "for the netcdf files. Format: YYYYmmdd(THHMM), Example: 20121217 "
         "or 20121217T2350")    
+    parser.add_argument('--regions', help="A GeoJSON file with region "
+        "polygons (property 'name'), the snow cover per region is uploaded "
+        "next to the snowline")
+    parser.add_argument('--dem', help="A DEM as npz file with arrays "
+        "elevation, lon and lat, the snowline altitude per region and aspect"
+        " is uploaded next to the snowline")
+    parser.add_argument('--delete-applied', action='store_true',
+            help='Delete every NetCDF file once it has been applied')
+    parser.add_argument('--scene-cache', help='A directory to cache '
+            'decoded scenes in, reprocessing cached scenes skips decoding')
+    parser.add_argument('--scene-cache-size', type=int, default=2048,
+            help='Maximum size of the scene cache in MB')
+    parser.add_argument('--min-usable-fraction', type=float, default=0,
+            help='Skip NetCDF files with a smaller fraction of pixels that '
+                'are neither cloud nor invalid, e.g. 0.05')
+    parser.add_argument('--binary', action='store_true',
+            help='Also upload the snowline in a binary format with a spatial '
+                'index, for reading only the snowline in a bounding box')
+    parser.add_argument('--raster', action='store_true',
+            help='Also upload the state map run-length encoded, for '
+                'clients that only need the raster')
+    parser.add_argument('--event-log', help='A file to append snow onset '
+            'and melt events to, the clustered pixels that changed between '
+            'snow and no snow')
+    parser.add_argument('--event-retention', type=float, default=30,
+            help='Days to keep events in the event log')
+    parser.add_argument('--keyframe-interval', type=int, help='Upload a '
+            'full snowline only every this many uploads and only the '
+            'changed features in between')
+    parser.add_argument('--satellite-dir', help='A local directory used '
+            'instead of the satellite bucket, to run offline')
+    parser.add_argument('--database-dir', help='A local directory used '
+            'instead of the database and snowline buckets, to run offline')
+    parser.add_argument('--publish-dir', help='A directory to publish '
+            'the updated state map to, for the query server')
+    parser.add_argument('--resampling', choices=('nearest', 'area'),
+            default='nearest', help='How scenes are resampled to the grid: '
+                'nearest pixel, or the class covering most of the area of a '
+                'grid cell')
+    parser.add_argument('--decode-workers', type=int, default=1,
+            help='The number of files decoded in parallel, in as many '
+                'processes')
+    parser.add_argument('-w', '--watch', action='store_true',
+            help='Keep running and process new files as they arrive, '
+                'polling the bucket or the directory given by --watch-dir')
+    parser.add_argument('--watch-dir', help='A local directory to watch '
+            'for new NetCDF or GeoTIFF files (only with --watch)')
+    parser.add_argument('--poll-interval', type=float, default=60,
+            help='Seconds between two polls for new files (only with --watch)')
+    parser.add_argument('--checkpoint-interval', type=float,
+            help='Minimum seconds between two writes of the state map '
+                'to --new-state-map, 3600 by default with --watch. Without '
+                '--watch there are no checkpoints unless given, an '
+                'interrupted update resumes from the last checkpoint when '
+                'run again.')
+    parser.add_argument('--checkpoint-files', type=int, help='Also write '
+            'the state map to --new-state-map every this many files '
+            '(not with --watch)')
     parsed = parser.parse_args()
-    update_snowmap(**vars(parsed))
+    kwargs = vars(parsed)
+    watch = kwargs.pop('watch')
+    watch_kwargs = dict(watch_dir=kwargs.pop('watch_dir'),
+            poll_interval=kwargs.pop('poll_interval'))
+    if watch:
+        for key in ('netcdf_files', 'wipe_previous', 'max_date',
+                'allow_upload_without_update', 'checkpoint_files'):
+            if kwargs.pop(key):
+                parser.error("--{} cannot be used with --watch".format(
+                        key.replace('_', '-')))
+        if kwargs['checkpoint_interval'] is None:
+            # Keep the default of watch_snowmap
+            kwargs.pop('checkpoint_interval')
+        kwargs.update(watch_kwargs)
+        watch_snowmap(**kwargs)
+    else:
+        update_snowmap(**kwargs)
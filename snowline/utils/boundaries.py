@@ -0,0 +1,178 @@
+import numpy as np
+
+
+class Boundaries(object):
+    """
+    The boundaries of the snow patches as ragged arrays: all vertices in
+    a single (N, 2) coordinate buffer, rings given by offsets into the
+    buffer and polygons (one per snow patch) by offsets into the rings.
+    Ring i is coordinates[ring_offsets[i]:ring_offsets[i+1]], polygon j
+    consists of the rings polygon_offsets[j] to polygon_offsets[j+1]-1.
+    Transforms and serialization work on the whole buffer at once.
+    Iterating yields every polygon as a list of (N, 2) arrays (views into
+    the buffer), as get_boundaries used to.
+    """
+    def __init__(self, coordinates, ring_offsets, polygon_offsets):
+        self._coordinates = np.asarray(coordinates,
+                dtype=float).reshape(-1, 2)
+        self._ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+        self._polygon_offsets = np.asarray(polygon_offsets, dtype=np.int64)
+        if (self._ring_offsets[0] != 0 or self._polygon_offsets[0] != 0 or
+                self._ring_offsets[-1] != len(self._coordinates) or
+                self._polygon_offsets[-1] != len(self._ring_offsets) - 1):
+            raise ValueError("Offsets do not match the coordinates")
+
+    @classmethod
+    def from_polygons(cls, polygons):
+        """
+        Creates the container from nested lists, every polygon a list of
+        rings of (x, y). Instances of Boundaries are returned as they are.
+        """
+        if isinstance(polygons, cls):
+            return polygons
+        rings = []
+        polygon_offsets = [0]
+        for polygon in polygons:
+            rings.extend(np.asarray(ring, dtype=float).reshape(-1, 2)
+                    for ring in polygon)
+            polygon_offsets.append(len(rings))
+        ring_offsets = np.cumsum([0] + [len(ring) for ring in rings])
+        coordinates = np.concatenate(rings) if rings else np.zeros((0, 2))
+        return cls(coordinates, ring_offsets, polygon_offsets)
+
+    def __len__(self):
+        return len(self._polygon_offsets) - 1
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError("Polygon index out of range")
+        index %= len(self)
+        offsets = self._ring_offsets[self._polygon_offsets[index]:
+                self._polygon_offsets[index+1]+1]
+        return [self._coordinates[start:stop]
+                for start, stop in zip(offsets[:-1], offsets[1:])]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def get_coordinates(self):
+        return self._coordinates
+
+    def get_ring_offsets(self):
+        return self._ring_offsets
+
+    def get_polygon_offsets(self):
+        return self._polygon_offsets
+
+    def get_ring_sizes(self):
+        return np.diff(self._ring_offsets)
+
+    def get_point_offsets(self):
+        """
+        Returns the offsets of the polygons into the coordinate buffer
+        """
+        return self._ring_offsets[self._polygon_offsets]
+
+    def get_bboxes(self):
+        """
+        Returns an array of shape (polygons, 4) with the bounding box
+        (minx, miny, maxx, maxy) of every polygon, NaN for empty polygons
+        """
+        bboxes = np.full((len(self), 4), np.nan)
+        point_offsets = self.get_point_offsets()
+        nonempty = np.diff(point_offsets) > 0
+        if nonempty.any():
+            starts = point_offsets[:-1][nonempty]
+            bboxes[nonempty, :2] = np.minimum.reduceat(self._coordinates,
+                    starts, axis=0)
+            bboxes[nonempty, 2:] = np.maximum.reduceat(self._coordinates,
+                    starts, axis=0)
+        return bboxes
+
+    def transform(self, scale, offset):
+        """
+        Returns new boundaries with every vertex transformed as
+        scale*vertex + offset, one vectorized operation over all vertices
+        """
+        return Boundaries(self._coordinates * scale + offset,
+                self._ring_offsets, self._polygon_offsets)
+
+    def clean(self, deviation=0.1):
+        """
+        Returns new boundaries without the vertices that lie (within
+        deviation) in the middle between their neighbors, see
+        geo_utils.clean_up_line. The first and last vertex of every ring
+        are kept.
+        """
+        coordinates = self._coordinates
+        keep = np.ones(len(coordinates), dtype=bool)
+        if len(coordinates) > 2:
+            keep[1:-1] = np.any(np.abs(0.5*(coordinates[:-2] +
+                    coordinates[2:]) - coordinates[1:-1]) > deviation, axis=1)
+        # Neighbors are only defined within a ring
+        sizes = self.get_ring_sizes()
+        starts = self._ring_offsets[:-1][sizes > 0]
+        keep[starts] = True
+        keep[self._ring_offsets[1:][sizes > 0] - 1] = True
+        new_sizes = np.zeros_like(sizes)
+        if len(starts):
+            new_sizes[sizes > 0] = np.add.reduceat(
+                    keep.astype(np.int64), starts)
+        return Boundaries(coordinates[keep],
+                np.concatenate([[0], np.cumsum(new_sizes)]),
+                self._polygon_offsets)
+
+    def smooth(self, iterations=1):
+        """
+        Returns new boundaries smoothed with Chaikin's corner cutting:
+        every segment (p, q) is replaced by the points 3/4 p + 1/4 q and
+        1/4 p + 3/4 q. Each iteration roughly doubles the number of
+        vertices and works on all rings at once, memory is proportional
+        to the vertices only. Closed rings (first vertex equal to the last)
+        stay closed, open rings keep their end points.
+        :param int iterations: The number of corner cutting passes
+        """
+        boundaries = self
+        for _ in range(iterations):
+            boundaries = boundaries._cut_corners()
+        return boundaries
+
+    def _cut_corners(self):
+        coordinates = self._coordinates
+        sizes = self.get_ring_sizes()
+        starts = self._ring_offsets[:-1]
+        nonempty = sizes > 0
+        closed = np.zeros(len(sizes), dtype=bool)
+        closed[sizes >= 3] = np.all(coordinates[starts[sizes >= 3]] ==
+                coordinates[self._ring_offsets[1:][sizes >= 3] - 1], axis=1)
+        # Open rings start with their first vertex, every ring but single
+        # vertices ends with an extra vertex: the first new one of closed
+        # rings, the last vertex of open rings
+        heads = (nonempty & ~closed).astype(np.int64)
+        tails = (sizes >= 2).astype(np.int64)
+        nsegments = np.maximum(sizes - 1, 0)
+        new_offsets = np.concatenate([[0],
+                np.cumsum(heads + 2*nsegments + tails)])
+        new_coordinates = np.empty((new_offsets[-1], 2))
+        # Segments start at every vertex but the last of a ring
+        is_last = np.zeros(len(coordinates), dtype=bool)
+        is_last[self._ring_offsets[1:][nonempty] - 1] = True
+        segment_starts = np.flatnonzero(~is_last)
+        rings = np.repeat(np.arange(len(sizes)), nsegments)
+        positions = (new_offsets[:-1][rings] + heads[rings] +
+                2*(segment_starts - starts[rings]))
+        p = coordinates[segment_starts]
+        q = coordinates[segment_starts + 1]
+        new_coordinates[positions] = 0.75*p + 0.25*q
+        new_coordinates[positions + 1] = 0.25*p + 0.75*q
+        new_coordinates[new_offsets[:-1][heads > 0]] = \
+                coordinates[starts[heads > 0]]
+        ends = new_offsets[1:] - 1
+        closed_tails = closed & (tails > 0)
+        new_coordinates[ends[closed_tails]] = new_coordinates[
+                new_offsets[:-1][closed_tails]]
+        open_tails = ~closed & (tails > 0)
+        new_coordinates[ends[open_tails]] = coordinates[
+                self._ring_offsets[1:][open_tails] - 1]
+        return Boundaries(new_coordinates, new_offsets, self._polygon_offsets)
@@ -1,16 +1,30 @@
+import hashlib, json, struct
 import numpy as np
+from snowline.utils.boundaries import Boundaries
 
 FLOAT_PREC = 6
 def boundaries_to_geo(boundaries):
+    """
+    Returns the boundaries as GeoJSON FeatureCollection, one Polygon per
+    snow patch.
+    :param boundaries: An instance of Boundaries, or nested lists as
+        returned by geo_to_boundaries
+    """
+    boundaries = Boundaries.from_polygons(boundaries)
+    # Rounding and conversion to Python floats is done once for the whole
+    # buffer, the rings are slices of the resulting list.
+    coordinates = np.round(boundaries.get_coordinates(), FLOAT_PREC).tolist()
+    ring_offsets = boundaries.get_ring_offsets().tolist()
+    polygon_offsets = boundaries.get_polygon_offsets().tolist()
     features = []
-    for boundary in boundaries:
+    for first_ring, last_ring in zip(polygon_offsets[:-1],
+            polygon_offsets[1:]):
         features.append({'type': 'Feature',
            'properties': {},
            'geometry': {'type': 'Polygon',
-            'coordinates':[[(round(x, FLOAT_PREC), round(y, FLOAT_PREC))
-                    for x,y in b]
-                        for b in boundary]}})
-        #print('@', boundary[0])
+            'coordinates': [coordinates[ring_offsets[iring]:
+                    ring_offsets[iring+1]]
+                for iring in range(first_ring, last_ring)]}})
 
     return {'type': 'FeatureCollection',
           'features':features}
@@ -20,12 +34,333 @@ def geo_to_boundaries(geo_dict):
 
 
 
+# Snowline deltas: the difference between two snowlines (GeoJSON
+# FeatureCollections), features identified by the hash of their geometry.
+#   {"type": "SnowlineDelta", "base": id of the database entry it applies to,
+#    "added": [features], "removed": [hashes],
+#    "modified": [{"hash": hash of the replaced feature, "feature": feature}]}
+def get_feature_hash(feature):
+    """
+    Returns the hash identifying a GeoJSON feature by its (rounded)
+    geometry, the same on the publishing and on the reading side
+    """
+    return hashlib.sha1(json.dumps(feature['geometry']['coordinates'],
+            separators=(',', ':')).encode()).hexdigest()[:16]
+
+
+def _get_feature_bboxes(features):
+    bboxes = np.zeros((len(features), 4))
+    for ifeature, feature in enumerate(features):
+        points = np.array([point for ring in feature['geometry']['coordinates']
+                for point in ring], dtype=float).reshape(-1, 2)
+        if len(points):
+            bboxes[ifeature] = np.concatenate([points.min(axis=0),
+                    points.max(axis=0)])
+    return bboxes
+
+
+def get_snowline_delta(old_geo, new_geo, base=None):
+    """
+    Returns the delta from old_geo to new_geo. Features of old_geo that are
+    not in new_geo are removed, unless a new feature overlaps their
+    bounding box, then they are modified (a snow patch that changed shape).
+    :param old_geo: The previous snowline as GeoJSON dictionary
+    :param new_geo: The new snowline as GeoJSON dictionary
+    :param base: The database id of the previous snowline
+    """
+    old_hashes = [get_feature_hash(feature) for feature in old_geo['features']]
+    new_hashes = [get_feature_hash(feature) for feature in new_geo['features']]
+    old_set, new_set = set(old_hashes), set(new_hashes)
+    gone = [(hash_, feature) for hash_, feature in zip(old_hashes,
+            old_geo['features']) if hash_ not in new_set]
+    new = [feature for hash_, feature in zip(new_hashes, new_geo['features'])
+            if hash_ not in old_set]
+    modified = []
+    if gone and new:
+        old_bboxes = _get_feature_bboxes([feature for _, feature in gone])
+        new_bboxes = _get_feature_bboxes(new)
+        # Overlap area of every pair of bounding boxes
+        overlap = np.prod(np.clip(np.minimum(new_bboxes[:, None, 2:],
+                old_bboxes[None, :, 2:]) - np.maximum(new_bboxes[:, None, :2],
+                old_bboxes[None, :, :2]), 0, None), axis=2)
+        # Matching the pairs with the largest overlap first
+        matched_new, matched_old = set(), set()
+        for inew, iold in zip(*np.unravel_index(np.argsort(-overlap,
+                axis=None), overlap.shape)):
+            if overlap[inew, iold] <= 0:
+                break
+            if inew in matched_new or iold in matched_old:
+                continue
+            matched_new.add(inew)
+            matched_old.add(iold)
+            modified.append({'hash': gone[iold][0], 'feature': new[inew]})
+        gone = [entry for iold, entry in enumerate(gone)
+                if iold not in matched_old]
+        new = [feature for inew, feature in enumerate(new)
+                if inew not in matched_new]
+    return {'type': 'SnowlineDelta', 'base': base, 'added': new,
+            'removed': [hash_ for hash_, _ in gone], 'modified': modified}
+
+
+def apply_snowline_delta(geo_dict, delta):
+    """
+    Returns the snowline resulting from applying delta to geo_dict, see
+    get_snowline_delta. Modified features keep their position, added
+    features are appended.
+    """
+    removed = set(delta['removed'])
+    replacements = {entry['hash']: entry['feature']
+            for entry in delta['modified']}
+    features = []
+    for feature in geo_dict['features']:
+        hash_ = get_feature_hash(feature)
+        if hash_ in removed:
+            continue
+        features.append(replacements.get(hash_, feature))
+    features.extend(delta['added'])
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def reconstruct_snowline(database, entry_id, read_file):
+    """
+    Returns the snowline of a database entry as GeoJSON dictionary.
+    Entries are either full snowlines (keyframes, with 'url') or deltas
+    ('delta_url') on the previous entry given by 'base'. The snowline is
+    reconstructed from the last keyframe and the deltas since then.
+    :param database: The snowline database (snowline.json) as dictionary
+    :param entry_id: The id of the entry
+    :param read_file: A function returning the content of a file
+        in the snowline bucket
+    """
+    entries = {entry['id']: entry for entry in database['data']}
+    chain = []
+    entry = entries[entry_id]
+    while 'url' not in entry:
+        chain.append(entry)
+        if entry.get('base') not in entries:
+            raise ValueError("Delta {} has no base in the database".format(
+                    entry['id']))
+        entry = entries[entry['base']]
+    geo_dict = json.loads(read_file(entry['url']))
+    for entry in reversed(chain):
+        geo_dict = apply_snowline_delta(geo_dict,
+                json.loads(read_file(entry['delta_url'])))
+    return geo_dict
+
+
 def clean_up_line(points, deviation=0.1):
     # get a line of points. remove all points that lie on the same line (except the very outer ones)
-    new_points = [points[0]]
-    
-    for idx, (point) in enumerate(points[1:-1], start=1):
-        if np.any(np.abs(0.5* (points[idx-1] + points[idx+1]) - point) > deviation):
-            new_points.append(point)
-    new_points.append(points[-1])
-    return new_points
+    points = np.asarray(points)
+    return list(Boundaries([points], [0, len(points)], [0, 1]).clean(
+            deviation=deviation).get_coordinates())
+
+
+# Binary snowline format, similar to FlatGeobuf:
+#   magic (8 bytes), header length (uint32), header (JSON),
+#   packed Hilbert R-tree of the feature bounding boxes,
+#   features sorted along the Hilbert curve.
+# A feature is: number of rings (uint32), number of points per ring
+# (uint32 each), the coordinates (float64, x y interleaved).
+# Every node of the tree is (minx, miny, maxx, maxy, offset), the levels are
+# stored from the root down. The offset of a leaf is the byte offset of its
+# feature in the data section, the offset of an internal node is the index
+# of its first child in the level below.
+# All numbers are little endian.
+BINARY_MAGIC = b'SNOWLIN\x01'
+_NODE_DTYPE = np.dtype([('minx', '<f8'), ('miny', '<f8'), ('maxx', '<f8'),
+        ('maxy', '<f8'), ('offset', '<u8')])
+_HILBERT_ORDER = 16
+
+
+def _hilbert_index(x, y):
+    """
+    Vectorized index along a Hilbert curve of order _HILBERT_ORDER for
+    integer coordinates 0 <= x, y < 2**_HILBERT_ORDER
+    """
+    x = np.asarray(x, dtype=np.int64).copy()
+    y = np.asarray(y, dtype=np.int64).copy()
+    index = np.zeros_like(x)
+    s = 1 << (_HILBERT_ORDER - 1)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        index += s * s * ((3 * rx) ^ ry)
+        # Rotating the quadrant
+        flip = ~ry
+        swap_x = np.where(flip & rx, s - 1 - x, x)
+        swap_y = np.where(flip & rx, s - 1 - y, y)
+        x, y = np.where(flip, swap_y, swap_x), np.where(flip, swap_x, swap_y)
+        s //= 2
+    return index
+
+
+def _get_level_sizes(nfeatures, node_size):
+    """
+    Returns the number of nodes per level, from the leaves up to the root
+    """
+    level_sizes = [nfeatures]
+    while level_sizes[-1] > 1:
+        level_sizes.append(-(-level_sizes[-1] // node_size))
+    return level_sizes
+
+
+def boundaries_to_binary(boundaries, node_size=16):
+    """
+    Encodes boundaries in the binary snowline format with a spatial index,
+    such that readers can fetch only the features in a bounding box.
+    :param boundaries: The boundaries as calculated by snowmap.get_boundaries,
+        transformed to WGS coordinates, or nested lists of rings
+    :param int node_size: The number of children per node of the index
+    :returns: bytes
+    """
+    if node_size < 2:
+        raise ValueError("node_size has to be at least 2")
+    boundaries = Boundaries.from_polygons(boundaries)
+    coordinates = boundaries.get_coordinates().astype('<f8')
+    ring_sizes = boundaries.get_ring_sizes()
+    point_offsets = boundaries.get_point_offsets()
+    bboxes = boundaries.get_bboxes()
+    features = []
+    for ipolygon, (first_ring, last_ring) in enumerate(zip(
+            boundaries.get_polygon_offsets()[:-1],
+            boundaries.get_polygon_offsets()[1:])):
+        sizes = ring_sizes[first_ring:last_ring]
+        sizes = sizes[sizes > 0]
+        if not len(sizes):
+            continue
+        features.append(np.concatenate([[len(sizes)], sizes]).astype(
+                '<u4').tobytes() + coordinates[point_offsets[ipolygon]:
+                point_offsets[ipolygon+1]].tobytes())
+    bboxes = bboxes[~np.isnan(bboxes[:, 0])]
+    nfeatures = len(features)
+
+    if nfeatures:
+        extent = np.concatenate([bboxes[:, :2].min(axis=0),
+                bboxes[:, 2:].max(axis=0)])
+        # Sorting the features along a Hilbert curve of the bbox centers
+        span = np.maximum(extent[2:] - extent[:2], 1e-12)
+        centers = (bboxes[:, :2] + bboxes[:, 2:]) / 2
+        scaled = ((centers - extent[:2]) / span *
+                ((1 << _HILBERT_ORDER) - 1)).astype(np.int64)
+        order = np.argsort(_hilbert_index(scaled[:, 0], scaled[:, 1]),
+                kind='stable')
+    else:
+        extent = np.zeros(4)
+        order = np.zeros(0, dtype=np.int64)
+
+    leaves = np.zeros(nfeatures, dtype=_NODE_DTYPE)
+    offsets = np.cumsum([0] + [len(features[i]) for i in order])
+    for name, column in zip(('minx', 'miny', 'maxx', 'maxy'), bboxes[order].T):
+        leaves[name] = column
+    leaves['offset'] = offsets[:-1]
+    levels = [leaves]
+    for level_size in _get_level_sizes(nfeatures, node_size)[1:]:
+        children = levels[-1]
+        parents = np.zeros(level_size, dtype=_NODE_DTYPE)
+        starts = np.arange(level_size) * node_size
+        parents['minx'] = np.minimum.reduceat(children['minx'], starts)
+        parents['miny'] = np.minimum.reduceat(children['miny'], starts)
+        parents['maxx'] = np.maximum.reduceat(children['maxx'], starts)
+        parents['maxy'] = np.maximum.reduceat(children['maxy'], starts)
+        parents['offset'] = starts
+        levels.append(parents)
+    index = b''.join(level.tobytes() for level in reversed(levels))
+
+    header = json.dumps({'version': 1, 'features': nfeatures,
+            'node_size': node_size, 'bbox': [float(v) for v in extent],
+            'index_size': len(index), 'data_size': int(offsets[-1])}).encode()
+    return b''.join([BINARY_MAGIC, struct.pack('<I', len(header)), header,
+            index] + [features[i] for i in order])
+
+
+def _get_file_range_reader(filename):
+    def read_range(offset, length):
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+    return read_range
+
+
+def read_binary_snowline(source, bbox=None):
+    """
+    Reads features from a file in the binary snowline format, see
+    boundaries_to_binary. With a bounding box, only the header, the index
+    and the matching features are read, using range reads.
+    :param source: A filename, or a function read_range(offset, length)
+        returning bytes, e.g. SnowlineDB.get_range_reader for remote files
+    :param bbox: Optional, (minx, miny, maxx, maxy). If given, returns only
+        the features whose bounding box intersects bbox.
+    :returns: A list of features, each a list of rings as (N, 2) arrays
+    """
+    if callable(source):
+        read_range = source
+    else:
+        read_range = _get_file_range_reader(source)
+    start = read_range(0, len(BINARY_MAGIC) + 4)
+    if start[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("Not a binary snowline file")
+    header_size, = struct.unpack('<I', start[len(BINARY_MAGIC):])
+    header = json.loads(read_range(len(start), header_size).decode())
+    index_start = len(start) + header_size
+    data_start = index_start + header['index_size']
+    nfeatures = header['features']
+    if nfeatures == 0:
+        return []
+    level_sizes = _get_level_sizes(nfeatures, header['node_size'])[::-1]
+    level_starts = np.cumsum([0] + level_sizes)
+    # Descending the tree from the root, level by level. Of every level,
+    # only the span of nodes that are children of matching nodes is read.
+    selected = np.arange(level_sizes[0])
+    for ilevel, level_size in enumerate(level_sizes):
+        first, last = int(selected.min()), int(selected.max())
+        span = np.frombuffer(read_range(index_start + _NODE_DTYPE.itemsize *
+                int(level_starts[ilevel] + first),
+                _NODE_DTYPE.itemsize * (last - first + 1)), dtype=_NODE_DTYPE)
+        nodes = span[selected - first]
+        if bbox is not None:
+            msk = ((nodes['minx'] <= bbox[2]) & (nodes['maxx'] >= bbox[0]) &
+                    (nodes['miny'] <= bbox[3]) & (nodes['maxy'] >= bbox[1]))
+            nodes = nodes[msk]
+            selected = selected[msk]
+        if len(selected) == 0:
+            return []
+        if ilevel == len(level_sizes) - 1:
+            break
+        child_size = level_sizes[ilevel+1]
+        selected = np.concatenate([np.arange(offset, min(offset +
+                header['node_size'], child_size), dtype=np.int64)
+                for offset in nodes['offset'].astype(np.int64)])
+    # span holds the leaves now, their offsets are the byte offsets of the
+    # features. The end of a feature is the start of the next one (or the
+    # end of the data).
+    next_offsets = np.frombuffer(read_range(index_start +
+            _NODE_DTYPE.itemsize * int(level_starts[-2] + last + 1),
+            _NODE_DTYPE.itemsize), dtype=_NODE_DTYPE)['offset'] \
+            if last + 1 < nfeatures else np.array([header['data_size']])
+    all_offsets = np.append(span['offset'], next_offsets[0])
+    starts = all_offsets[selected - first].astype(np.int64)
+    ends = all_offsets[selected - first + 1].astype(np.int64)
+    features = []
+    # Merging consecutive features into a single range read
+    iselected = 0
+    while iselected < len(selected):
+        ilast = iselected
+        while ilast + 1 < len(selected) and \
+                selected[ilast+1] == selected[ilast] + 1:
+            ilast += 1
+        data = read_range(data_start + int(starts[iselected]),
+                int(ends[ilast] - starts[iselected]))
+        for ifeature in range(iselected, ilast+1):
+            features.append(_decode_binary_feature(data,
+                    int(starts[ifeature] - starts[iselected])))
+        iselected = ilast + 1
+    return features
+
+
+def _decode_binary_feature(data, offset):
+    nrings, = struct.unpack_from('<I', data, offset)
+    npoints = np.frombuffer(data, dtype='<u4', count=nrings, offset=offset+4)
+    offset += 4 * (nrings + 1)
+    points = np.frombuffer(data, dtype='<f8', count=2*int(npoints.sum()),
+            offset=offset).reshape(-1, 2)
+    return np.split(points, np.cumsum(npoints)[:-1].astype(np.int64))
@@ -1,52 +1,73 @@
 import numpy as np
 import os
-from PIL import Image
 
+# GeoTIFF tags with the georeferencing of the raster
+_TAG_PIXEL_SCALE = 33550
+_TAG_TIEPOINT = 33922
 
 
 def load_array(filename):
     """
     Given a valid image, load the image and return the pixels as a numpy array
     :param filename: The filename as a string
-    :returns: A numpy array which stores the pixel data from a snowmap
+    :returns: A numpy array which stores the pixel data from a snowmap,
+        indexed (column, row), rows from top to bottom
 
     Convention is as follows: pixels that read 0,0,0, 255 are read as snow-free and contain the value 0;
     pixels that read 0,0,0,0 assume no data and return -1, and pixels that read (255, 255, 255, 255)
     are read as snow and get the value 1
     """
+    # PIL is only needed for GeoTIFF scenes
+    from PIL import Image
+    with Image.open(filename) as image:
+        pixels = np.asarray(image.convert('RGBA')).transpose(1, 0, 2)
 
-    image = Image.open(filename)
-    image.load()
-    height, width = image.size
-
-    snowmap = np.zeros((height, width), dtype=int)
-    for row in range(height):
-        for col in range(width):
-            a = image.getpixel((row,col))
-            if a == (0, 0, 0, 255): # This is no snow
-                snowmap[row, col] = 0
-            elif a ==  (0, 0, 0, 0): # this is no data
-                snowmap[row, col] = -1
-            elif a ==  (255, 255, 255, 255): # that's for snow
-                snowmap[row, col] = 1
-            else:
-                raise ValueError("Unknown Pixel value {}".format(a))
+    snowmap = np.zeros(pixels.shape[:2], dtype=int)
+    is_known = np.zeros(pixels.shape[:2], dtype=bool)
+    for value, rgba in ((0, (0, 0, 0, 255)), # This is no snow
+            (-1, (0, 0, 0, 0)), # this is no data
+            (1, (255, 255, 255, 255))): # that's for snow
+        mask = np.all(pixels == rgba, axis=2)
+        snowmap[mask] = value
+        is_known |= mask
+    if not is_known.all():
+        col, row = np.argwhere(~is_known)[0]
+        raise ValueError("Unknown Pixel value {}".format(
+                tuple(pixels[col, row])))
     return snowmap
 
 
 def get_coordinates(filename):
     """
-    Get coordinates from tiff file using gdal
+    Get the corner coordinates (upper left, lower left, upper right,
+    lower right) of a tiff file. They are read from the GeoTIFF tags if
+    present, otherwise from gdalinfo.
     Assume they are printed something like this:
      Upper Left  (   5.8000000,  47.8900000) (  5d48' 0.00"E, 47d53'24.00"N)
      Lower Left  (   5.8000000,  45.6000000) (  5d48' 0.00"E, 45d36' 0.00"N)
      Upper Right (  12.7318760,  47.8900000) ( 12d43'54.75"E, 47d53'24.00"N)
      Lower Right (  12.7318760,  45.6000000) ( 12d43'54.75"E, 45d36' 0.00"N)
     """
+    from PIL import Image
+    with Image.open(filename) as image:
+        width, height = image.size
+        scale = image.tag_v2.get(_TAG_PIXEL_SCALE)
+        tiepoint = image.tag_v2.get(_TAG_TIEPOINT)
+    if scale is not None and tiepoint is not None:
+        # The raster point (i, j) of the tie point is at (x, y)
+        i, j, _, x, y = tiepoint[:5]
+        left = x - i*scale[0]
+        top = y + j*scale[1]
+        right = left + width*scale[0]
+        bottom = top - height*scale[1]
+        return np.array([[left, top], [left, bottom], [right, top],
+                [right, bottom]])
     metadata_text = os.popen('gdalinfo {}'.format(filename)).readlines()
     for iline, line in enumerate(metadata_text):
         if line.strip() == 'Corner Coordinates:':
             break
+    else:
+        raise ValueError("No coordinates found for {}".format(filename))
     coords = []
     strings = ['Upper Left', 'Lower Left', 'Upper Right', 'Lower Right']
     for count, iline in enumerate(range(iline+1, iline+5)):
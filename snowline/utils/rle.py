@@ -0,0 +1,51 @@
+import json, struct
+import numpy as np
+
+# Run-length encoded state maps, for clients that only need the raster:
+#   magic (8 bytes), header length (uint32), header (JSON),
+#   values of the runs (int8 each), lengths of the runs (uint32 each).
+# Runs go over the flattened (row-major) array, rows from south to north.
+# The header holds the shape, the number of runs and optional attributes
+# such as the timestamp. All numbers are little endian.
+RLE_MAGIC = b'SNOWRLE\x01'
+
+
+def encode_rle(array, **attributes):
+    """
+    Encodes a 2-D integer array as runs of equal values
+    :param array: The array, values have to fit into int8
+    :param attributes: JSON-serializable attributes stored in the header
+    :returns: bytes
+    """
+    flat = np.asarray(array).ravel()
+    if len(flat):
+        starts = np.concatenate([[0], np.flatnonzero(flat[1:] != flat[:-1]) + 1])
+        lengths = np.diff(np.append(starts, len(flat)))
+    else:
+        starts = lengths = np.zeros(0, dtype=np.int64)
+    header = dict(attributes, version=1, shape=list(np.shape(array)),
+            runs=len(starts))
+    header = json.dumps(header).encode()
+    return b''.join([RLE_MAGIC, struct.pack('<I', len(header)), header,
+            flat[starts].astype('<i1').tobytes(),
+            lengths.astype('<u4').tobytes()])
+
+
+def decode_rle(data):
+    """
+    Decodes bytes written by encode_rle
+    :returns: array (int8), header
+    """
+    if data[:len(RLE_MAGIC)] != RLE_MAGIC:
+        raise ValueError("Not a run-length encoded map")
+    offset = len(RLE_MAGIC)
+    header_size, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    header = json.loads(data[offset:offset+header_size].decode())
+    offset += header_size
+    nruns = header['runs']
+    values = np.frombuffer(data, dtype='<i1', count=nruns, offset=offset)
+    lengths = np.frombuffer(data, dtype='<u4', count=nruns,
+            offset=offset+nruns)
+    array = np.repeat(values, lengths).astype(np.int8)
+    return array.reshape(header['shape']), header
@@ -1,6 +1,8 @@
-import boto3, json, datetime, tempfile, os, shutil
+import json, datetime, tempfile, os, shutil
 from snowline.analysis.snowmap import SnowMap
-from snowline.utils.geo_utils import boundaries_to_geo, geo_to_boundaries
+from snowline.utils.geo_utils import (boundaries_to_geo, geo_to_boundaries,
+        boundaries_to_binary, get_snowline_delta, reconstruct_snowline)
+from snowline.utils.storage import S3Storage, ConditionFailedError
 from abc import ABCMeta
 
 DB_VERSION = 0.1
@@ -9,21 +11,23 @@ BUCKET_URL = "https://snowlines.s3.eu-central-1.amazonaws.com"
 
 class S3DB(object, metaclass=ABCMeta):
     def __init__(self, aws_access_key_id=None,
-            aws_secret_access_key=None):
-        self._s3_resource = boto3.resource('s3',
-                aws_access_key_id=aws_access_key_id,
-                aws_secret_access_key=aws_secret_access_key)
+            aws_secret_access_key=None, storage=None):
+        """
+        :param storage: Optional, the Storage holding the files, e.g. a
+            LocalStorage to run offline. By default the S3 bucket
+            dbbucketname.
+        """
+        if storage is None:
+            storage = S3Storage(self._dbbucketname,
+                    aws_access_key_id=aws_access_key_id,
+                    aws_secret_access_key=aws_secret_access_key)
+        self._storage = storage
 
     def get_files(self):
-        dbbucket = self._s3_resource.Bucket(name=self._dbbucketname)
-        files = []
-        for dbobj_ in dbbucket.objects.all():
-            files.append(dbobj_.key)
-        return files
+        return self._storage.list()
 
     def download_files(self, filenames, directory, overwrite=False):
         os.makedirs(directory, exist_ok=True)
-        dbbucket = self._s3_resource.Bucket(name=self._dbbucketname)
         for filename in filenames:
             full_path = os.path.join(directory, filename)
             if not(overwrite) and os.path.isfile(full_path):
@@ -31,8 +35,7 @@ class S3DB(object, metaclass=ABCMeta):
                 continue
             # TODO Exception handling if files do not exist!
             print("Downloading {}".format(filename))
-            dbobj = self._s3_resource.Object(self._dbbucketname, filename)
-            dbobj.download_file(full_path)
+            self._storage.download_file(filename, full_path)
 
 
 class SatelliteDB(S3DB):
@@ -42,37 +45,95 @@ class SatelliteDB(S3DB):
 
 
 class SnowlineDB(S3DB):
+    # Attempts to write the database when other uploaders change it
+    # concurrently
+    _MAX_UPLOAD_ATTEMPTS = 3
+
     def __init__(self, dbbucketname='snowlines-database',
             snowlinebucketname='snowlines',
-            dbname='snowline.json', **kwargs):
+            dbname='snowline.json', snowline_storage=None, **kwargs):
+        """
+        :param snowline_storage: Optional, the Storage for the snowline
+            files. By default the S3 bucket snowlinebucketname, sharing the
+            connection of the database storage if that is on S3.
+        """
         self._dbbucketname = dbbucketname
         self._snowlinebucketname = snowlinebucketname
         self._dbname = dbname
+        # The id and content of the last snowline uploaded, the base of
+        # the next delta
+        self._published = None
         super().__init__(**kwargs)
+        if snowline_storage is None:
+            snowline_storage = S3Storage(snowlinebucketname,
+                    s3_resource=self._storage.get_s3_resource()
+                        if isinstance(self._storage, S3Storage) else None,
+                    aws_access_key_id=kwargs.get('aws_access_key_id'),
+                    aws_secret_access_key=kwargs.get('aws_secret_access_key'))
+        self._snowline_storage = snowline_storage
 
     def download_db(self):
         """
         Utility function, download db locally for inspection
         """
-        dbobj = self._s3_resource.Object(self._dbbucketname, self._dbname)
-        dbobj.download_file(self._dbname)
+        self._storage.download_file(self._dbname, self._dbname)
+
+    def get_range_reader(self, filename):
+        """
+        Returns a function read_range(offset, length) reading byte ranges
+        of a snowline file in the bucket, see geo_utils.read_binary_snowline
+        """
+        def read_range(offset, length):
+            return self._snowline_storage.get_range(filename, offset, length)
+        return read_range
+
+    def read_file(self, filename):
+        """
+        Returns the content of a file in the snowline bucket
+        """
+        return self._snowline_storage.get(filename)
+
+    def get_snowline(self, entry_id, database=None):
+        """
+        Returns the snowline of a database entry as GeoJSON dictionary,
+        reconstructed from keyframe and deltas if needed
+        :param database: Optional, the database, downloaded if not given
+        """
+        if database is None:
+            database = json.loads(self._storage.get(self._dbname))
+        return reconstruct_snowline(database, entry_id, self.read_file)
 
     def upload(self, boundaries, dry_run=False, timestamp=None,
-            verbose=True, wipe_previous=False):
+            verbose=True, wipe_previous=False, statistics=None, binary=False,
+            keyframe_interval=None, raster=None):
         """
         :param boundaries: The boundaries as calculated by snowmap.get_boundaries
+        :param statistics: Optional, JSON-serializable statistics (see
+            SnowMapUpdater.calculate_statistics), uploaded next to the snowline
+        :param bool binary: Also upload the snowline in the binary format
+            with spatial index, see geo_utils.boundaries_to_binary
+        :param bytes raster: Optional, the state map run-length encoded
+            (SnowMap.to_rle), uploaded next to the snowline
         :param bool dry_run: Whether this is a dry_run, if True will not upload
             but write to a directory
         :param timestamp: The timestamp to write to the DB. If None, will chose
             now()
         :param bool verbose: Enables verbose output
         :param bool wipe_previous: Deletes all previous data in the DB.
+        :param int keyframe_interval: If given, only every keyframe_interval
+            uploads a full snowline (keyframe) is written, in between only
+            the delta to the previous snowline, see
+            geo_utils.get_snowline_delta. Clients reconstruct snowlines with
+            geo_utils.reconstruct_snowline. If None, every upload is a
+            keyframe.
+        If another uploader changes the database concurrently, the
+        database is downloaded again and the entry (id and base of the
+        delta) recomputed, up to _MAX_UPLOAD_ATTEMPTS times before the
+        ConditionFailedError is raised.
         """
         if timestamp is None:
             timestamp = datetime.datetime.now().timestamp()
 
-        dbobj = self._s3_resource.Object(self._dbbucketname, self._dbname)
-
         # Creating a temporary directory to work in:
         with tempfile.TemporaryDirectory() as tmpdirname:
             if verbose:
@@ -82,74 +143,144 @@ class SnowlineDB(S3DB):
             new_sl_filename = 'snowline_{}.json'.format(
                     datetime.datetime.strftime(
                         datetime.datetime.fromtimestamp(timestamp), "%Y%m%d_%H%M"))
-            if verbose:
-                print(" Done\nWriting snowline boundaries to {}...".format(new_sl_filename))
-            with open(os.path.join(tmpdirname,new_sl_filename), 'w') as f:
-                json.dump(new_sl_data, f, separators=(',', ':'))
+            new_files = []
+            entry = {}
+            if statistics is not None:
+                new_stats_filename = 'snowline_stats_{}.json'.format(
+                        new_sl_filename[len('snowline_'):-len('.json')])
+                with open(os.path.join(tmpdirname, new_stats_filename),
+                        'w') as f:
+                    json.dump(statistics, f, separators=(',', ':'))
+                new_files.append(new_stats_filename)
+                entry['stats_url'] = new_stats_filename
+            if binary:
+                new_binary_filename = new_sl_filename[:-len('.json')] + '.bin'
+                with open(os.path.join(tmpdirname, new_binary_filename),
+                        'wb') as f:
+                    f.write(boundaries_to_binary(boundaries))
+                new_files.append(new_binary_filename)
+                entry['binary_url'] = new_binary_filename
+            if raster is not None:
+                new_raster_filename = 'snowmap_{}.rle'.format(
+                        new_sl_filename[len('snowline_'):-len('.json')])
+                with open(os.path.join(tmpdirname, new_raster_filename),
+                        'wb') as f:
+                    f.write(raster)
+                new_files.append(new_raster_filename)
+                entry['raster_url'] = new_raster_filename
 
             dbfilename = os.path.join(tmpdirname, self._dbname)
-            try:
-                if verbose:
-                    print("Downloading database...", end='')
-                dbobj.download_file(dbfilename)
-                with open(dbfilename) as f:
-                    database = json.load(f)
-            except Exception as e:
-                print("An exception occured: {}".format(e))
+            for attempt in range(1, self._MAX_UPLOAD_ATTEMPTS + 1):
+                # The database is only written if nobody else wrote it
+                # in the meantime, see below
+                db_version = None
+                try:
+                    if verbose:
+                        print("Downloading database...", end='')
+                    db_version = self._storage.get_version(self._dbname)
+                    database = json.loads(self._storage.get(self._dbname))
+                except Exception as e:
+                    print("An exception occured: {}".format(e))
+                    if wipe_previous:
+                        # This is recoverable since I dont need the DB in that case
+                        if verbose:
+                            print("Deciding not to download database.")
+                        # TODO Improve this hardcoded shit:
+                        database = {
+                            "version": DB_VERSION,
+                            "bucket": BUCKET_URL}
+                    else:
+                        raise e
+                database['updated'] = timestamp
                 if wipe_previous:
-                    # This is recoverable since I dont need the DB in that case
                     if verbose:
-                        print("Deciding not to download database.")
-                    # TODO Improve this hardcoded shit:
-                    database = {
-                        "version": DB_VERSION,
-                        "bucket": BUCKET_URL}
-                else:
-                    raise e
-            database['updated'] = timestamp
-            if wipe_previous:
-                if verbose:
-                    print(" Deleting previous data in DB")
-                # Before I do this, make a backup
-                for idx in range(1, 101):
-                    filepath = 'snowline-{}.json'.format(idx)
-                    if os.path.isfile(filepath):
-                        continue
-                    elif idx == 100:
-                        raise ValueError("Exceed number of filenames"
-                                " snowline-[1..100]")
-                    print("Keeping backup of previous database in {}".format(
-                            filepath))
-                    with open(filepath, 'w') as f:
-                        json.dump(database, f)
-                    break
-                database['data'] = []
+                        print(" Deleting previous data in DB")
+                    # Before I do this, make a backup
+                    for idx in range(1, 101):
+                        filepath = 'snowline-{}.json'.format(idx)
+                        if os.path.isfile(filepath):
+                            continue
+                        elif idx == 100:
+                            raise ValueError("Exceed number of filenames"
+                                    " snowline-[1..100]")
+                        print("Keeping backup of previous database in {}".format(
+                                filepath))
+                        with open(filepath, 'w') as f:
+                            json.dump(database, f)
+                        break
+                    database['data'] = []
 
-            current_max_id = max([0] + [d['id'] for d in database['data']])
-            # THe [0] + [ is to avoid get 0 when database is empty
-            # otherwise raises a ValueError.
+                current_max_id = max([0] + [d['id'] for d in database['data']])
+                # THe [0] + [ is to avoid get 0 when database is empty
+                # otherwise raises a ValueError.
 
+                # The id and the base of the delta depend on the database,
+                # decided again on every attempt
+                attempt_files = list(new_files)
+                attempt_entry = dict(entry)
+                delta = self._get_delta(database, new_sl_data, keyframe_interval)
+                if delta is None:
+                    if verbose:
+                        print("Writing snowline boundaries to {}...".format(
+                                new_sl_filename))
+                    with open(os.path.join(tmpdirname,new_sl_filename), 'w') as f:
+                        json.dump(new_sl_data, f, separators=(',', ':'))
+                    attempt_files.append(new_sl_filename)
+                    attempt_entry['url'] = new_sl_filename
+                else:
+                    new_delta_filename = 'snowline_delta_{}'.format(
+                            new_sl_filename[len('snowline_'):])
+                    if verbose:
+                        print("Writing snowline delta ({} added, {} removed, {} "
+                            "modified) to {}...".format(len(delta['added']),
+                            len(delta['removed']), len(delta['modified']),
+                            new_delta_filename))
+                    with open(os.path.join(tmpdirname, new_delta_filename),
+                            'w') as f:
+                        json.dump(delta, f, separators=(',', ':'))
+                    attempt_files.append(new_delta_filename)
+                    attempt_entry.update({'delta_url': new_delta_filename,
+                            'base': delta['base']})
 
-            database['data'].append({'id':current_max_id+1,
-                    'datetime':timestamp, 'url':new_sl_filename})
-            if verbose:
-                print(" Done\nWriting new database... ", end='')
-            with open(dbfilename, 'w') as f:
-                json.dump(database, f)
-            if verbose:
-                print("Done")
-            # upload
-            if not dry_run:
+                attempt_entry.update({'id':current_max_id+1, 'datetime':timestamp})
+                database['data'].append(attempt_entry)
+                if verbose:
+                    print(" Done\nWriting new database... ", end='')
+                with open(dbfilename, 'w') as f:
+                    json.dump(database, f)
+                if verbose:
+                    print("Done")
+                if dry_run:
+                    break
+                # upload
                 if verbose:
                     print("Uploading database and new snowline to "
                             "bucket... ", end="")
-                slobj = self._s3_resource.Object(
-                        self._snowlinebucketname, new_sl_filename)
-                slobj.upload_file(os.path.join(tmpdirname, new_sl_filename))
-                dbobj.upload_file(dbfilename)
+                # The files keep their names on every attempt, a retry
+                # overwrites them instead of leaving copies behind
+                for new_filename in attempt_files:
+                    with open(os.path.join(tmpdirname, new_filename),
+                            'rb') as f:
+                        self._snowline_storage.put(new_filename, f.read())
+                try:
+                    with open(dbfilename, 'rb') as f:
+                        # Raises ConditionFailedError if another uploader
+                        # changed the database since it was read
+                        self._storage.put(self._dbname, f.read(),
+                                if_version=db_version,
+                                if_absent=db_version is None)
+                except ConditionFailedError:
+                    if attempt == self._MAX_UPLOAD_ATTEMPTS:
+                        raise
+                    if verbose:
+                        print("\nThe database has been modified by another "
+                                "uploader, retrying")
+                    continue
+                self._published = (attempt_entry['id'], new_sl_data)
                 if verbose:
                     print("Done")
-            else:
+                break
+            if dry_run:
                 for idx in range(1, 101):
                     dirpath = 'dry-run-{}'.format(idx)
                     if os.path.isdir(dirpath):
@@ -162,6 +293,30 @@ class SnowlineDB(S3DB):
                     shutil.copytree(tmpdirname, dirpath)
                     break
 
+    def _get_delta(self, database, new_sl_data, keyframe_interval):
+        """
+        Returns the delta of new_sl_data to the last snowline in database,
+        None if a keyframe is due
+        """
+        if not keyframe_interval or not database['data']:
+            return None
+        last = max(database['data'], key=lambda entry: entry['id'])
+        # Uploads since the last keyframe, including that one
+        since_keyframe = 0
+        for entry in sorted(database['data'], key=lambda entry: -entry['id']):
+            since_keyframe += 1
+            if 'url' in entry:
+                break
+        if since_keyframe >= keyframe_interval:
+            return None
+        if self._published is None or self._published[0] != last['id']:
+            # Not uploaded by this instance, or someone else uploaded since
+            self._published = (last['id'],
+                    reconstruct_snowline(database, last['id'], self.read_file))
+        return get_snowline_delta(self._published[1], new_sl_data,
+                base=last['id'])
+
+
 if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
@@ -0,0 +1,220 @@
+import os, shutil, tempfile
+from abc import ABCMeta, abstractmethod
+
+
+class ConditionFailedError(Exception):
+    pass
+
+
+class Storage(object, metaclass=ABCMeta):
+    """
+    A flat key-value store of files, like an S3 bucket. Keys are strings,
+    values bytes. Every stored object has a version token that changes
+    whenever the object is written, used for conditional writes.
+    """
+    @abstractmethod
+    def list(self, prefix=''):
+        """
+        Returns the keys starting with prefix
+        """
+
+    @abstractmethod
+    def get(self, key):
+        """
+        Returns the content of key, raises KeyError if it does not exist
+        """
+
+    @abstractmethod
+    def get_range(self, key, offset, length):
+        """
+        Returns length bytes of key, starting at offset
+        """
+
+    @abstractmethod
+    def get_version(self, key):
+        """
+        Returns the version token of key, None if it does not exist
+        """
+
+    @abstractmethod
+    def put(self, key, data, if_version=None, if_absent=False):
+        """
+        Writes data to key. Raises ConditionFailedError, without writing,
+        if if_version is given and is not the current version of key, or
+        if if_absent is set and key exists.
+        """
+
+    def download_file(self, key, filename):
+        """
+        Writes the content of key to a local file
+        """
+        with open(filename, 'wb') as f:
+            f.write(self.get(key))
+
+
+class LocalStorage(Storage):
+    """
+    Storage in a local (or network) directory, keys are paths relative
+    to the directory. Writes are atomic, conditional writes are serialized
+    with a lock file.
+    """
+    _LOCK_FILENAME = '.storage.lock'
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._directory)
+
+    def _get_path(self, key):
+        path = os.path.normpath(os.path.join(self._directory, key))
+        if os.path.relpath(path, self._directory).startswith(os.pardir):
+            raise ValueError("Key {} is outside of the storage".format(key))
+        return path
+
+    def list(self, prefix=''):
+        keys = []
+        for root, _, filenames in os.walk(self._directory):
+            for filename in filenames:
+                if filename == self._LOCK_FILENAME or filename.endswith('.tmp'):
+                    continue
+                key = os.path.relpath(os.path.join(root, filename),
+                        self._directory).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def get(self, key):
+        try:
+            with open(self._get_path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def get_range(self, key, offset, length):
+        with open(self._get_path(key), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def get_version(self, key):
+        try:
+            stat = os.stat(self._get_path(key))
+        except FileNotFoundError:
+            return None
+        return '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+
+    def put(self, key, data, if_version=None, if_absent=False):
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if if_version is None and not if_absent:
+            os.replace(tmp_path, path)
+            return
+        import fcntl
+        with open(os.path.join(self._directory, self._LOCK_FILENAME),
+                'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            version = self.get_version(key)
+            if ((if_absent and version is not None) or
+                    (if_version is not None and version != if_version)):
+                os.remove(tmp_path)
+                raise ConditionFailedError("{} has been modified".format(key))
+            os.replace(tmp_path, path)
+
+    def download_file(self, key, filename):
+        shutil.copyfile(self._get_path(key), filename)
+
+
+class S3Storage(Storage):
+    """
+    Storage in an S3 bucket. Conditional writes use the ETag of the
+    objects (If-Match and If-None-Match).
+    """
+    def __init__(self, bucketname, s3_resource=None, aws_access_key_id=None,
+            aws_secret_access_key=None):
+        """
+        :param str bucketname: The name of the bucket
+        :param s3_resource: Optional, a boto3 S3 resource to share between
+            several buckets. Created if not given.
+        """
+        if s3_resource is None:
+            # boto3 takes a while to import, only load it once it is needed
+            import boto3
+            s3_resource = boto3.resource('s3',
+                    aws_access_key_id=aws_access_key_id,
+                    aws_secret_access_key=aws_secret_access_key)
+        self._s3_resource = s3_resource
+        self._bucketname = bucketname
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._bucketname)
+
+    def get_s3_resource(self):
+        return self._s3_resource
+
+    def _is_missing(self, error):
+        return error.response.get('Error', {}).get('Code') in (
+                '404', 'NoSuchKey', 'NotFound')
+
+    def list(self, prefix=''):
+        bucket = self._s3_resource.Bucket(name=self._bucketname)
+        return [obj.key for obj in bucket.objects.filter(Prefix=prefix)]
+
+    def get(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self._s3_resource.Object(self._bucketname,
+                    key).get()['Body'].read()
+        except ClientError as e:
+            if self._is_missing(e):
+                raise KeyError(key)
+            raise
+
+    def get_range(self, key, offset, length):
+        if length <= 0:
+            return b''
+        return self._s3_resource.Object(self._bucketname, key).get(
+                Range='bytes={}-{}'.format(offset, offset+length-1)
+                )['Body'].read()
+
+    def get_version(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self._s3_resource.Object(self._bucketname, key).e_tag
+        except ClientError as e:
+            if self._is_missing(e):
+                return None
+            raise
+
+    def put(self, key, data, if_version=None, if_absent=False):
+        from botocore.exceptions import ClientError
+        kwargs = {}
+        if if_version is not None:
+            kwargs['IfMatch'] = if_version
+        if if_absent:
+            kwargs['IfNoneMatch'] = '*'
+        try:
+            self._s3_resource.Object(self._bucketname, key).put(Body=data,
+                    **kwargs)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in (
+                    'PreconditionFailed', 'ConditionalRequestConflict'):
+                raise ConditionFailedError("{} has been modified".format(key))
+            raise
+
+    def download_file(self, key, filename):
+        self._s3_resource.Object(self._bucketname, key).download_file(filename)
+
+
+def get_storage(location, **aws_kwargs):
+    """
+    Returns the storage for a location, s3://<bucket> for an S3 bucket,
+    otherwise a local directory
+    """
+    if location.startswith('s3://'):
+        return S3Storage(location[len('s3://'):].strip('/'), **aws_kwargs)
+    return LocalStorage(location)
@@ -19,3 +19,17 @@ def get_datetime_from_filename(filename):
         raise ValueError("Could not find any date time in {}".format(filename))
     datestr = match.group('datetime')
     return datetime.datetime.strptime(datestr, '%Y%m%dT%H%M%S')
+
+
+def get_timestamp_from_date_string(date_string, completion='T0000'):
+    """
+    Returns the timestamp stored in a date string of format %Y%m%dT%H%M.
+    The hours and minutes can be omitted, in which case they are taken
+    from completion.
+    example: 20121217T2158 or 20121217
+    :param str completion: The time to complete the date string with, e.g.
+        'T2359' to get the end of a day.
+    """
+    if len(date_string) < 13:
+        date_string = date_string + completion[len(date_string)-13:]
+    return datetime.datetime.strptime(date_string, '%Y%m%dT%H%M').timestamp()
@@ -1,8 +1,20 @@
 import unittest
-import os, numpy as np
+import os, tempfile, json, asyncio, contextlib, io, numpy as np
 from snowline.analysis.snowmap import SnowMap, UpdatedSnowMap
 from snowline.analysis.grid import Grid
-from snowline.bin.update_snowmap import update_snowmap
+from snowline.bin.update_snowmap import (update_snowmap, watch_snowmap,
+        SnowMapUpdater)
+from snowline.bin.backfill import (backfill, parse_cadence,
+        CHECKPOINT_FILENAME)
+from snowline.utils.time_utils import (get_datetime_from_filename,
+        get_timestamp_from_date_string)
+from snowline.analysis.cube import SnowCube
+from snowline.bin.query_server import (SnowQueryService, serve,
+        _reload_periodically)
+from snowline.utils.storage import LocalStorage, ConditionFailedError
+from snowline.utils.s3_io import SnowlineDB
+from snowline.bin.check_import_time import (IMPORT_BUDGETS,
+        get_loaded_lazy_modules)
 
 class TestUpdateScript(unittest.TestCase):
     def test_script_1(self):
@@ -28,6 +40,577 @@ class TestUpdateScript(unittest.TestCase):
         
         self.assertTrue(new_state_map, os.listdir('./'))
         os.remove(new_state_map)
+
+class TestWatch(unittest.TestCase):
+    def test_find_local_files(self):
+        smu = SnowMapUpdater(allow_blank=True, verbose=False)
+        with tempfile.TemporaryDirectory() as watch_dir:
+            for filename in ('scene_20191214T093535_a.nc',
+                    'scene_20191215T093535_b.nc', 'notes.txt',
+                    'no_timestamp.nc'):
+                open(os.path.join(watch_dir, filename), 'w').close()
+            self.assertEqual(smu.find_local_netcdf_files(watch_dir), 2)
+            # Files already queued are not queued twice
+            self.assertEqual(smu.find_local_netcdf_files(watch_dir), 0)
+            self.assertTrue(smu.has_new_files())
+
+    def test_watch_empty_dir(self):
+        with tempfile.TemporaryDirectory() as watch_dir:
+            new_state_map = os.path.join(watch_dir, 'state.tar.gz')
+            watch_snowmap(watch_dir=watch_dir, new_state_map=new_state_map,
+                    quiet=True, poll_interval=0, max_polls=2)
+            # Nothing was processed, so nothing to checkpoint
+            self.assertFalse(os.path.exists(new_state_map))
+
+    def test_watch_failing_poll(self):
+        with tempfile.TemporaryDirectory() as watch_dir:
+            new_state_map = os.path.join(watch_dir, 'state.tar.gz')
+            _write_cloudy_netcdf(os.path.join(watch_dir,
+                    'scene_20191214T093535_a.nc'), 0.3)
+            # Broken, or still being written
+            with open(os.path.join(watch_dir,
+                    'scene_20191215T093535_a.nc'), 'w') as f:
+                f.write('incomplete')
+            _write_cloudy_netcdf(os.path.join(watch_dir,
+                    'scene_20191216T093535_a.nc'), 0.3)
+            # Files are only picked up once they did not change in two polls
+            watch_snowmap(watch_dir=watch_dir, new_state_map=new_state_map,
+                    quiet=True, poll_interval=0, max_polls=1,
+                    no_boundaries=True)
+            self.assertFalse(os.path.exists(new_state_map))
+            # The broken file does not stop the watch, the files before it
+            # are applied
+            watch_snowmap(watch_dir=watch_dir, new_state_map=new_state_map,
+                    quiet=True, poll_interval=0, max_polls=3,
+                    no_boundaries=True)
+            self.assertEqual(UpdatedSnowMap.load(new_state_map).get_timestamp(),
+                    get_datetime_from_filename(
+                        'scene_20191214T093535_a.nc').timestamp())
+            # After the third failed attempt the broken file is dropped
+            # and the files after it are applied
+            watch_snowmap(state_map=new_state_map, watch_dir=watch_dir,
+                    new_state_map=new_state_map, quiet=True, poll_interval=0,
+                    max_polls=4, no_boundaries=True)
+            self.assertEqual(UpdatedSnowMap.load(new_state_map).get_timestamp(),
+                    get_datetime_from_filename(
+                        'scene_20191216T093535_a.nc').timestamp())
+
+class _FakeUpdater(SnowMapUpdater):
+    """
+    Decodes random maps instead of reading NetCDF files
+    """
+    def __init__(self, *args, fail_at=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.decoded = []
+        self._fail_at = fail_at
+
+    def _decode(self, netcdf_file_path):
+        if netcdf_file_path == self._fail_at:
+            raise ValueError("Cannot decode {}".format(netcdf_file_path))
+        self.decoded.append(netcdf_file_path)
+        array = self._usm.get_array()
+        return SnowMap(np.random.choice(np.arange(-1,2),
+                size=array.shape).astype('int8'), is_internal=True)
+
+class TestPipeline(unittest.TestCase):
+    def test_pipeline_order(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for day in (17, 14, 15, 16):
+                path = os.path.join(directory,
+                        'scene_201912{}T093535_a.nc'.format(day))
+                open(path, 'w').close()
+                paths.append(path)
+            smu = _FakeUpdater(allow_blank=True, verbose=False)
+            smu.set_netcdf_files(*paths)
+            smu.update(delete_applied=True, queue_size=1)
+            self.assertEqual(smu.decoded, sorted(paths))
+            self.assertEqual(os.listdir(directory), [])
+            self.assertEqual(smu.get_metrics()['nfiles'], 4)
+            self.assertFalse(smu.has_new_files())
+
+    def test_pipeline_error(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for day in (14, 15, 16):
+                open(os.path.join(directory,
+                        'scene_201912{}T093535_a.nc'.format(day)), 'w').close()
+            fail_at = os.path.join(directory, 'scene_20191215T093535_a.nc')
+            smu = _FakeUpdater(allow_blank=True, verbose=False,
+                    fail_at=fail_at, max_decode_attempts=2)
+            smu.find_local_netcdf_files(directory)
+            with self.assertRaises(ValueError):
+                smu.update()
+            # Files before the failing one have been applied
+            self.assertEqual(smu.get_timestamp(), get_datetime_from_filename(
+                    'scene_20191214T093535_a.nc').timestamp())
+            # The failing file is dropped on the last attempt, the files
+            # after it are applied
+            smu.update(delete_applied=True)
+            self.assertEqual(smu.get_timestamp(), get_datetime_from_filename(
+                    'scene_20191216T093535_a.nc').timestamp())
+            self.assertEqual([path for path, _ in smu.get_metrics()['failed']],
+                    [fail_at])
+            # The dropped file is kept
+            self.assertEqual(sorted(os.listdir(directory)),
+                    ['scene_20191214T093535_a.nc',
+                    'scene_20191215T093535_a.nc'])
+            self.assertFalse(smu.has_new_files())
+
+class TestCheckpoint(unittest.TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for day in (14, 15, 16, 17, 18):
+                path = os.path.join(directory,
+                        'scene_201912{}T093535_a.nc'.format(day))
+                open(path, 'w').close()
+                paths.append(path)
+            store = os.path.join(directory, 'state.tar.gz')
+            smu = _FakeUpdater(allow_blank=True, verbose=False,
+                    fail_at=paths[3])
+            smu.set_netcdf_files(*paths)
+            with self.assertRaises(ValueError):
+                smu.update(store=store, checkpoint_files=2)
+            # The checkpoint after two files survived the crash
+            self.assertEqual(UpdatedSnowMap.load(store).get_timestamp(),
+                    get_datetime_from_filename(paths[1]).timestamp())
+            with open(store + '.journal') as f:
+                self.assertEqual(json.load(f)['applied'],
+                        [os.path.basename(path) for path in paths[:2]])
+            # A rerun starting from the same state only decodes the rest
+            smu = _FakeUpdater(allow_blank=True, verbose=False)
+            smu.set_netcdf_files(*paths)
+            smu.update(store=store, checkpoint_files=2)
+            self.assertEqual(smu.decoded, paths[2:])
+            self.assertEqual(UpdatedSnowMap.load(store).get_timestamp(),
+                    get_datetime_from_filename(paths[-1]).timestamp())
+            self.assertFalse(os.path.exists(store + '.journal'))
+            self.assertEqual(sorted(os.listdir(directory)),
+                    sorted(os.path.basename(path) for path in paths) +
+                    ['state.tar.gz'])
+
+def _write_cloudy_netcdf(filename, cloud_fraction):
+    import netCDF4
+    with netCDF4.Dataset(filename, mode='w') as ncfile:
+        ncfile.createDimension('lat', 40)
+        ncfile.createDimension('lon', 60)
+        # Partly outside of the grid, descending latitudes
+        ncfile.createVariable('lat', 'f8', ('lat',))[:] = np.linspace(
+                48.5, 46.0, 40)
+        ncfile.createVariable('lon', 'f8', ('lon',))[:] = np.linspace(
+                6.0, 12.0, 60)
+        cloud = np.zeros((40, 60), dtype='i4')
+        cloud[np.random.random(cloud.shape) < cloud_fraction] = 2
+        ncfile.createVariable('IDEPIX_CLOUD', 'i4', ('lat', 'lon'))[:] = cloud
+        ncfile.createVariable('IDEPIX_INVALID', 'i4', ('lat', 'lon'))[:] = 0
+        snow = np.zeros((40, 60), dtype='i4')
+        snow[:, :30] = 2
+        ncfile.createVariable('IDEPIX_SNOW_ICE', 'i4', ('lat', 'lon'))[:] = snow
+        ncfile.createVariable('RED', 'f4', ('lat', 'lon'))[:] = 0.5
+
+class TestTriage(unittest.TestCase):
+    def test_triage_skip(self):
+        from snowline.analysis.read_NetCDF import NetCDF4SnowMap
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'scene_20191214T093535_a.nc')
+            _write_cloudy_netcdf(filename, 0.9)
+            fraction = NetCDF4SnowMap.get_usable_fraction(filename, stride=1)
+            self.assertTrue(0.0 < fraction < 0.3)
+            smu = SnowMapUpdater(allow_blank=True, verbose=False,
+                    min_usable_fraction=0.5, triage_stride=1)
+            array_before = smu.get_state_map().get_array()
+            smu.set_netcdf_files(filename)
+            smu.update()
+            skipped = smu.get_metrics()['skipped']
+            self.assertEqual(len(skipped), 1)
+            self.assertEqual(skipped[0], (filename, fraction))
+            self.assertTrue(np.all(smu.get_state_map().get_array()
+                    == array_before))
+            # The skipped file is not picked up again
+            self.assertEqual(smu.find_local_netcdf_files(directory), 0)
+
+    def test_triage_message(self):
+        from snowline.analysis.read_NetCDF import NetCDF4SnowMap
+        with tempfile.TemporaryDirectory() as directory:
+            filenames = []
+            for day, cloud_fraction in ((14, 0.9), (15, 0.8), (16, 0.95)):
+                filenames.append(os.path.join(directory,
+                        'scene_201912{}T093535_a.nc'.format(day)))
+                _write_cloudy_netcdf(filenames[-1], cloud_fraction)
+            class DecodingAhead(SnowMapUpdater):
+                # All files are decoded before the first is applied
+                def _run_pipeline(self, netcdf_files, queue_size):
+                    return iter(list(super()._run_pipeline(netcdf_files,
+                            queue_size)))
+            smu = DecodingAhead(allow_blank=True, verbose=True,
+                    min_usable_fraction=0.5, triage_stride=1)
+            smu.set_netcdf_files(*filenames)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                smu.update()
+            # Every message names the fraction of its own file
+            for filename in filenames:
+                self.assertIn("Skipped NetCDF file {}, usable fraction "
+                        "{:.3f}".format(filename,
+                        NetCDF4SnowMap.get_usable_fraction(filename, stride=1)),
+                        output.getvalue())
+
+    def test_area_resampling(self):
+        from snowline.analysis.read_NetCDF import NetCDF4SnowMap
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'scene_20191214T093535_a.nc')
+            _write_cloudy_netcdf(filename, 0.5)
+            netcdf = NetCDF4SnowMap(filename)
+            fractions = netcdf.get_fractions()
+            self.assertTrue(np.allclose(fractions.sum(axis=0), 1))
+            snowmap = netcdf.get_snowmap(resampling='area')
+            # The majority class of every cell
+            self.assertTrue(np.all(snowmap[fractions[2] > 0.5] == 0))
+            self.assertTrue(np.all(snowmap[fractions[1] > 0.5] == -1))
+            self.assertTrue(np.all(snowmap[fractions[0] > 0.5] == 1))
+
+def _write_geotiff(filename, values, upper_left, pixel_size):
+    from PIL import Image, TiffImagePlugin
+    rgba = np.zeros(values.shape + (4,), dtype=np.uint8)
+    rgba[values == 0] = (0, 0, 0, 255)
+    rgba[values == 1] = 255
+    tags = TiffImagePlugin.ImageFileDirectory_v2()
+    tags[33550] = (pixel_size, pixel_size, 0.0)
+    tags[33922] = (0.0, 0.0, 0.0, upper_left[0], upper_left[1], 0.0)
+    tags.tagtype[33550] = tags.tagtype[33922] = 12
+    Image.fromarray(rgba, 'RGBA').save(filename, tiffinfo=tags)
+
+class TestReaders(unittest.TestCase):
+    def test_geotiff(self):
+        from snowline.analysis.readers import get_reader, GeoTIFFReader
+        from snowline.utils.read_geotiff import load_array
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'scene_20191214T093535_a.tif')
+            # Rows from north to south, snow in the north
+            values = np.zeros((20, 30), dtype=int)
+            values[:10] = 1
+            values[:, -5:] = -1
+            _write_geotiff(filename, values, (6.0, 47.5), 0.1)
+            self.assertTrue(np.all(load_array(filename) == values.T))
+            self.assertIs(get_reader(filename), GeoTIFFReader)
+            grid = Grid()
+            for resampling in ('nearest', 'area'):
+                snowmap = GeoTIFFReader.read(filename, resampling=resampling)
+                self.assertEqual(snowmap.shape, grid.zeros().shape)
+                iy, ix = grid.get_indices([7.0, 7.0, 8.9, 10.0],
+                        [47.2, 45.8, 46.2, 47.0])
+                self.assertEqual(snowmap[iy, ix].tolist(), [1, -1, 0, 0])
+        with self.assertRaises(ValueError):
+            get_reader('notes.txt')
+
+    def test_same_timestamp(self):
+        with tempfile.TemporaryDirectory() as directory:
+            netcdf = os.path.join(directory, 'scene_20191214T093535_a.nc')
+            _write_cloudy_netcdf(netcdf, 0.3)
+            # Snow everywhere, on the same day
+            geotiff = os.path.join(directory, 'scene_20191214T093535_b.tif')
+            _write_geotiff(geotiff, np.ones((30, 60), dtype=int),
+                    (5.5, 48.0), 0.1)
+            arrays = []
+            for decode_workers in (1, 2):
+                smu = SnowMapUpdater(allow_blank=True, verbose=False,
+                        decode_workers=decode_workers)
+                self.assertEqual(smu.find_local_netcdf_files(directory), 2)
+                smu.update()
+                arrays.append(smu.get_state_map().get_array())
+            self.assertTrue(np.all(arrays[0] == arrays[1]))
+            # The NetCDF scene has the higher priority, the GeoTIFF only
+            # fills in its unknown pixels
+            from snowline.analysis.readers import IdePixReader
+            netcdf_array = IdePixReader.read(netcdf)
+            known = netcdf_array != 0
+            self.assertTrue(np.all(arrays[0][known] == netcdf_array[known]))
+            self.assertTrue(np.all(arrays[0][~known] == 1))
+
+class TestOffline(unittest.TestCase):
+    def test_local_storage(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = LocalStorage(directory)
+            self.assertIsNone(storage.get_version('a/b.json'))
+            with self.assertRaises(KeyError):
+                storage.get('a/b.json')
+            storage.put('a/b.json', b'first', if_absent=True)
+            storage.put('c.json', b'other')
+            self.assertEqual(storage.list(), ['a/b.json', 'c.json'])
+            self.assertEqual(storage.list(prefix='a/'), ['a/b.json'])
+            self.assertEqual(storage.get_range('a/b.json', 1, 3), b'irs')
+            version = storage.get_version('a/b.json')
+            with self.assertRaises(ConditionFailedError):
+                storage.put('a/b.json', b'second', if_absent=True)
+            storage.put('a/b.json', b'second!', if_version=version)
+            # A writer with an outdated version fails
+            with self.assertRaises(ConditionFailedError):
+                storage.put('a/b.json', b'third', if_version=version)
+            self.assertEqual(storage.get('a/b.json'), b'second!')
+            with self.assertRaises(ValueError):
+                storage.get('../outside')
+
+    def test_concurrent_upload(self):
+        class RacingStorage(LocalStorage):
+            """
+            Lets another uploader write the database right before each
+            of the next conflicts writes
+            """
+            def __init__(self, directory, conflicts):
+                super().__init__(directory)
+                self.conflicts = conflicts
+
+            def put(self, key, data, if_version=None, if_absent=False):
+                if key == 'snowline.json' and self.conflicts:
+                    self.conflicts -= 1
+                    other = SnowlineDB(storage=LocalStorage(self._directory),
+                            snowline_storage=LocalStorage(self._directory))
+                    nentries = len(json.loads(self.get(key))['data'])
+                    other.upload(square, timestamp=timestamp - 3600*nentries,
+                            verbose=False, keyframe_interval=3)
+                return super().put(key, data, if_version=if_version,
+                        if_absent=if_absent)
+
+        square = [[[(0., 0.), (0., 1.), (1., 1.), (1., 0.), (0., 0.)]]]
+        timestamp = get_timestamp_from_date_string('20191214')
+        with tempfile.TemporaryDirectory() as directory:
+            LocalStorage(directory).put('snowline.json',
+                    json.dumps({'data': []}).encode())
+            storage = RacingStorage(directory, 2)
+            snowlinedb = SnowlineDB(storage=storage, snowline_storage=storage)
+            snowlinedb.upload(square, timestamp=timestamp, verbose=False,
+                    keyframe_interval=3)
+            database = json.loads(storage.get('snowline.json'))
+            # The entry is appended after the other uploads, as delta to
+            # the last of them
+            self.assertEqual([entry['id'] for entry in database['data']],
+                    [1, 2, 3])
+            self.assertEqual(database['data'][-1]['datetime'], timestamp)
+            self.assertEqual(database['data'][-1]['base'], 2)
+            self.assertEqual(snowlinedb.get_snowline(3)['features'],
+                    snowlinedb.get_snowline(1)['features'])
+            # Too many conflicts give up
+            storage.conflicts = SnowlineDB._MAX_UPLOAD_ATTEMPTS
+            with self.assertRaises(ConditionFailedError):
+                snowlinedb.upload(square, timestamp=timestamp + 3600,
+                        verbose=False, keyframe_interval=3)
+
+    def test_failed_download(self):
+        with tempfile.TemporaryDirectory() as directory:
+            satellite_dir = os.path.join(directory, 'satellite')
+            cache = os.path.join(directory, 'cache')
+            os.mkdir(satellite_dir)
+            os.mkdir(cache)
+            _write_cloudy_netcdf(os.path.join(satellite_dir,
+                    'scene_20191214T093535_a.nc'), 0.3)
+            smu = SnowMapUpdater(allow_blank=True, verbose=False,
+                    satellite_dir=satellite_dir)
+            smu.get_netcdf_files(cache)
+            satellite = smu._get_satellite('snowlines-satellite')
+            download_files = satellite.download_files
+            def fail_once(*args, **kwargs):
+                satellite.download_files = download_files
+                raise ConnectionError("Simulated network error")
+            satellite.download_files = fail_once
+            with self.assertRaises(ConnectionError):
+                smu.update()
+            # The file is still queued and downloaded by the next update
+            smu.get_netcdf_files(cache)
+            smu.update()
+            self.assertEqual(smu.get_timestamp(), get_datetime_from_filename(
+                    'scene_20191214T093535_a.nc').timestamp())
+            self.assertEqual(os.listdir(cache), ['scene_20191214T093535_a.nc'])
+
+    def test_offline_update(self):
+        with tempfile.TemporaryDirectory() as directory:
+            satellite_dir = os.path.join(directory, 'satellite')
+            database_dir = os.path.join(directory, 'database')
+            os.mkdir(satellite_dir)
+            state_map = os.path.join(directory, 'state.tar.gz')
+            LocalStorage(database_dir).put('snowline.json',
+                    json.dumps({'data': []}).encode())
+            for iday, day in enumerate(('20191214', '20191215', '20191216')):
+                _write_cloudy_netcdf(os.path.join(satellite_dir,
+                        'scene_{}T093535_a.nc'.format(day)), 0.3)
+                update_snowmap(state_map=state_map if iday else None,
+                        new_state_map=state_map, allow_blank=True,
+                        quiet=True, satellite_dir=satellite_dir,
+                        database_dir=database_dir, keyframe_interval=2,
+                        raster=True, delete_applied=True)
+            # The satellite directory is used in place, it is the source data
+            self.assertEqual(len(os.listdir(satellite_dir)), 3)
+            database = json.loads(LocalStorage(database_dir).get(
+                    'snowline.json'))
+            self.assertEqual([sorted(entry) for entry in database['data']], [
+                    ['datetime', 'id', 'raster_url', 'url'],
+                    ['base', 'datetime', 'delta_url', 'id', 'raster_url'],
+                    ['datetime', 'id', 'raster_url', 'url']])
+            raster = UpdatedSnowMap.from_rle(LocalStorage(database_dir).get(
+                    database['data'][-1]['raster_url']))
+            self.assertTrue(np.all(raster.get_array() ==
+                    UpdatedSnowMap.load(state_map).get_array()))
+            snowlinedb = SnowlineDB(storage=LocalStorage(database_dir),
+                    snowline_storage=LocalStorage(database_dir))
+            snowline = snowlinedb.get_snowline(2)
+            smu = SnowMapUpdater(update_map_path=None, verbose=False)
+            smu.set_netcdf_files(*sorted(os.path.join(satellite_dir, f)
+                    for f in os.listdir(satellite_dir))[:2])
+            smu.update()
+            smu.calculate_boundaries()
+            with tempfile.NamedTemporaryFile(suffix='.json') as f:
+                smu.write_boundaries(f.name)
+                expected = json.load(f)
+            self.assertEqual(len(snowline['features']),
+                    len(expected['features']))
+
+class TestBackfill(unittest.TestCase):
+    def test_parse_cadence(self):
+        self.assertEqual(parse_cadence('daily'), 86400)
+        self.assertEqual(parse_cadence('6h'), 6*3600)
+        self.assertEqual(parse_cadence('2d'), 2*86400)
+        for cadence in ('0h', '3m', 'monthly'):
+            with self.assertRaises(ValueError):
+                parse_cadence(cadence)
+
+    def test_backfill_resume(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            netcdf_dir = os.path.join(tmpdir, 'netcdf')
+            output_dir = os.path.join(tmpdir, 'output')
+            os.mkdir(netcdf_dir)
+            for day in ('20191201T093535', '20191202T183000',
+                    '20191203T093535'):
+                _write_cloudy_netcdf(os.path.join(netcdf_dir,
+                        'scene_{}_a.nc'.format(day)), 0.3)
+            backfill('20191201', '20191202', output_dir,
+                    netcdf_dir=netcdf_dir, quiet=True)
+            self.assertEqual(sorted(os.listdir(output_dir)), [
+                    CHECKPOINT_FILENAME,
+                    'snowline_20191202_0000.json',
+                    'snowline_20191203_0000.json',
+                    'statemap_20191202_0000.tar.gz',
+                    'statemap_20191203_0000.tar.gz'])
+            # Every output holds the scenes up to the end of its day,
+            # including the scene on the last day
+            for filename, day in (('statemap_20191202_0000.tar.gz',
+                        '20191201T093535'),
+                    ('statemap_20191203_0000.tar.gz', '20191202T183000')):
+                self.assertEqual(UpdatedSnowMap.load(os.path.join(output_dir,
+                        filename)).get_timestamp(), get_datetime_from_filename(
+                        'scene_{}_a.nc'.format(day)).timestamp())
+            # Removing an output that is before the checkpoint, a resumed
+            # run does not write it again.
+            os.remove(os.path.join(output_dir, 'statemap_20191202_0000.tar.gz'))
+            backfill('20191201', '20191203', output_dir,
+                    netcdf_dir=netcdf_dir, quiet=True, no_boundaries=True)
+            files = os.listdir(output_dir)
+            self.assertNotIn('statemap_20191202_0000.tar.gz', files)
+            self.assertEqual(UpdatedSnowMap.load(os.path.join(output_dir,
+                    'statemap_20191204_0000.tar.gz')).get_timestamp(),
+                    get_datetime_from_filename(
+                        'scene_20191203T093535_a.nc').timestamp())
+            with self.assertRaises(ValueError):
+                backfill('20191130', '20191203', output_dir,
+                        netcdf_dir=netcdf_dir, quiet=True)
+
+class TestQueryServer(unittest.TestCase):
+    def test_query_service(self):
+        grid = Grid()
+        current = np.random.choice(np.arange(-1,2),
+                size=grid.zeros().shape).astype('int8')
+        old = np.ones_like(current)
+        yesterday = get_timestamp_from_date_string('20191214T1200')
+        today = get_timestamp_from_date_string('20191215T1200')
+        with tempfile.TemporaryDirectory() as directory:
+            state_dir = os.path.join(directory, 'state')
+            cube_dir = os.path.join(directory, 'cube')
+            UpdatedSnowMap(current, is_internal=True,
+                    timestamp=today).publish(state_dir)
+            cube = SnowCube.create(cube_dir, current.shape, chunks=(100, 100))
+            cube.append(SnowMap(old, is_internal=True), yesterday)
+            service = SnowQueryService(state_dir=state_dir, cube_dir=cube_dir)
+
+            lon, lat = grid.get_coordinates()
+            points = [[lon[10, 20], lat[10, 20]], [lon[500, 900],
+                    lat[500, 900]], [0.0, 0.0]]
+            status, result = service.handle('POST', '/points',
+                    json.dumps({'points': points}).encode())
+            self.assertEqual(status, 200)
+            self.assertEqual(result['values'], [current[10, 20],
+                    current[500, 900], None])
+            status, result = service.handle('GET',
+                    '/point?lon={}&lat={}&date=20191214'.format(*points[1]))
+            self.assertEqual((status, result['value']), (200, 1))
+            status, result = service.handle('GET', '/point?lon=7&lat=46&'
+                    'date=20191201')
+            self.assertEqual(status, 404)
+            status, result = service.handle('GET', '/bbox?minlon=0&minlat=0'
+                    '&maxlon=20&maxlat=60')
+            self.assertEqual(result['snow'], (current == 1).sum())
+            self.assertEqual(result['unknown'], (current == 0).sum())
+            self.assertEqual(service.handle('GET', '/point?lon=7')[0], 400)
+            for body in (b'[1,2]', b'{"points": {"a": 1}}', b'{"points": 1}',
+                    b'{"points": [[1, 2, 3]]}', b'nonsense'):
+                self.assertEqual(service.handle('POST', '/points', body)[0],
+                        400)
+
+            # Hot reload after a new state map is published
+            UpdatedSnowMap(old, is_internal=True,
+                    timestamp=today+1).publish(state_dir)
+            os.utime(os.path.join(state_dir, 'array.npy'), ns=(1, 1))
+            self.assertTrue(service.reload())
+            self.assertEqual(service.handle('GET', '/point?lon={}&lat={}'
+                    .format(*points[0]))[1]['value'], 1)
+
+            async def request(*requests):
+                ready = asyncio.get_event_loop().create_future()
+                server = asyncio.ensure_future(serve(service, port=0,
+                        reload_interval=0.1, ready=ready))
+                port = await ready
+                responses = []
+                for request_bytes in requests:
+                    reader, writer = await asyncio.open_connection(
+                            '127.0.0.1', port)
+                    writer.write(request_bytes)
+                    responses.append(await reader.read())
+                    writer.close()
+                server.cancel()
+                return responses
+            loop = asyncio.new_event_loop()
+            response, invalid = loop.run_until_complete(request(
+                    b'GET /status HTTP/1.1\r\nConnection: close\r\n\r\n',
+                    b'POST /points HTTP/1.1\r\nConnection: close\r\n'
+                    b'Content-Length: 5\r\n\r\n[1,2]'))
+            loop.close()
+            self.assertTrue(response.startswith(b'HTTP/1.1 200 OK'))
+            self.assertEqual(json.loads(response.split(b'\r\n\r\n')[1])[
+                    'timestamp'], today+1)
+            self.assertTrue(invalid.startswith(b'HTTP/1.1 400 Bad Request'))
+
+    def test_failing_reload(self):
+        class FailingService(object):
+            nreloads = 0
+            def reload(self):
+                self.nreloads += 1
+                raise OSError("Map is being published")
+        service = FailingService()
+        async def run():
+            task = asyncio.ensure_future(_reload_periodically(service, 0.01))
+            await asyncio.sleep(0.1)
+            self.assertFalse(task.done())
+            task.cancel()
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run())
+        loop.close()
+        # Reloading goes on after a failure
+        self.assertGreater(service.nreloads, 1)
+
+class TestImportTime(unittest.TestCase):
+    def test_lazy_imports(self):
+        # Timings are machine dependent and checked by check_import_time,
+        # but heavy dependencies must never be loaded at import.
+        for module in IMPORT_BUDGETS:
+            self.assertEqual(get_loaded_lazy_modules(module), [])
+
 if __name__ == '__main__':
     unittest.main()
     
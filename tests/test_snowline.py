@@ -1,10 +1,20 @@
 import unittest
 import numpy as np
-import os, tempfile
+import os, tempfile, json
 from scipy.ndimage import measurements
 
 from snowline.analysis.snowmap import SnowMap, UpdatedSnowMap
-from snowline.analysis.grid import Grid
+from snowline.analysis.grid import Grid, _get_cell_edges
+from snowline.analysis.cube import SnowCube
+from snowline.analysis.regions import RegionRaster
+from snowline.analysis.dem import ElevationModel, ASPECTS
+from snowline.analysis.labelling import label_tiled
+from snowline.analysis.scene_cache import SceneCache
+from snowline.analysis.events import EventLog, ONSET, MELT
+from snowline.utils.geo_utils import (boundaries_to_binary,
+        read_binary_snowline, boundaries_to_geo, geo_to_boundaries,
+        get_snowline_delta, reconstruct_snowline, get_feature_hash)
+from snowline.utils.boundaries import Boundaries
 
 class TestSnowmap(unittest.TestCase):
     def test_read_snowline_1(self):
@@ -102,5 +112,371 @@ class TestSaveLoad(unittest.TestCase):
             self.assertTrue(smap_new._get_attributes(
                     ) == smap_new._get_attributes() == attributes)
             os.remove(filename)
+    def test_rle(self):
+        grid = Grid()
+        array = grid.zeros()
+        array[100:300, 200:700] = 1
+        array[400:, :] = -1
+        array[150:160, 250:260] = 0
+        usm = UpdatedSnowMap(array, is_internal=True, timestamp=1576316135.0)
+        data = usm.to_rle()
+        new = UpdatedSnowMap.from_rle(data)
+        self.assertTrue(np.all(new.get_array() == array))
+        self.assertEqual(new._get_attributes(), usm._get_attributes())
+        self.assertTrue(len(data) < array.nbytes / 100)
+        random = np.random.choice(np.arange(-1,2), size=(7, 11)).astype('int8')
+        self.assertTrue(np.all(SnowMap.from_rle(SnowMap(random).to_rle()
+                ).get_array() == random))
+
+class TestCube(unittest.TestCase):
+    def test_cube_1(self):
+        arrays = np.random.choice(np.arange(-1,2),
+                size=(6, 50, 70)).astype('int8')
+        with tempfile.TemporaryDirectory() as directory:
+            cube = SnowCube.create(directory, (50, 70), chunks=(16, 16))
+            for idx, array in enumerate(arrays):
+                cube.append(SnowMap(array, is_internal=True), 100.0+idx)
+            with self.assertRaises(ValueError):
+                cube.append(SnowMap(arrays[0], is_internal=True), 100.0)
+            cube = SnowCube(directory)
+            self.assertEqual(cube.get_shape(), arrays.shape)
+            self.assertTrue(np.all(cube.get_region_series(slice(3, 40),
+                    slice(10, 69)) == arrays[:, 3:40, 10:69]))
+            self.assertTrue(np.all(cube.get_pixel_series(33, 47, start=102)
+                    == arrays[2:, 33, 47]))
+            self.assertTrue(np.all(cube.get_snow_duration()
+                    == (arrays == 1).sum(axis=0)))
+            onset = cube.get_onset()
+            melt = cube.get_melt()
+            for iy, ix in ((0, 0), (49, 69), (20, 30)):
+                series = arrays[:, iy, ix]
+                snow_indices = np.where(series == 1)[0]
+                if len(snow_indices) == 0:
+                    self.assertTrue(np.isnan(onset[iy, ix]))
+                    self.assertTrue(np.isnan(melt[iy, ix]))
+                    continue
+                self.assertEqual(onset[iy, ix], 100.0 + snow_indices[0])
+                last = snow_indices[-1]
+                melt_indices = np.where(series[last:] == -1)[0]
+                if len(melt_indices):
+                    self.assertEqual(melt[iy, ix],
+                            100.0 + last + melt_indices[0])
+                else:
+                    self.assertTrue(np.isnan(melt[iy, ix]))
+
+class TestRegions(unittest.TestCase):
+    def test_regions_1(self):
+        square = [[7.0, 46.0], [8.0, 46.0], [8.0, 47.0], [7.0, 47.0],
+                [7.0, 46.0]]
+        hole = [[7.4, 46.4], [7.6, 46.4], [7.6, 46.6], [7.4, 46.6],
+                [7.4, 46.4]]
+        geo_dict = {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'name': 'square'},
+                'geometry': {'type': 'Polygon', 'coordinates': [square, hole]}},
+            {'type': 'Feature', 'properties': {'name': 'hole'},
+                'geometry': {'type': 'MultiPolygon', 'coordinates': [[hole]]}},
+            ]}
+        grid = Grid()
+        randommap = np.random.choice(np.arange(-1,2),
+                size=grid.zeros().shape).astype('int8')
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'regions.json')
+            with open(filename, 'w') as f:
+                json.dump(geo_dict, f)
+            regions = RegionRaster.from_geojson(filename, cache_dir=directory)
+            # Second time is read from the cache
+            cached = RegionRaster.from_geojson(filename, cache_dir=directory)
+        self.assertTrue(np.all(regions.get_labels() == cached.get_labels()))
+        self.assertEqual(cached.get_names(), ['square', 'hole'])
+        labels = regions.get_labels()
+        lon, lat = grid.get_coordinates()
+        inside_hole = (lon > 7.41) & (lon < 7.59) & (lat > 46.41) & (lat < 46.59)
+        self.assertTrue(np.all(labels[inside_hole] == 2))
+        self.assertTrue(np.all(labels[(lon < 6.9) | (lat > 47.1)] == 0))
+        statistics = regions.get_statistics(SnowMap(randommap,
+                is_internal=True))
+        for label, entry in enumerate(statistics, start=1):
+            self.assertEqual(entry['snow_pixels'],
+                    ((labels == label) & (randommap == 1)).sum())
+            self.assertEqual(entry['unknown_pixels'],
+                    ((labels == label) & (randommap == 0)).sum())
+
+class TestDEM(unittest.TestCase):
+    def test_snowline_altitude_1(self):
+        grid = Grid()
+        lon, lat = grid.get_coordinates()
+        # A cone-shaped mountain
+        elevation = np.clip(4000 - 8000*np.hypot(lon-8.2, (lat-46.8)/0.7),
+                200, None)
+        dem = ElevationModel(np.round(elevation))
+        for point, aspect in (((8.2, 47.0), 'N'), ((8.5, 46.8), 'E'),
+                ((8.2, 46.6), 'S'), ((7.9, 46.8), 'W')):
+            iy, ix = np.unravel_index(np.argmin(np.hypot(lon-point[0],
+                    lat-point[1])), lon.shape)
+            self.assertEqual(ASPECTS[dem.get_aspect()[iy, ix]], aspect)
+        snowmap = SnowMap(np.where(elevation >= 2500, 1, -1).astype('int8'),
+                is_internal=True)
+        for entry in dem.get_snowline_altitudes(snowmap):
+            if entry['aspect'] != 'flat':
+                self.assertEqual(entry['snowline_altitude'], 2500)
+
+class TestLabelling(unittest.TestCase):
+    def test_label_tiled_1(self):
+        for structure in ([[0,1,0], [1,1,1], [0,1,0]], np.ones((3, 3))):
+            for tile_size in (1, 7, 64, 1000):
+                msk = np.random.random((97, 131)) < 0.55
+                reference, num_reference = measurements.label(msk,
+                        structure=structure)
+                labels, num_clusters, sizes = label_tiled(msk,
+                        structure=structure, tile_size=tile_size, n_jobs=3)
+                self.assertEqual(num_clusters, num_reference)
+                # Labels can be numbered differently, but every cluster
+                # has to map to exactly one reference cluster
+                pairs = np.unique(np.stack([labels.ravel(),
+                        reference.ravel()], axis=1), axis=0)
+                self.assertEqual(len(pairs), num_clusters + 1)
+                self.assertTrue(np.all(sizes == np.bincount(labels.ravel())))
+
+    def test_label_tiled_overflow(self):
+        # 200 isolated pixels, more labels than int8 can hold
+        msk = np.zeros((20, 40), dtype=bool)
+        msk[::2, ::2] = True
+        with self.assertRaises(OverflowError):
+            label_tiled(msk, tile_size=10, out=np.zeros(msk.shape,
+                    dtype=np.int8))
+        labels, num_clusters, _ = label_tiled(msk, tile_size=10,
+                out=np.zeros(msk.shape, dtype=np.int16))
+        self.assertEqual(num_clusters, 200)
+        self.assertEqual(labels.max(), 200)
+
+class TestSceneCache(unittest.TestCase):
+    def test_scene_cache_1(self):
+        randommap = np.random.choice(np.arange(-1,2),
+                size=(81, 127)).astype('int8')
+        with tempfile.TemporaryDirectory() as directory:
+            input_filename = os.path.join(directory, 'scene.nc')
+            with open(input_filename, 'wb') as f:
+                f.write(b'some scene')
+            key = SceneCache.get_key(input_filename, 1)
+            self.assertNotEqual(key, SceneCache.get_key(input_filename, 2))
+            cache = SceneCache(os.path.join(directory, 'cache'))
+            self.assertIsNone(cache.get(key))
+            cache.put(key, randommap)
+            self.assertTrue(np.all(cache.get(key) == randommap))
+            # A cache too small for two entries evicts the older one
+            entry_size = os.path.getsize(cache._get_path(key))
+            cache = SceneCache(os.path.join(directory, 'cache'),
+                    max_size=1.5*entry_size)
+            os.utime(cache._get_path(key), (0, 0))
+            cache.put('other', randommap)
+            self.assertIsNone(cache.get(key))
+            self.assertTrue(np.all(cache.get('other') == randommap))
+
+class TestBinarySnowline(unittest.TestCase):
+    def test_binary_snowline_1(self):
+        boundaries = []
+        for _ in range(300):
+            center = np.random.uniform((5.7, 45.7), (10.7, 47.9))
+            boundaries.append([center + np.random.normal(0, 0.01,
+                    (np.random.randint(3, 20), 2))
+                    for _ in range(np.random.randint(1, 3))])
+        data = boundaries_to_binary(boundaries, node_size=4)
+        lengths = []
+        def read_range(offset, length):
+            lengths.append(length)
+            return data[offset:offset+length]
+        def key(feature):
+            return tuple(np.concatenate(feature).sum(axis=0).round(9))
+        self.assertEqual(sorted(map(key, read_binary_snowline(read_range))),
+                sorted(map(key, boundaries)))
+        for bbox in ((7.0, 46.0, 7.5, 46.5), (0.0, 0.0, 1.0, 1.0)):
+            del lengths[:]
+            features = read_binary_snowline(read_range, bbox=bbox)
+            expected = []
+            for boundary in boundaries:
+                points = np.concatenate(boundary)
+                if (points[:, 0].min() <= bbox[2] and
+                        points[:, 0].max() >= bbox[0] and
+                        points[:, 1].min() <= bbox[3] and
+                        points[:, 1].max() >= bbox[1]):
+                    expected.append(boundary)
+            self.assertEqual(sorted(map(key, features)),
+                    sorted(map(key, expected)))
+            # Only a small part of the file is read
+            self.assertTrue(sum(lengths) < len(data) / 10)
+
+class TestBoundaries(unittest.TestCase):
+    def test_boundaries_1(self):
+        grid = Grid()
+        array = grid.zeros()
+        array[100:140, 200:260] = 1
+        array[110:120, 210:220] = -1
+        array[300:305, 400:402] = 1
+        snowmap = SnowMap(array, is_internal=True)
+        boundaries = snowmap.get_boundaries(clean=False)
+        self.assertEqual(len(boundaries), 2)
+        # The patch with the hole has two rings
+        self.assertEqual(sorted(len(polygon) for polygon in boundaries), [1, 2])
+        # Iterating yields the same rings as the buffer
+        self.assertEqual(sum(len(ring) for polygon in boundaries
+                for ring in polygon), len(boundaries.get_coordinates()))
+        transformed = grid.transform_boundaries(boundaries)
+        for polygon, polygon_wgs in zip(boundaries, transformed):
+            for ring, ring_wgs in zip(grid.transform_boundary(polygon),
+                    polygon_wgs):
+                self.assertTrue(np.allclose(ring, ring_wgs))
+        bboxes = transformed.get_bboxes()
+        for polygon, bbox in zip(transformed, bboxes):
+            points = np.concatenate(polygon)
+            self.assertTrue(np.allclose(bbox, np.concatenate(
+                    [points.min(axis=0), points.max(axis=0)])))
+        # Cleaning removes the points on straight lines only
+        cleaned = boundaries.clean()
+        self.assertEqual(len(cleaned), len(boundaries))
+        for polygon, polygon_cleaned in zip(boundaries, cleaned):
+            for ring, ring_cleaned in zip(polygon, polygon_cleaned):
+                self.assertTrue(len(ring_cleaned) < len(ring))
+                self.assertTrue(np.allclose(ring[[0, -1]],
+                        ring_cleaned[[0, -1]]))
+        # GeoJSON round trip
+        geo = json.loads(json.dumps(boundaries_to_geo(transformed)))
+        restored = Boundaries.from_polygons(geo_to_boundaries(geo))
+        self.assertTrue(np.allclose(restored.get_coordinates(),
+                transformed.get_coordinates(), atol=1e-6))
+        self.assertTrue(np.array_equal(restored.get_ring_offsets(),
+                transformed.get_ring_offsets()))
+
+    def test_smooth(self):
+        def get_area(ring):
+            x, y = ring[:, 0], ring[:, 1]
+            return 0.5*abs(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+        y, x = np.mgrid[:60, :60]
+        array = np.where((y-30)**2 + (x-30)**2 < 15**2, 1, -1).astype(np.int8)
+        boundaries = SnowMap(array, is_internal=True).get_boundaries()
+        ring = boundaries[0][0]
+        for iterations in (1, 2, 3):
+            smoothed = SnowMap(array, is_internal=True).get_boundaries(
+                    smooth=iterations)
+            ring_smoothed = smoothed[0][0]
+            # Closed rings stay closed, with twice the segments per pass
+            self.assertTrue(np.allclose(ring_smoothed[0], ring_smoothed[-1]))
+            self.assertEqual(len(ring_smoothed) - 1,
+                    (len(ring) - 1) * 2**iterations)
+            self.assertTrue(abs(get_area(ring_smoothed) / get_area(ring) - 1)
+                    < 0.01)
+        # Open rings keep their end points, single vertices are kept
+        open_rings = Boundaries.from_polygons([[[(0, 0), (1, 0), (1, 1)],
+                [(5, 5)]]]).smooth()
+        self.assertTrue(np.allclose(open_rings[0][0], [(0, 0), (0.25, 0),
+                (0.75, 0), (1, 0.25), (1, 0.75), (1, 1)]))
+        self.assertTrue(np.allclose(open_rings[0][1], [(5, 5)]))
+
+class TestResampling(unittest.TestCase):
+    def test_area_weighted(self):
+        grid = Grid()
+        # A finer source grid, fully inside the internal grid
+        lon = np.linspace(7.0, 7.5, 230)
+        lat = np.linspace(46.2, 46.4, 130)
+        mask = np.random.random((len(lon), len(lat))) < 0.3
+        fractions, = grid.transform_fractions_from_grid([mask], lon, lat)
+        self.assertEqual(fractions.shape, grid.zeros().T.shape)
+        self.assertTrue(fractions.min() >= 0 and fractions.max() <= 1+1e-6)
+        # Conservation: the area of the mask is the same on both grids
+        lon_grid, lat_grid = grid.get_coordinates()
+        target_area = np.outer(np.diff(_get_cell_edges(lon_grid[0])),
+                np.diff(_get_cell_edges(lat_grid[:, 0])))
+        source_area = np.outer(np.diff(_get_cell_edges(lon)),
+                np.diff(_get_cell_edges(lat)))
+        self.assertTrue(np.isclose((fractions*target_area).sum(),
+                (mask*source_area).sum(), rtol=1e-5))
+        # Cells fully covered by a source of ones have fraction 1,
+        # cells outside the source 0
+        ones, = grid.transform_fractions_from_grid([np.ones_like(mask)],
+                lon, lat)
+        iy, ix = grid.get_indices(7.25, 46.3)
+        self.assertAlmostEqual(ones[ix, iy], 1, places=5)
+        iy, ix = grid.get_indices(9.0, 47.0)
+        self.assertEqual(ones[ix, iy], 0)
+        # The operator is built once per source geometry
+        self.assertIs(grid.get_resampling_operator(lon, lat)[0],
+                grid.get_resampling_operator(lon.copy(), lat.copy())[0])
+
+class TestSnowlineDelta(unittest.TestCase):
+    def test_delta_1(self):
+        grid = Grid()
+        array = grid.zeros()
+        for y0 in range(50, 650, 150):
+            for x0 in range(50, 1150, 250):
+                array[y0:y0+30, x0:x0+40] = 1
+        snowlines = [boundaries_to_geo(SnowMap(array, is_internal=True
+                ).get_boundaries(transform=True))]
+        array[200:230, 340:350] = 1   # grows
+        array[500:530, 800:840] = 0   # melts
+        array[10:20, 1000:1010] = 1   # new
+        snowlines.append(boundaries_to_geo(SnowMap(array, is_internal=True
+                ).get_boundaries(transform=True)))
+        delta = get_snowline_delta(snowlines[0], snowlines[1], base=1)
+        self.assertEqual((len(delta['added']), len(delta['removed']),
+                len(delta['modified'])), (1, 1, 1))
+        # Files and database as in the bucket, a keyframe and a delta
+        files = {'snowline_1.json': json.dumps(snowlines[0]),
+                'snowline_delta_2.json': json.dumps(delta)}
+        database = {'data': [{'id': 1, 'url': 'snowline_1.json'},
+                {'id': 2, 'delta_url': 'snowline_delta_2.json', 'base': 1}]}
+        for entry_id, expected in ((1, snowlines[0]), (2, snowlines[1])):
+            reconstructed = reconstruct_snowline(database, entry_id,
+                    files.__getitem__)
+            self.assertEqual(
+                    sorted(map(get_feature_hash, reconstructed['features'])),
+                    sorted(map(get_feature_hash, expected['features'])))
+        # The delta is much smaller than the full snowline
+        self.assertTrue(len(files['snowline_delta_2.json']) <
+                len(json.dumps(snowlines[1])) / 2)
+
+class TestEvents(unittest.TestCase):
+    def test_events_1(self):
+        grid = Grid()
+        array = grid.zeros()
+        array[100:150, 100:150] = -1
+        array[300:320, 400:420] = 1
+        usm = UpdatedSnowMap(array, is_internal=True, timestamp=1000.0)
+        new = grid.zeros()
+        new[100:110, 100:120] = 1   # onset
+        new[140:145, 140:142] = 1   # a second onset
+        new[300:320, 400:410] = -1  # melt
+        new[500:510, 500:510] = 1   # unknown before, not a flip
+        changes = usm.update(SnowMap(new, is_internal=True), timestamp=2000.0,
+                return_changes=True)
+        self.assertEqual(len(changes), 200 + 10 + 200)
+        self.assertEqual((changes.get_directions() == ONSET).sum(), 210)
+        self.assertTrue(np.all(usm.get_array().ravel()[
+                changes.get_indices()] == changes.get_directions()))
+        events = changes.get_events()
+        self.assertEqual(sorted((e['type'], e['pixels']) for e in events),
+                [('melt', 200), ('onset', 10), ('onset', 200)])
+        lon, lat = grid.get_coordinates()
+        melt, = [e for e in events if e['type'] == 'melt']
+        self.assertTrue(np.allclose(melt['bbox'], [lon[0, 400], lat[300, 0],
+                lon[0, 409], lat[319, 0]]))
+        self.assertEqual(len(changes.get_events(min_pixels=50)), 2)
+        self.assertIsNone(usm.update(SnowMap(new, is_internal=True)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            log = EventLog(os.path.join(directory, 'events.jsonl'),
+                    retention=500)
+            log.append(events)
+            inode = os.stat(log._filename).st_ino
+            later = [dict(event, timestamp=2400.0) for event in events]
+            log.append(later)
+            # Nothing to drop, the events are appended in place
+            self.assertEqual(os.stat(log._filename).st_ino, inode)
+            self.assertEqual(len(log.get_events()), 6)
+            self.assertEqual(len(log.get_events(since=2000.0)), 3)
+            self.assertEqual(len(log.get_events(bbox=melt['bbox'])), 2)
+            # The first events are older than the retention now
+            log.append([dict(events[0], timestamp=2600.0)])
+            self.assertEqual([e['timestamp'] for e in log.get_events()],
+                    [2400.0]*3 + [2600.0])
+
 if __name__ == '__main__':
     unittest.main()